@@ -112,6 +112,26 @@ DATABASES = {
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Rendered load pages are cached here, keyed by package generation. The cache must be shared by all the
+# web server processes, and by the warm_load_caches command, so don't use the per process LocMemCache.
+# Deployments across several servers should use a shared cache server such as Memcached or Redis.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    }
+}
+
+# How long, in seconds, rendered load pages are kept if their package doesn't change
+WAM_FRAGMENT_CACHE_TIMEOUT = 24 * 60 * 60
+
+# How long, in seconds, the modules each external examiner can access are cached if nothing changes
+WAM_EXAMINER_ACCESS_CACHE_TIMEOUT = 24 * 60 * 60
+
+# How long, in seconds, each process keeps the assessment workflow. Changes made through WAM are seen at once
+# through the shared cache above, this only bounds changes made directly to the database
+WAM_ASSESSMENT_WORKFLOW_CACHE_TIMEOUT = 10 * 60
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -61,6 +61,9 @@ urlpatterns = [
     re_path(r'^loads/$', views.loads, name='loads'),
     re_path(r'^loads_charts/$', views.loads_by_staff_chart, name='loads_charts'),
     re_path(r'^loads/modules/(?P<semesters>[0-9,]*)$', views.loads_modules, name='loads_modules'),
+    re_path(r'^loads/simulate/$', views.loads_simulate, name='loads_simulate'),
+    re_path(r'^loads/trend/$', views.loads_trend, name='loads_trend'),
+    re_path(r'^loads/trend/(?P<staff_id>[0-9]+)$', views.loads_trend, name='loads_trend_staff'),
     re_path(r'^activities/(?P<staff_id>[0-9]+)$', views.activities, name='activities'),
     re_path(r'^activities/index/$', ActivityListView.as_view(), name='activities_index'),
     re_path(r'^activities/create/$', CreateActivityView.as_view(), name='create activity'),
@@ -101,6 +104,7 @@ urlpatterns = [
             name='add_assessment_sign_off'),
     re_path(r'^modules/delete_assessment_sign_off/(?P<signoff_id>[0-9]+)(?P<confirm>/confirm)?$', views.delete_assessment_sign_off,
             name='delete_assessment_sign_off'),
+    re_path(r'^modules/allocation_solver/$', views.modules_allocation_solver, name='modules_allocation_solver'),
     re_path(r'^modules/allocations/(?P<package_id>[0-9]+)/(?P<module_id>[0-9]+)$', views.module_staff_allocation,
             name='module_staff_allocation'),
     re_path(r'^modules/create/$', CreateModuleView.as_view(), name='create module'),
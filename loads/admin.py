@@ -30,6 +30,7 @@ from .models import Project
 from .models import ProjectStaff
 from .models import School
 from .models import Staff
+from .models import StaffLoadSummary
 from .models import Task
 from .models import TaskCompletion
 from .models import Resource
@@ -111,6 +112,13 @@ class StaffAdmin(admin.ModelAdmin):
     search_fields = ['staff_number', 'user__first_name', 'user__last_name']
 
 
+class StaffLoadSummaryAdmin(admin.ModelAdmin):
+    list_display = ('package', 'staff', 'total_hours', 'semester1_hours', 'semester2_hours', 'semester3_hours',
+                    'modified')
+    list_filter = ('package',)
+    search_fields = ['staff__user__last_name', 'staff__user__first_name']
+
+
 class TaskAdmin(admin.ModelAdmin):
     list_display = ('name', 'category', 'deadline')
     list_filter = ('archive', 'category')
@@ -167,6 +175,7 @@ admin.site.register(Project)
 admin.site.register(ProjectStaff)
 admin.site.register(School, SchoolAdmin)
 admin.site.register(Staff, StaffAdmin)
+admin.site.register(StaffLoadSummary, StaffLoadSummaryAdmin)
 admin.site.register(Task, TaskAdmin)
 admin.site.register(TaskCompletion, TaskCompletionAdmin)
 admin.site.register(Resource)
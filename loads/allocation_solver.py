@@ -0,0 +1,302 @@
+"""Proposes ModuleStaff allocations which balance teaching load across the staff of a WorkPackage
+
+Work that is not yet allocated on each module is cut into chunks, and each chunk is given to a
+member of staff so that loads, normalised by FTE against the package nominal hours, stay as even
+as possible. A greedy pass takes the largest chunks first, each to the least loaded of a few
+candidates allowing for the semesters the chunk falls in, and a local search then moves chunks
+from the most to the least loaded member of staff while that narrows the spread.
+
+The calculation itself, solve_allocation(), works only on lists of numbers, so it runs in seconds
+even for thousands of modules and hundreds of staff. AllocationSolver gathers those lists from the
+database and turns the result back into proposals that can be previewed and accepted in bulk.
+"""
+
+import heapq
+import logging
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Sum
+
+from .helpers import SEMESTERS
+from .models import Module
+from .models import ModuleStaff
+from .models import StaffLoadSummary
+from .models import WorkPackage
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# How many of the least loaded staff are considered for each chunk
+CANDIDATES = 16
+
+# How much the busiest semester of a member of staff counts against the total load
+SEMESTER_WEIGHT = 0.5
+
+# The most chunks moved by the local search, which stops sooner if nothing improves
+ITERATIONS = 2000
+
+
+def solve_allocation(chunk_hours, chunk_semester_hours, capacities, loads, semester_loads,
+                     semester_weight=SEMESTER_WEIGHT, candidates=CANDIDATES, iterations=ITERATIONS):
+    """Assigns chunks of work to staff to minimise the spread of their normalised loads
+
+    chunk_hours             for each chunk, its total hours
+    chunk_semester_hours    for each chunk, a list of its hours in each semester
+    capacities              for each member of staff, the hours of a full load for their FTE
+    loads                   for each member of staff, the hours already allocated
+    semester_loads          for each member of staff, a list of the hours already allocated in each semester
+    semester_weight         how much the busiest semester counts against the total load
+    candidates              how many of the least loaded staff to consider for each chunk
+    iterations              the most moves the local search may make
+
+    returns a list with, for each chunk, the index of the member of staff it is assigned to
+    """
+    if not capacities:
+        return [None] * len(chunk_hours)
+
+    loads = list(loads)
+    semester_loads = [list(hours) for hours in semester_loads]
+    assignments = [None] * len(chunk_hours)
+
+    # Greedy, largest chunks first, each to the best of the least loaded staff
+    heap = [(loads[staff] / capacities[staff], staff) for staff in range(len(capacities))]
+    heapq.heapify(heap)
+    for chunk in sorted(range(len(chunk_hours)), key=lambda chunk: (-chunk_hours[chunk], chunk)):
+        hours = chunk_hours[chunk]
+        semester_hours = chunk_semester_hours[chunk]
+        shortlist = [heapq.heappop(heap) for counter in range(min(candidates, len(heap)))]
+
+        best = None
+        for load, staff in shortlist:
+            capacity = capacities[staff]
+            busiest = max(semester_loads[staff][semester] + semester_hours[semester]
+                          for semester in range(len(semester_hours)))
+            cost = (loads[staff] + hours + semester_weight * busiest) / capacity
+            if best is None or cost < best[0]:
+                best = (cost, staff)
+
+        staff = best[1]
+        assignments[chunk] = staff
+        loads[staff] += hours
+        for semester, extra in enumerate(semester_hours):
+            semester_loads[staff][semester] += extra
+        for load, other in shortlist:
+            heapq.heappush(heap, (loads[other] / capacities[other], other))
+
+    # Local search, move chunks from the most to the least loaded member of staff while that helps
+    chunks_by_staff = dict()
+    for chunk, staff in enumerate(assignments):
+        chunks_by_staff.setdefault(staff, set()).add(chunk)
+
+    for iteration in range(iterations):
+        normalised = [loads[staff] / capacities[staff] for staff in range(len(capacities))]
+        most = max((staff for staff in chunks_by_staff if chunks_by_staff[staff]), key=lambda staff: normalised[staff],
+                   default=None)
+        least = min(range(len(capacities)), key=lambda staff: normalised[staff])
+        if most is None or most == least:
+            break
+
+        # The chunk giving the narrowest pair of loads after the move, if that is narrower than now
+        best = None
+        for chunk in sorted(chunks_by_staff[most]):
+            hours = chunk_hours[chunk]
+            highest = max((loads[most] - hours) / capacities[most], (loads[least] + hours) / capacities[least])
+            if highest < normalised[most] - 1e-9 and (best is None or highest < best[0]):
+                best = (highest, chunk)
+        if best is None:
+            break
+
+        chunk = best[1]
+        hours = chunk_hours[chunk]
+        assignments[chunk] = least
+        chunks_by_staff[most].remove(chunk)
+        chunks_by_staff.setdefault(least, set()).add(chunk)
+        loads[most] -= hours
+        loads[least] += hours
+        for semester, extra in enumerate(chunk_semester_hours[chunk]):
+            semester_loads[most][semester] -= extra
+            semester_loads[least][semester] += extra
+
+    return assignments
+
+
+class AllocationProposal(object):
+    """A proposed ModuleStaff allocation
+
+    module                  the Module
+    staff                   the Staff
+    contact_proportion      the proposed percentage of contact hours
+    admin_proportion        the proposed percentage of admin hours
+    assessment_proportion   the proposed percentage of assessment hours
+    hours                   the total hours this adds to the load of the member of staff
+    existing                whether the member of staff is already allocated to the module, in which
+                            case the proportions are added to that allocation
+    """
+
+    def __init__(self, module, staff, existing=False):
+        self.module = module
+        self.staff = staff
+        self.existing = existing
+        self.contact_proportion = 0
+        self.admin_proportion = 0
+        self.assessment_proportion = 0
+        self.hours = 0.0
+
+    def __str__(self):
+        return str(self.module) + " : " + str(self.staff)
+
+
+class AllocationSolver(object):
+    """Proposes allocations for the unallocated module work in a WorkPackage
+
+    package         the WorkPackage
+    step            the largest percentage of each aspect of a module given to one chunk of work
+    modules         the Modules with unallocated work
+    staff           the Staff who may be allocated work, with a workload and an FTE
+    capacities      for each member of staff, the hours of a full load for their FTE
+    loads           for each member of staff, their [total, semester 1, semester 2, semester 3] hours now
+    generation      the package generation the data was read at
+    allocated_pairs a set of (module, staff) primary keys of the existing allocations
+
+    raises ValidationError if the package has no nominal hours, as loads can't then be compared
+    """
+
+    def __init__(self, package, step=50):
+        if not package.nominal_hours:
+            raise ValidationError("the package %(package)s has no nominal hours", params={'package': package})
+        self.package = package
+        self.step = step
+        # Read before the data, so the proposals are never labelled newer than they are
+        self.generation = WorkPackage.objects.filter(pk=package.pk).values_list('generation', flat=True).get()
+
+        self.staff = [staff for staff in package.get_all_staff().select_related('user')
+                      if staff.has_workload and not staff.is_external and staff.is_active() and staff.fte > 0]
+        summaries = StaffLoadSummary.get_for_package(package, self.staff)
+        self.capacities = [package.nominal_hours * staff.fte / 100 for staff in self.staff]
+        self.loads = [summaries[staff.pk].hours_by_semester()[:4] for staff in self.staff]
+
+        allocated = {row['module']: row for row in ModuleStaff.objects.filter(module__package=package).
+                     values('module').annotate(contact=Sum('contact_proportion'), admin=Sum('admin_proportion'),
+                                               assessment=Sum('assessment_proportion'))}
+        self.allocated_pairs = set(ModuleStaff.objects.filter(module__package=package).values_list('module', 'staff'))
+        modules = list(Module.objects.filter(package=package).select_related('package').order_by('module_code'))
+        module_hours = Module.get_hours_batch(modules)
+
+        # Each chunk is (module, contact, admin, assessment) proportions, with its hours kept alongside
+        self.modules = list()
+        self.chunks = list()
+        self.chunk_hours = list()
+        self.chunk_semester_hours = list()
+        for module in modules:
+            row = allocated.get(module.pk, dict())
+            remaining = [max(0, 100 - (row.get(aspect) or 0)) for aspect in ['contact', 'admin', 'assessment']]
+            hours = module_hours[module.pk]
+            aspects = [hours.contact_by_semester, hours.admin_by_semester, hours.assessment_by_semester]
+            if not any(remaining) or not (hours.contact or hours.admin or hours.assessment):
+                continue
+            self.modules.append(module)
+            while any(remaining):
+                proportions = [min(step, proportion) for proportion in remaining]
+                remaining = [proportion - part for proportion, part in zip(remaining, proportions)]
+                semester_hours = [sum(by_semester[semester] * proportion / 100
+                                      for by_semester, proportion in zip(aspects, proportions))
+                                  for semester in SEMESTERS]
+                self.chunks.append([module] + proportions)
+                self.chunk_hours.append(sum(semester_hours))
+                self.chunk_semester_hours.append(semester_hours)
+
+    def get_proposals(self):
+        """Solves the allocation, returns a list of AllocationProposal objects ordered by module and staff"""
+        assignments = solve_allocation(self.chunk_hours, self.chunk_semester_hours, self.capacities,
+                                       [load[0] for load in self.loads], [load[1:] for load in self.loads])
+
+        proposals = dict()
+        for chunk, staff_index in enumerate(assignments):
+            if staff_index is None:
+                continue
+            module, contact, admin, assessment = self.chunks[chunk]
+            staff = self.staff[staff_index]
+            key = (module.pk, staff.pk)
+            if key not in proposals:
+                proposals[key] = AllocationProposal(module, staff, existing=key in self.allocated_pairs)
+            proposal = proposals[key]
+            proposal.contact_proportion += contact
+            proposal.admin_proportion += admin
+            proposal.assessment_proportion += assessment
+            proposal.hours += self.chunk_hours[chunk]
+
+        return sorted(proposals.values(), key=lambda proposal: (proposal.module.module_code, str(proposal.staff)))
+
+    def get_load_changes(self, proposals):
+        """Returns a list of (staff, hours now, hours proposed, percentage now, percentage proposed)
+
+        Percentages are of a full load for the FTE of each member of staff, and only staff
+        with proposals are included.
+        """
+        extra = dict()
+        for proposal in proposals:
+            extra[proposal.staff.pk] = extra.get(proposal.staff.pk, 0.0) + proposal.hours
+
+        changes = list()
+        for staff, capacity, load in zip(self.staff, self.capacities, self.loads):
+            if staff.pk in extra:
+                proposed = load[0] + extra[staff.pk]
+                changes.append((staff, load[0], proposed, 100 * load[0] / capacity, 100 * proposed / capacity))
+        return changes
+
+    def get_spread(self, proposals=()):
+        """Returns the difference between the highest and lowest percentage loads, after any proposals"""
+        extra = dict()
+        for proposal in proposals:
+            extra[proposal.staff.pk] = extra.get(proposal.staff.pk, 0.0) + proposal.hours
+        percentages = [100 * (load[0] + extra.get(staff.pk, 0.0)) / capacity
+                       for staff, capacity, load in zip(self.staff, self.capacities, self.loads)]
+        return max(percentages) - min(percentages) if percentages else 0.0
+
+    def accept(self, proposals, activity_type=None):
+        """Creates ModuleStaff allocations for proposals in one go
+
+        Where a member of staff is already allocated to a module, the proposal is added to that
+        allocation, keeping its activity type, rather than a second allocation being created.
+
+        proposals       a list of AllocationProposal objects
+        activity_type   the ActivityType for new allocations, or None for the default
+
+        returns the number of allocations created or added to
+        """
+        existing = dict()
+        for allocation in ModuleStaff.objects.filter(module__in=[proposal.module for proposal in proposals],
+                                                     staff__in=[proposal.staff for proposal in proposals]). \
+                order_by('pk'):
+            existing.setdefault((allocation.module_id, allocation.staff_id), allocation)
+
+        created = list()
+        updated = list()
+        for proposal in proposals:
+            allocation = existing.get((proposal.module.pk, proposal.staff.pk))
+            if allocation is not None:
+                allocation.contact_proportion += proposal.contact_proportion
+                allocation.admin_proportion += proposal.admin_proportion
+                allocation.assessment_proportion += proposal.assessment_proportion
+                updated.append(allocation)
+                continue
+            allocation = ModuleStaff(module=proposal.module, staff=proposal.staff, package=self.package,
+                                     contact_proportion=proposal.contact_proportion,
+                                     admin_proportion=proposal.admin_proportion,
+                                     assessment_proportion=proposal.assessment_proportion)
+            if activity_type is not None:
+                allocation.activity_type = activity_type
+            created.append(allocation)
+
+        with transaction.atomic():
+            ModuleStaff.objects.bulk_create(created)
+            ModuleStaff.objects.bulk_update(updated, ['contact_proportion', 'admin_proportion',
+                                                      'assessment_proportion'])
+            # Bulk creation skips the signals which would otherwise keep these up to date
+            StaffLoadSummary.refresh(self.package, set(proposal.staff.pk for proposal in proposals))
+            WorkPackage.bump_generation([self.package])
+
+        logger.info("created %u and added to %u allocations from proposals for package %s" %
+                    (len(created), len(updated), self.package))
+        return len(created) + len(updated)
@@ -0,0 +1,291 @@
+"""Caching of rendered page fragments for WorkPackages, versioned by the package generation
+
+Keys include the package generation, which is increased whenever anything affecting the
+package changes (see WorkPackage.bump_generation()), so out of date fragments are never
+found again and simply expire. This uses Django's default cache, so needs no external service.
+"""
+
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, F, FloatField, OuterRef, Prefetch, Subquery, Sum, When
+from django.db.models.functions import Cast, Coalesce
+from django.template import loader
+from django.utils.safestring import mark_safe
+
+from .helpers import overlapping_semester_masks, semester_mask
+from .models import Activity
+from .models import LoadMatrix
+from .models import Module
+from .models import ModuleStaff
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# How long fragments are kept, in seconds, unless the package changes first
+FRAGMENT_TIMEOUT = getattr(settings, 'WAM_FRAGMENT_CACHE_TIMEOUT', 24 * 60 * 60)
+
+# Hit and miss counters are kept in the cache too, so all processes sharing it share them
+HITS_KEY = 'wam:fragment:hits'
+MISSES_KEY = 'wam:fragment:misses'
+
+
+def get_fragment_key(package, name, options):
+    """Returns the cache key for a fragment
+
+    package     the WorkPackage the fragment shows
+    name        a name for the fragment, usually the view name
+    options     a list of any form options that change the fragment
+    """
+    # The creation time distinguishes packages which reuse a primary key, as in a restored database
+    version = ':'.join(str(item) for item in [settings.WAM_VERSION, package.pk, package.created, package.generation])
+    options = ':'.join(str(option) for option in options)
+    return 'wam:fragment:{}:{}'.format(name, hashlib.sha1((version + '|' + options).encode()).hexdigest())
+
+
+def increment_counter(key):
+    """Increment a hit or miss counter, creating it if necessary"""
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter was culled between adding and incrementing it
+        cache.set(key, 1, timeout=None)
+
+
+def get_or_render_fragment(package, name, options, render):
+    """Returns a rendered fragment from the cache, or renders and caches it
+
+    package     the WorkPackage the fragment shows
+    name        a name for the fragment, usually the view name
+    options     a list of any form options that change the fragment
+    render      a function taking no arguments that renders the fragment as a string
+    """
+    key = get_fragment_key(package, name, options)
+    fragment = cache.get(key)
+    if fragment is None:
+        logger.debug("fragment cache miss for %s in package %s" % (name, package))
+        increment_counter(MISSES_KEY)
+        fragment = render()
+        cache.set(key, fragment, timeout=FRAGMENT_TIMEOUT)
+    else:
+        increment_counter(HITS_KEY)
+    return mark_safe(fragment)
+
+
+def get_fragment_statistics():
+    """Returns a dict of the number of fragment cache hits and misses"""
+    return {
+        'hits': cache.get(HITS_KEY, 0),
+        'misses': cache.get(MISSES_KEY, 0),
+    }
+
+
+def reset_fragment_statistics():
+    """Resets the fragment cache hit and miss counters"""
+    cache.delete_many([HITS_KEY, MISSES_KEY])
+
+
+def render_loads_table(package, show_percentages):
+    """Renders the table of staff loads by semester for the loads page
+
+    package             the WorkPackage to show
+    show_percentages    whether to show percentages of nominal hours rather than hours
+    """
+    # Get the loads of all staff in the package groups in one go, some users can be in multiple
+    # groups, but will only be counted once for the totals and average
+    matrix = LoadMatrix(package)
+    totals = [load_info[0] for load_info in matrix.semester_hours]
+    group_rows = matrix.get_group_rows(totals)
+
+    group_data = []
+    for group, rows in group_rows:
+        group_list = []
+        for row in rows:
+            staff = matrix.staff[row]
+            load_info = matrix.semester_hours[row]
+            if show_percentages:
+                combined_item = [staff] + matrix.get_percentages(row, load_info) + \
+                                [100 * (100 * load_info[0] / staff.fte) / package.nominal_hours]
+            else:
+                combined_item = [staff] + load_info + [100 * load_info[0] / staff.fte]
+            group_list.append(combined_item)
+
+        (group_total, group_average, group_allocated_staff, group_allocated_average) = \
+            matrix.get_statistics(rows, totals)
+        group_data.append(
+            [group, group_list, group_total, group_average, group_allocated_staff, group_allocated_average])
+
+    (total, total_staff, average) = matrix.get_overall_statistics(group_rows, totals)
+
+    return loader.render_to_string('loads/loads/loads_table.html', {
+        'group_data': group_data,
+        'total': total,
+        'total_staff': total_staff,
+        'average': average,
+        'show_percentages': show_percentages,
+    })
+
+
+def render_loads_charts_table(package, sort_by_load, show_90_110, scale_fte):
+    """Renders the charts of staff loads by category for the loads charts page
+
+    package             the WorkPackage to show
+    sort_by_load        whether to sort staff by load rather than alphabetically
+    show_90_110         whether to mark 90% and 110% of nominal hours
+    scale_fte           whether to scale loads by FTE
+    """
+    # Get the loads of all staff in the package groups in one go, some users can be in multiple
+    # groups, but will only be counted once for the totals and average
+    matrix = LoadMatrix(package)
+    totals = matrix.category_totals
+    group_rows = matrix.get_group_rows(totals)
+    categories = matrix.categories
+
+    group_data = []
+    for group, rows in group_rows:
+        group_list = []
+        for row in rows:
+            staff = matrix.staff[row]
+            hours = totals[row]
+
+            # For each member of staff, we want a list which includes, for each category
+            # The category, the number of hours in that category, and the percentage for the category
+            # as calculated against the nominal hours for the package
+            category_hours = matrix.category_hours[row]
+            percentages = matrix.get_percentages(row, category_hours, scale_fte=scale_fte)
+            staff_loads_by_category = [list(item) for item in zip(categories, category_hours, percentages)]
+
+            # For each staff member, the bar width is keyed to be 80% for 100% load, up to 100% for 125% load
+            # This allows us to show some moderately overloaded staff clearly.
+            if scale_fte:
+                bar_width = 0.8 * 100 * (100 / staff.fte) * hours / package.nominal_hours
+            else:
+                bar_width = 0.8 * 100 * hours / package.nominal_hours
+
+            if bar_width < 80:
+                bar_width = 80
+            if bar_width > 100:
+                bar_width = 100
+
+            # Now add all this data for each member of staff
+            combined_item = [staff, staff_loads_by_category, hours, bar_width, hours * (100/staff.fte)]
+            group_list.append(combined_item)
+
+        (group_total, group_average, group_allocated_staff, group_allocated_average) = \
+            matrix.get_statistics(rows, totals)
+
+        # We want to sort with the most loaded staff at the top, using scaled hours to compensate for FTE
+        if sort_by_load:
+            group_list = sorted(group_list, key=lambda item : item[4], reverse=True)
+
+        group_data.append(
+            [group, group_list, group_total, group_average, group_allocated_staff, group_allocated_average])
+
+    (total, total_staff, average) = matrix.get_overall_statistics(group_rows, totals)
+
+    return loader.render_to_string('loads/loads/loads_charts_table.html', {
+        'group_data': group_data,
+        'total': total,
+        'total_staff': total_staff,
+        'average': average,
+        'categories': categories,
+        'show_90_110': show_90_110,
+    })
+
+
+def render_modules_table(package, semesters, brief_details):
+    """Renders the table of module allocations for the loads by modules page
+
+    package             the WorkPackage to show
+    semesters           a comma separated string of semesters, only overlapping modules are shown
+    brief_details       whether to show less detail for each module
+    """
+    # The allocation totals are summed in the database, activities in a subquery so the joins don't multiply
+    activity_hours = Activity.objects.filter(module=OuterRef('pk')).order_by().values('module').annotate(
+        total=Sum(Case(
+            When(hours_percentage=Activity.HOURS, then=Cast('hours', FloatField())),
+            default=Cast('percentage', FloatField()) * F('package__nominal_hours') / 100.0,
+            output_field=FloatField()))).values('total')
+    package_modules = Module.objects.filter(package=package)
+    if semesters:
+        # Only modules in at least one of these semesters
+        package_modules = package_modules.filter(
+            semester_mask__in=overlapping_semester_masks(semester_mask(semesters)))
+    modules = package_modules. \
+        select_related('package', 'coordinator__user', 'size'). \
+        annotate(contact_proportion=Coalesce(Sum('modulestaff__contact_proportion'), 0),
+                 admin_proportion=Coalesce(Sum('modulestaff__admin_proportion'), 0),
+                 assessment_proportion=Coalesce(Sum('modulestaff__assessment_proportion'), 0),
+                 extra_hours=Coalesce(Subquery(activity_hours, output_field=FloatField()), 0.0)). \
+        prefetch_related(Prefetch('modulestaff_set',
+                                  queryset=ModuleStaff.objects.select_related('staff__user').order_by('pk'))). \
+        order_by('module_code')
+    modules = list(modules)
+
+    # Calculate the hours for all modules in one pass
+    module_hours = Module.get_hours_batch(modules)
+
+    combined_list = []
+    for module in modules:
+        hours = module_hours[module.pk]
+        module_info = [module,
+                       hours.contact,
+                       module.contact_proportion,
+                       hours.admin,
+                       module.admin_proportion,
+                       hours.assessment,
+                       module.assessment_proportion,
+                       module.extra_hours,
+                       module.modulestaff_set.all()]
+
+        combined_list.append(module_info)
+
+    return loader.render_to_string('loads/loads/modules_table.html', {
+        'combined_list': combined_list,
+        # Summed in the database where the package formulas allow
+        'totals': package.get_module_hours_totals(package_modules),
+        'brief_details': brief_details,
+    })
+
+
+def get_loads_table(package, show_percentages):
+    """Returns the rendered loads table, from the cache if possible, see render_loads_table()"""
+    return get_or_render_fragment(package, 'loads', [show_percentages],
+                                  lambda: render_loads_table(package, show_percentages))
+
+
+def get_loads_charts_table(package, sort_by_load, show_90_110, scale_fte):
+    """Returns the rendered loads charts, from the cache if possible, see render_loads_charts_table()"""
+    return get_or_render_fragment(package, 'loads_charts', [sort_by_load, show_90_110, scale_fte],
+                                  lambda: render_loads_charts_table(package, sort_by_load, show_90_110, scale_fte))
+
+
+def get_modules_table(package, semesters, brief_details):
+    """Returns the rendered modules table, from the cache if possible, see render_modules_table()"""
+    return get_or_render_fragment(package, 'loads_modules', [semesters, brief_details],
+                                  lambda: render_modules_table(package, semesters, brief_details))
+
+
+def warm_package_fragments(package):
+    """Renders and caches the fragments for a package with the options the views use by default
+
+    package     the WorkPackage to warm
+
+    returns a list of tuples of fragment name and the seconds taken to get it
+    """
+    fragments = [
+        ('loads', lambda: get_loads_table(package, package.show_percentages)),
+        ('loads_charts', lambda: get_loads_charts_table(package, True, False, True)),
+        ('loads_modules', lambda: get_modules_table(package, '', False)),
+    ]
+
+    timings = []
+    for name, get_fragment in fragments:
+        start = time.perf_counter()
+        get_fragment()
+        timings.append((name, time.perf_counter() - start))
+    return timings
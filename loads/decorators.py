@@ -1,6 +1,11 @@
 # Custom decorators for this project
 
+import hashlib
+
+from django.conf import settings
+from django.contrib import messages
 from django.core.exceptions import PermissionDenied
+from django.views.decorators.http import condition
 from .models import Staff
 
 
@@ -70,3 +75,55 @@ def admin_only(function):
     wrapper.__doc__ = function.__doc__
     wrapper.__name__ = function.__name__
     return wrapper
+
+
+def get_package_generation(request):
+    """
+    Returns (package_id, generation, generation_modified) for the logged in user's WorkPackage, or None
+
+    This is only looked up once for each request.
+    """
+    if not hasattr(request, '_package_generation'):
+        request._package_generation = None
+        # Pending messages are shown on the next page, so it must be sent in full
+        if request.method in ('GET', 'HEAD') and not len(messages.get_messages(request)):
+            request._package_generation = Staff.objects.filter(user=request.user, package__isnull=False).\
+                values_list('package', 'package__generation', 'package__generation_modified').first()
+    return request._package_generation
+
+
+def package_etag(request, *args, **kwargs):
+    """An ETag for a page showing the logged in user's WorkPackage, or None if it can't be cached"""
+    package_generation = get_package_generation(request)
+    if not package_generation:
+        return None
+    package_id, generation, generation_modified = package_generation
+    user = request.user
+    # The page also depends on who is looking, their CSRF token, and the version of the code
+    key = ':'.join(str(item) for item in [settings.WAM_VERSION, package_id, generation, user.pk,
+                                          user.is_staff, user.is_superuser,
+                                          request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def package_last_modified(request, *args, **kwargs):
+    """When the logged in user's WorkPackage pages last changed, or None if they can't be cached"""
+    package_generation = get_package_generation(request)
+    if not package_generation or not package_generation[2]:
+        return None
+    last_modified = package_generation[2]
+    # Logging in again should always give a fresh page
+    if request.user.last_login and request.user.last_login > last_modified:
+        last_modified = request.user.last_login
+    return last_modified
+
+
+def package_conditional(function):
+    """
+    Answers conditional GET requests for pages that only depend on the logged in user's WorkPackage
+
+    The ETag and Last-Modified headers come from the package generation, which is increased
+    whenever anything affecting the package changes. So an unchanged page gets a 304 response
+    before the view does any work. This should be applied after the access checks.
+    """
+    return condition(etag_func=package_etag, last_modified_func=package_last_modified)(function)
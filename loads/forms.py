@@ -12,6 +12,7 @@ from django.db import transaction
 from django.core.exceptions import ValidationError
 
 from .models import Activity
+from .models import ActivityType
 from .models import AssessmentResource, Task, Module, ActivityGenerator
 from .models import AssessmentStaff
 from .models import AssessmentStateSignOff
@@ -24,7 +25,7 @@ from .models import WorkPackage
 
 from .widgets import HoursPercentageField, SemesterField
 
-from WAM.settings import WAM_STAFF_REGEX, WAM_EXTERNAL_REGEX
+from WAM.settings import WAM_DEFAULT_ACTIVITY_TYPE, WAM_STAFF_REGEX, WAM_EXTERNAL_REGEX
 
 # Forms that are custom forms not based on a Model
 
@@ -128,6 +129,26 @@ class LoadChartsForm(forms.Form):
     sort_by_load = forms.BooleanField(required=False, initial=True)
 
 
+class AllocationSolverForm(forms.Form):
+    """Options for proposing allocations of unallocated module work"""
+    step = forms.IntegerField(min_value=5, max_value=100, initial=50, label="Largest share",
+                              help_text='The largest percentage of a module given to one member of staff at a time')
+    activity_type = forms.ModelChoiceField(queryset=ActivityType.objects.all(), initial=WAM_DEFAULT_ACTIVITY_TYPE,
+                                           help_text='The activity type for accepted allocations')
+
+    # Shown if loads in the package can't be compared, as a full load would be no hours
+    NO_NOMINAL_HOURS = "The work package has no nominal hours, so loads can't be balanced"
+
+    def __init__(self, *args, **kwargs):
+        self.package = kwargs.pop('package', None)
+        super(AllocationSolverForm, self).__init__(*args, **kwargs)
+
+    def clean(self):
+        """Check the package loads can be balanced"""
+        if self.package is not None and not self.package.nominal_hours:
+            raise ValidationError(self.NO_NOMINAL_HOURS)
+
+
 class ModulesIndexForm(forms.Form):
     """This prompts for comma separated semesters used for some restrictions"""
     semesters = SemesterField()
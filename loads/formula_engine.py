@@ -1,6 +1,13 @@
 # services/formula_engine.py
+import ast
 import math
-from simpleeval import simple_eval, InvalidExpression
+import operator
+import threading
+from functools import lru_cache
+
+from django.db.models import ExpressionWrapper, F, FloatField, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+from simpleeval import SimpleEval, InvalidExpression, FunctionNotDefined
 
 ALLOWED_FUNCTIONS = {
     'log': math.log,
@@ -13,14 +20,62 @@ ALLOWED_FUNCTIONS = {
     'round': round,
 }
 
+# The number of distinct formula strings kept in compiled form
+FORMULA_CACHE_SIZE = 256
+
+# Each thread keeps one evaluator, only its names change between evaluations
+_local = threading.local()
+
+# The only operators that can be translated into database expressions
+SQL_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+
 class FormulaError(Exception):
     pass
 
 
+class CompiledFormula(object):
+    """A formula parsed and whitelist checked once, ready for repeated evaluation
+
+    formula     the original formula text
+    tree        the parsed expression
+    """
+
+    def __init__(self, formula: str):
+        self.formula = formula
+        self.tree = SimpleEval.parse(formula)
+
+        # Reject functions outside the whitelist now, rather than on each evaluation
+        for node in ast.walk(self.tree):
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                if node.func.id not in ALLOWED_FUNCTIONS:
+                    raise FunctionNotDefined(node.func.id, formula)
+
+    def __call__(self, variables: dict):
+        """Evaluate with the given variables, raising simpleeval's exceptions as they occur"""
+        evaluator = getattr(_local, 'evaluator', None)
+        if evaluator is None:
+            evaluator = SimpleEval(functions=ALLOWED_FUNCTIONS)
+            _local.evaluator = evaluator
+        evaluator.names = variables
+        return evaluator.eval(self.formula, previously_parsed=self.tree)
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def compile_formula(formula: str) -> CompiledFormula:
+    """Return the compiled form of a formula, parsing it only the first time it is seen"""
+    return CompiledFormula(formula)
+
+
 def _evaluate(formula: str, variables: dict) -> float:
     """Core evaluation — not called directly by application code."""
     try:
-        result = simple_eval(formula, names=variables, functions=ALLOWED_FUNCTIONS)
+        result = compile_formula(formula)(variables)
         return float(result)
     except InvalidExpression as e:
         raise FormulaError(f"Invalid formula '{formula}': {e}")
@@ -79,6 +134,43 @@ def calculate_all_hours(package, credits: int, students: int) -> dict:
         'assessment': assessment,
     }
 
+def calculate_all_hours_batch(package, credits, students, contact_hours=None, admin_hours=None,
+                              assessment_hours=None, coordinator_hours=None) -> dict:
+    """Calculates hours for many modules of one package in a single pass.
+
+    credits and students are sequences with one entry per module. Each optional override
+    sequence holds a fixed value for a module, or None where the formula should be used,
+    just as the Module fields do. Modules sharing the same inputs are evaluated only once.
+
+    Returns a dict of lists, keyed as calculate_all_hours() with an extra 'coordinator' entry.
+    """
+    unset = [None] * len(credits)
+    results = {'contact': [], 'admin': [], 'assessment': [], 'coordinator': []}
+    evaluated = dict()
+    for inputs in zip(credits, students, contact_hours or unset, admin_hours or unset,
+                      assessment_hours or unset, coordinator_hours or unset):
+        if inputs not in evaluated:
+            evaluated[inputs] = _calculate_with_overrides(package, *inputs)
+        for name, value in zip(('contact', 'admin', 'assessment', 'coordinator'), evaluated[inputs]):
+            results[name].append(value)
+    return results
+
+
+def _calculate_with_overrides(package, credits, students, contact, admin, assessment, coordinator):
+    """Returns contact, admin, assessment and coordinator hours, using any override that is not None."""
+    contact = float(contact) if contact is not None else calculate_contact_hours(package, credits, students)
+    admin = float(admin) if admin is not None else calculate_admin_hours(package, credits, students, contact)
+    if assessment is not None:
+        assessment = float(assessment)
+    else:
+        assessment = calculate_assessment_hours(package, credits, students, contact, admin)
+    if coordinator is not None:
+        coordinator = float(coordinator)
+    else:
+        coordinator = calculate_coordinator_hours(package, credits, students)
+    return contact, admin, assessment, coordinator
+
+
 def calculate_coordinator_hours(package, credits: int, students: int) -> float:
     if package.coordinator_formula:
         variables = {
@@ -87,4 +179,114 @@ def calculate_coordinator_hours(package, credits: int, students: int) -> float:
         }
         return _evaluate(package.coordinator_formula, variables)
     # Fallback if no formula set — returns 0 rather than guessing
-    return 0.0
\ No newline at end of file
+    return 0.0
+
+
+def formula_to_expression(formula: str, names: dict):
+    """Translate a purely arithmetic formula into a database expression.
+
+    names maps each variable the formula may use to a database expression.
+    Returns None if the formula uses anything other than numbers, those names,
+    and + - * /, in which case the Python path must be used instead.
+
+    Division by zero gives NULL rather than a database error, so callers should
+    treat a NULL result as needing the Python path too.
+    """
+    try:
+        tree = compile_formula(formula).tree
+    except (InvalidExpression, SyntaxError):
+        return None
+    return _to_expression(tree, names)
+
+
+def _to_expression(node, names):
+    """Recursively translate an expression tree, returning None if any part can't be"""
+    if isinstance(node, ast.Expr):
+        return _to_expression(node.value, names)
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            return None
+        return Value(float(node.value), output_field=FloatField())
+    if isinstance(node, ast.Name):
+        return names.get(node.id)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        operand = _to_expression(node.operand, names)
+        if operand is None or isinstance(node.op, ast.UAdd):
+            return operand
+        return ExpressionWrapper(Value(0.0) - operand, output_field=FloatField())
+    if isinstance(node, ast.BinOp) and type(node.op) in SQL_OPERATORS:
+        left = _to_expression(node.left, names)
+        right = _to_expression(node.right, names)
+        if left is None or right is None:
+            return None
+        if isinstance(node.op, ast.Div):
+            right = NullIf(right, Value(0.0), output_field=FloatField())
+        return ExpressionWrapper(SQL_OPERATORS[type(node.op)](left, right), output_field=FloatField())
+    return None
+
+
+def package_hours_expressions(package):
+    """Returns database expressions for module contact, admin and assessment hours in a package.
+
+    Module overrides are respected, as are the legacy scalings when a formula isn't set.
+    Returns a dict keyed as calculate_all_hours(), or None if any formula can't be translated.
+    """
+    def scalar(value):
+        return Value(float(value), output_field=FloatField())
+
+    def field(name):
+        return Cast(F(name), output_field=FloatField())
+
+    # Each formula sees exactly the variables it would in the Python path
+    credits = field('credits')
+    students = field('number_students')
+    contact_scaling = scalar(package.credit_contact_scaling)
+    admin_scaling = scalar(package.contact_admin_scaling)
+    assessment_scaling = scalar(package.contact_assessment_scaling)
+
+    if package.contact_formula:
+        contact = formula_to_expression(package.contact_formula, {
+            'credits': credits,
+            'students': students,
+            'contact_scaling': contact_scaling,
+        })
+    else:
+        contact = ExpressionWrapper(credits * contact_scaling, output_field=FloatField())
+    if contact is None:
+        return None
+    contact = Coalesce(field('contact_hours'), contact, output_field=FloatField())
+
+    if package.admin_formula:
+        admin = formula_to_expression(package.admin_formula, {
+            'credits': credits,
+            'students': students,
+            'contact': contact,
+            'admin_scaling': admin_scaling,
+            'assessment_scaling': assessment_scaling,
+        })
+    else:
+        admin = ExpressionWrapper(contact * admin_scaling, output_field=FloatField())
+    if admin is None:
+        return None
+    admin = Coalesce(field('admin_hours'), admin, output_field=FloatField())
+
+    if package.assessment_formula:
+        assessment = formula_to_expression(package.assessment_formula, {
+            'credits': credits,
+            'students': students,
+            'contact': contact,
+            'admin': admin,
+            'admin_scaling': admin_scaling,
+            'assessment_scaling': assessment_scaling,
+        })
+    else:
+        assessment = ExpressionWrapper(contact * assessment_scaling, output_field=FloatField())
+    if assessment is None:
+        return None
+    assessment = Coalesce(field('assessment_hours'), assessment, output_field=FloatField())
+
+    return {
+        'contact': contact,
+        'admin': admin,
+        'assessment': assessment,
+    }
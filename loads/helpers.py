@@ -1,5 +1,11 @@
 # Helper Functions used in the project
 
+import time
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
 def divide_by_semesters(total_hours, semester_string):
     """divide hours equally between targeted semesters
 
@@ -16,4 +22,86 @@ def divide_by_semesters(total_hours, semester_string):
         for semester in range(1, 4)
     ]
     split_hours.insert(0, total_hours)
-    return split_hours
\ No newline at end of file
+    return split_hours
+
+# Semesters 1 to 3 are held in bits 0 to 2 of a semester mask
+SEMESTERS = (1, 2, 3)
+
+
+def semester_mask(semester_string):
+    """convert a comma separated list of semesters into a bitmask
+
+    semester_string comma separated list of semesters, e.g. "1,3"
+
+    returns an integer with bit 0 set for semester 1, bit 1 for semester 2
+    and so on, anything other than semesters 1 to 3 is ignored
+    """
+    mask = 0
+    for semester in str(semester_string).split(','):
+        semester = semester.strip()
+        if semester.isdigit() and int(semester) in SEMESTERS:
+            mask |= 1 << (int(semester) - 1)
+    return mask
+
+
+# For each possible mask, what to divide the total hours by in each semester, or 0 if not in it
+SEMESTER_DIVISORS = [
+    tuple(bin(mask).count('1') if mask & (1 << (semester - 1)) else 0 for semester in SEMESTERS)
+    for mask in range(1 << len(SEMESTERS))
+]
+
+
+def divide_by_semester_mask(total_hours, mask):
+    """divide hours equally between targeted semesters, without parsing a semester string
+
+    total_hours     the total number of hours to divide
+    mask            a semester mask, see semester_mask()
+
+    returns a list exactly as for divide_by_semesters()
+    """
+    split_hours = [total_hours]
+    for divisor in SEMESTER_DIVISORS[mask]:
+        split_hours.append(total_hours / divisor if divisor else 0)
+    return split_hours
+
+
+def overlapping_semester_masks(mask):
+    """returns a list of all the semester masks sharing at least one semester with the one given
+
+    This allows an indexed filter like semester_mask__in= rather than bitwise arithmetic
+    """
+    return [other for other in range(1, 1 << len(SEMESTERS)) if other & mask]
+
+
+class CacheVersion(object):
+    """A version kept in the default cache, which tells every process when some data has changed
+
+    Data loaded from the database can be kept with the version it was loaded at, and is out of
+    date once the version differs. This only works if every process shares the cache, so with the
+    per process local memory cache, or no cache, there is no version and data must be loaded again.
+
+    key     the cache key of the version
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    @staticmethod
+    def is_shared():
+        """Checks if the default cache is shared by all processes"""
+        return not isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+    def get(self):
+        """Returns the current version, or None if there is no shared cache to keep it"""
+        if not self.is_shared():
+            return None
+        version = cache.get(self.key)
+        if version is None:
+            self.invalidate()
+            version = cache.get(self.key)
+        return version
+
+    def invalidate(self):
+        """Starts a new version, so that data kept from before is out of date in every process"""
+        # The version is taken from the clock, so it is never reused even if lost from the cache
+        cache.set(self.key, time.time_ns(), timeout=None)
@@ -0,0 +1,65 @@
+"""A custom command to measure formula evaluation speed, uncached against compiled"""
+import logging
+import timeit
+
+# Code to implement a custom command
+from django.core.management.base import BaseCommand
+
+from simpleeval import simple_eval
+
+# And some models
+from loads.formula_engine import ALLOWED_FUNCTIONS
+from loads.formula_engine import compile_formula
+from loads.models import WorkPackage
+from loads.validators import FORMULA_DUMMY_CONTEXT
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# Used if no package is given, or the package has no formulas of its own
+DEFAULT_FORMULAS = [
+    'credits * contact_scaling',
+    'contact * admin_scaling + sqrt(students)',
+    'contact * assessment_scaling + students * log(credits) / 10',
+    'max(credits / 2, 5)',
+]
+
+
+class Command(BaseCommand):
+    help = 'Reports formula evaluations per second with and without the compiled formula cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--package',
+                            dest='package',
+                            type=int,
+                            default=None,
+                            help='Benchmark the formulas of the WorkPackage with this id')
+
+        parser.add_argument('--number',
+                            dest='number',
+                            type=int,
+                            default=20000,
+                            help='How many evaluations of each formula to time')
+
+    def handle(self, *args, **options):
+        number = options['number']
+
+        formulas = DEFAULT_FORMULAS
+        if options['package']:
+            package = WorkPackage.objects.get(pk=options['package'])
+            formulas = [formula for formula in [package.contact_formula, package.admin_formula,
+                                                package.assessment_formula, package.coordinator_formula]
+                        if formula] or DEFAULT_FORMULAS
+
+        for formula in formulas:
+            uncached = timeit.timeit(
+                lambda: simple_eval(formula, names=FORMULA_DUMMY_CONTEXT, functions=ALLOWED_FUNCTIONS),
+                number=number)
+            compiled = timeit.timeit(
+                lambda: compile_formula(formula)(FORMULA_DUMMY_CONTEXT),
+                number=number)
+
+            string = '{}: {:.0f} evaluations/s uncached, {:.0f} evaluations/s compiled ({:.1f}x)'.format(
+                formula, number / uncached, number / compiled, uncached / compiled)
+            logger.info(string)
+            self.stdout.write(string)
@@ -7,9 +7,11 @@ from django.core.mail import EmailMultiAlternatives
 from django.template.loader import get_template
 
 # And some models
+from loads.models import Module
 from loads.models import ModuleStaff
 from loads.models import AssessmentStaff
 from loads.models import AssessmentStateSignOff
+from loads.models import AssessmentWorkflow
 
 # We need to access a few settings
 from django.conf import settings
@@ -47,7 +49,8 @@ class Command(BaseCommand):
         # TODO needs some decent exception handling
 
         # Get all sign offs with no notification time
-        signoffs = AssessmentStateSignOff.objects.all().filter(notified=None).order_by("created")
+        signoffs = AssessmentStateSignOff.objects.all().filter(notified=None).order_by("created"). \
+            select_related('module__package')
 
         count = 0
         verbosity = options['verbosity']
@@ -60,6 +63,9 @@ class Command(BaseCommand):
         if verbosity and options['test-only']:
             self.stdout.write(self.style.WARNING('TEST MODE, No emails will actually be sent.'))
 
+        # The assessment histories of all the modules, built in one go
+        histories = Module.get_assessment_histories(set(signoff.module for signoff in signoffs))
+
         for signoff in signoffs:
             if signoff.module.package.in_the_past() and not include_past:
                 string1 = 'Skipping sign-off for package in the past:'
@@ -73,7 +79,7 @@ class Command(BaseCommand):
                 signoff.notified = datetime.datetime.now(datetime.timezone.utc)
                 signoff.save()
             else:
-                if self.email_updates_for_signoff(signoff, options):
+                if self.email_updates_for_signoff(signoff, options, histories[signoff.module_id]):
                     count += 1
 
         string = str(count) + ' update(s) sent'
@@ -89,8 +95,11 @@ class Command(BaseCommand):
 
         logger.info("Email Assessment Updates management command completed.")
 
-    def email_updates_for_signoff(self, signoff, options):
-        """Email relevant parties for a sign-off, and update notified field"""
+    def email_updates_for_signoff(self, signoff, options, assessment_history=None):
+        """Email relevant parties for a sign-off, and update notified field
+
+        assessment_history  the history of the module, if already known, see Module.get_assessment_history()
+        """
         verbosity = options['verbosity']
 
         # Get the current time
@@ -102,29 +111,32 @@ class Command(BaseCommand):
         # Now, make a list of user objects to write to
         email_targets = list()
 
-        for target in signoff.assessment_state.get_notify_list():
-            # Is it a Module Coordinator
-            if target == signoff.assessment_state.COORDINATOR:
-                if signoff.module.coordinator:
-                    email_targets.append(signoff.module.coordinator.user)
-            # Or a moderator
-            if target == signoff.assessment_state.MODERATOR:
-                for moderator in signoff.module.moderators.all():
-                    email_targets.append(moderator.user)
-            # Or a member of staff allocated to the module
-            if target == signoff.assessment_state.TEAM_MEMBER:
-                for module_staff in ModuleStaff.objects.all().filter(module=signoff.module):
-                    email_targets.append(module_staff.staff.user)
-            # Or an external examiner
-            if target == signoff.assessment_state.EXTERNAL:
-                # A Lead Programme must be defined
-                if signoff.module.lead_programme:
-                    for external in signoff.module.lead_programme.examiners.all():
-                        email_targets.append(external.user)
-            # Or a member of assessment staff
-            if target == signoff.assessment_state.ASSESSMENT_STAFF:
-                for assessment_staff in AssessmentStaff.objects.all().filter(package=signoff.module.package):
-                    email_targets.append(assessment_staff.staff.user)
+        # The roles to notify, from the saved workflow
+        state = AssessmentWorkflow.get().states.get(signoff.assessment_state_id)
+        notify = state.notify if state else 0
+
+        # Is it a Module Coordinator
+        if notify & AssessmentWorkflow.COORDINATOR:
+            if signoff.module.coordinator:
+                email_targets.append(signoff.module.coordinator.user)
+        # Or a moderator
+        if notify & AssessmentWorkflow.MODERATOR:
+            for moderator in signoff.module.moderators.all():
+                email_targets.append(moderator.user)
+        # Or a member of staff allocated to the module
+        if notify & AssessmentWorkflow.TEAM_MEMBER:
+            for module_staff in ModuleStaff.objects.all().filter(module=signoff.module):
+                email_targets.append(module_staff.staff.user)
+        # Or an external examiner
+        if notify & AssessmentWorkflow.EXTERNAL:
+            # A Lead Programme must be defined
+            if signoff.module.lead_programme:
+                for external in signoff.module.lead_programme.examiners.all():
+                    email_targets.append(external.user)
+        # Or a member of assessment staff
+        if notify & AssessmentWorkflow.ASSESSMENT_STAFF:
+            for assessment_staff in AssessmentStaff.objects.all().filter(package=signoff.module.package):
+                email_targets.append(assessment_staff.staff.user)
 
         # Create lists for email addresses to notify and those that are inactive
         email_addresses = list()
@@ -138,7 +150,8 @@ class Command(BaseCommand):
                 inactive_addresses.append("{} {} <{}>".format(target.first_name, target.last_name, target.email))
 
         # Get the whole assessment history
-        assessment_history = signoff.module.get_assessment_history()
+        if assessment_history is None:
+            assessment_history = signoff.module.get_assessment_history()
 
         # Trim off any sign-offs before the current one (in case more happened before this job)
         corrected_history = list()
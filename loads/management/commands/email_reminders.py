@@ -1,16 +1,34 @@
-"""A custom command to send reminder emails for open tasks to staff"""
+"""A custom command to send reminder emails for open tasks to staff
+
+This works as a pipeline of three stages, each timed:
+
+resolve     the tasks and completions of all staff are found in a few queries, staff are read with an iterator
+render      the messages are rendered, in a pool of worker processes if there are enough of them
+send        the messages are sent over one mail connection, in batches
+
+In incremental mode staff are only emailed if their outstanding tasks, or the urgency of them,
+have changed since they were last reminded, or if their last reminder is older than the interval.
+"""
+import datetime
 import logging
+import os
+import time
 
 # Code to implement a custom command
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 
-# We will be using mail functionality, and templates to create them
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import get_template
+# We will be using mail functionality, the templates are rendered by render_reminder()
+from django.core.mail import EmailMultiAlternatives, get_connection
 
 # And some models
 from loads.models import Staff
+from loads.models import Task
 from loads.models import TaskCompletion
+from loads.models import TaskCompletionMatrix
+from loads.models import TaskReminderState
+from loads.models import TaskTarget
+from loads.workers import get_pool, render_reminder
 
 # We need to access a few settings
 from django.conf import settings
@@ -18,6 +36,10 @@ from django.conf import settings
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
+# How many reminders each worker renders at a time
+RENDER_CHUNK_SIZE = 50
+
+
 class Command(BaseCommand):
     help = 'Emails staff if tasks are outstanding'
 
@@ -34,23 +56,51 @@ class Command(BaseCommand):
                             default=False,
                             help='Don\'t actually send emails')
 
+        parser.add_argument('--workers',
+                            dest='workers',
+                            type=int,
+                            default=None,
+                            help='How many worker processes render emails, by default one for each CPU')
+
+        parser.add_argument('--batch-size',
+                            dest='batch-size',
+                            type=int,
+                            default=100,
+                            help='How many emails to send at a time over the mail connection')
+
+        parser.add_argument('--incremental',
+                            action='store_true',
+                            dest='incremental',
+                            default=False,
+                            help='Only email staff whose outstanding tasks changed, or who have not been reminded lately')
+
+        parser.add_argument('--interval',
+                            dest='interval',
+                            type=float,
+                            default=7,
+                            help='In incremental mode, the days after which unchanged staff are reminded again')
+
     def handle(self, *args, **options):
         # TODO needs some decent exception handling
-        all_staff = Staff.objects.all()
-
-        count = 0
-        urgent_only = options['urgent-only']
         verbosity = options['verbosity']
-        logger.info("Email Assessment Updates management command invoked.", extra={'optione': options})
+        logger.info("Email Reminders management command invoked.", extra={'optione': options})
 
         if options['test-only']:
             logging.info("TEST MODE, No emails will actually be sent.")
             if verbosity:
                 self.stdout.write('TEST MODE, No emails will actually be sent.')
 
-        for staff in all_staff:
-            if self.email_tasks_by_staff(staff, options, urgent_only=urgent_only):
-                count += 1
+        start = time.perf_counter()
+        reminders = self.resolve_reminders(options)
+        self.report_stage('resolved', len(reminders), start, options)
+
+        start = time.perf_counter()
+        messages = self.render_reminders(reminders, options)
+        self.report_stage('rendered', len(messages), start, options)
+
+        start = time.perf_counter()
+        count = self.send_reminders(reminders, messages, options)
+        self.report_stage('sent', count, start, options)
 
         string = str(count) + ' reminder(s) sent'
         logger.info(string)
@@ -60,90 +110,185 @@ class Command(BaseCommand):
         if verbosity and options['test-only']:
             self.stdout.write('TEST MODE, No emails will actually be sent.')
 
-        logger.info("Email Assessment Updates management command completed.")
+        logger.info("Email Reminders management command completed.")
+
+    def report_stage(self, stage, count, start, options):
+        """Logs, and perhaps shows, the time taken and throughput of a stage"""
+        seconds = time.perf_counter() - start
+        rate = count / seconds if seconds > 0 else 0
+        string = '{} {} reminder(s) in {:.2f}s, {:.1f} per second'.format(stage, count, seconds, rate)
+        logger.info(string)
+        if options['verbosity'] > 1:
+            self.stdout.write(string)
+
+    def resolve_reminders(self, options):
+        """Finds the outstanding tasks of all staff in a few queries
 
-    def email_tasks_by_staff(self, staff, options, urgent_only='false'):
-        """docstring for email_tasks_by_staff"""
+        returns a list of dicts, for each member of staff to remind, of the context for the templates
+        """
         verbosity = options['verbosity']
+        urgent_only = options['urgent-only']
+
+        # All the unarchived tasks and their completions, with urgency found for all at once
+        matrix = TaskCompletionMatrix(Task.annotate_urgency(Task.objects.filter(archive=False)), [],
+                                      TaskCompletion.objects.filter(task__archive=False).only('task', 'staff', 'when'))
+        tasks = {task.pk: task for task in matrix.tasks}
+
+        # The tasks of each member of staff, in deadline order
+        staff_tasks = dict()
+        for staff_id, task_id in TaskTarget.objects.filter(task__archive=False). \
+                order_by('staff', 'task__deadline', 'task').values_list('staff', 'task').iterator():
+            staff_tasks.setdefault(staff_id, list()).append(tasks[task_id])
+
+        # What staff were last reminded of, only needed in incremental mode
+        if options['incremental']:
+            states = {state.staff_id: state for state in TaskReminderState.objects.all()}
+            interval_start = timezone.now() - datetime.timedelta(days=options['interval'])
+        else:
+            states = dict()
+            interval_start = None
+        forgotten = list()
+
+        reminders = list()
+        for staff in Staff.objects.all().select_related('user').order_by('pk').iterator():
+            # If the member of staff is inactive (perhaps retired, skip them)
+            if not staff.is_active():
+                if verbosity > 2:
+                    self.stdout.write('  considering: {}'.format(str(staff)))
+                    self.stdout.write('    user marked inactive, skipping...')
+                continue
+
+            # We will create separate lists for those tasks that are complete
+            combined_list_complete = []
+            combined_list_incomplete = []
+
+            urgent_tasks = False
+            for task in staff_tasks.get(staff.pk, list()):
+                # Is it complete? Look for a completion model
+                completion = matrix.get_completion(task, staff)
+                if completion is None:
+                    # It isn't complete, find out if urgent or overdue
+                    urgent = matrix.is_urgent(task)
+                    if urgent:
+                        urgent_tasks = True
+                    combined_list_incomplete.append([task, urgent, matrix.is_overdue(task)])
+                else:
+                    # It is complete, add information as to when
+                    combined_list_complete.append([task, completion.when])
 
-        # If the member of staff is inactive (perhaps retired, skip them)
-        if not staff.is_active():
             if verbosity > 2:
                 self.stdout.write('  considering: {}'.format(str(staff)))
-                self.stdout.write('    user marked inactive, skipping...')
-            return False
-
-        # Get all the tasks for this member of staff who must be active now
-        all_tasks = staff.get_all_tasks()
-
-        # We will create separate lists for those tasks that are complete
-        combined_list_complete = []
-        combined_list_incomplete = []
-
-        urgent_tasks = False
-        for task in all_tasks:
-            # Is it complete? Look for a completion model
-            completion = TaskCompletion.objects.all().filter(staff=staff).filter(task=task)
-            if len(completion) == 0:
-                # It isn't complete, find out if urgent or overdue
-                urgent = task.is_urgent()
-                overdue = task.is_overdue()
-
-                if urgent:
-                    urgent_tasks = True
-
-                # It isn't complete...
-                combined_item = [task, urgent, overdue]
-                combined_list_incomplete.append(combined_item)
-                # How long do we have left
-
-            else:
-                # It is complete, add information as to when
-                combined_item = [task, completion[0].when]
-                combined_list_complete.append(combined_item)
-
-        if verbosity > 2:
-            self.stdout.write('  considering: {}'.format(str(staff)))
-            self.stdout.write('    complete {}, incomplete {}, urgent tasks {}'.format(
-                len(combined_list_complete), len(combined_list_incomplete), urgent_tasks
-            ))
-
-        # Don't nag staff with no tasks
-        if len(combined_list_incomplete) == 0:
-            return False
-
-        # Or if urgent_only is set and no tasks are urgent
-        if not urgent_tasks and urgent_only:
-            return False
-
-        plaintext = get_template('loads/emails/task_reminders.txt')
-        html = get_template('loads/emails/task_reminders.html')
-
-        context_dict = {
-            'staff': staff,
-            'combined_list_incomplete': combined_list_incomplete,
-            'combined_list_complete': combined_list_complete,
-            'urgent_tasks': urgent_tasks,
-            'urgent_only': urgent_only,
-            'base_url': settings.WAM_URL,
-        }
-
-        if urgent_tasks:
-            email_subject = 'URGENT: Your task reminders'
+                self.stdout.write('    complete {}, incomplete {}, urgent tasks {}'.format(
+                    len(combined_list_complete), len(combined_list_incomplete), urgent_tasks
+                ))
+
+            # Don't nag staff with no tasks, and remind them afresh when they have some again
+            if len(combined_list_incomplete) == 0:
+                if staff.pk in states:
+                    forgotten.append(staff.pk)
+                continue
+
+            # Or if urgent_only is set and no tasks are urgent
+            if not urgent_tasks and urgent_only:
+                continue
+
+            # Or, in incremental mode, if nothing has changed since a recent reminder
+            digest = TaskReminderState.get_digest(combined_list_incomplete)
+            state = states.get(staff.pk)
+            if state and state.digest == digest and state.sent >= interval_start:
+                if verbosity > 2:
+                    self.stdout.write('    unchanged since last reminder, skipping...')
+                continue
+
+            reminders.append({
+                'staff': staff,
+                'combined_list_incomplete': combined_list_incomplete,
+                'combined_list_complete': combined_list_complete,
+                'urgent_tasks': urgent_tasks,
+                'urgent_only': urgent_only,
+                'digest': digest,
+            })
+
+        if forgotten and not options['test-only']:
+            TaskReminderState.objects.filter(staff__in=forgotten).delete()
+        return reminders
+
+    def render_reminders(self, reminders, options):
+        """Renders the emails for reminders, in worker processes if there are enough of them
+
+        returns a list of tuples of the email subject, the plain text and the html, in the same order
+        """
+        workers = options['workers'] or os.cpu_count() or 1
+        if workers > 1 and len(reminders) > RENDER_CHUNK_SIZE:
+            with get_pool(workers) as executor:
+                return list(executor.map(render_reminder, reminders, chunksize=RENDER_CHUNK_SIZE))
+        return [render_reminder(reminder) for reminder in reminders]
+
+    def send_reminders(self, reminders, messages, options):
+        """Sends the rendered emails over one mail connection, in batches
+
+        returns the number of reminders sent, or that would have been in test mode
+        """
+        batch_size = max(1, options['batch-size'])
+        from_email = settings.WAM_AUTO_EMAIL_FROM
+
+        connection = None if options['test-only'] else get_connection()
+        count = 0
+        batch = list()
+        # The reminders for the current batch, reported and recorded once it is sent
+        batch_reminders = list()
+        try:
+            if connection:
+                # Opened here, the connection stays open between batches until closed below
+                connection.open()
+            for reminder, (email_subject, text_content, html_content) in zip(reminders, messages):
+                staff = reminder['staff']
+                if not staff.user.email:
+                    logger.warning('No email address for {}, reminder not sent'.format(str(staff)))
+                    continue
+                email = EmailMultiAlternatives(email_subject, text_content, from_email, [staff.user.email],
+                                               connection=connection)
+                email.attach_alternative(html_content, "text/html")
+                batch.append(email)
+                batch_reminders.append(reminder)
+
+                if len(batch) >= batch_size:
+                    count += self.send_batch(connection, batch, batch_reminders, options)
+                    batch = list()
+                    batch_reminders = list()
+            if batch:
+                count += self.send_batch(connection, batch, batch_reminders, options)
+        finally:
+            if connection:
+                connection.close()
+        return count
+
+    def send_batch(self, connection, batch, reminders, options):
+        """Sends a batch of emails, and then reports and records the reminders as sent
+
+        connection  the open mail connection, or None in test mode, when nothing is sent or recorded
+        batch       a list of EmailMultiAlternatives objects
+        reminders   a list of the reminders for the emails, in the same order
+
+        returns the number of emails sent, or that would have been in test mode
+        """
+        if connection:
+            sent = connection.send_messages(batch) or 0
         else:
-            email_subject = 'Your task reminders'
-
-        from_email, to = settings.WAM_AUTO_EMAIL_FROM, staff.user.email
-        text_content = plaintext.render(context_dict)
-        html_content = html.render(context_dict)
-
-        string = 'Email sent to {} <{}>'.format(str(staff), staff.user.email)
-        logger.info(string)
-        if verbosity:
-            self.stdout.write(string)
-
-        email = EmailMultiAlternatives(email_subject, text_content, from_email, [to])
-        email.attach_alternative(html_content, "text/html")
-        if not options['test-only']:
-            email.send()
-        return True
+            sent = len(batch)
+        if sent < len(batch):
+            # There's no telling which were sent, so none are recorded, and all are sent again next time
+            logger.error('Only {} of a batch of {} reminder emails were sent'.format(sent, len(batch)))
+            return sent
+
+        for reminder in reminders:
+            staff = reminder['staff']
+            string = 'Email sent to {} <{}>'.format(str(staff), staff.user.email)
+            logger.info(string)
+            if options['verbosity']:
+                self.stdout.write(string)
+
+        if connection:
+            TaskReminderState.record({reminder['staff'].pk: reminder['digest'] for reminder in reminders},
+                                     timezone.now())
+        return sent
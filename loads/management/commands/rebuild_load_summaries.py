@@ -0,0 +1,104 @@
+"""A custom command to check and repair the StaffLoadSummary table against live calculations"""
+import logging
+
+# Code to implement a custom command
+from django.core.management.base import BaseCommand
+
+# And some models
+from loads.models import PackageLoadEngine
+from loads.models import Staff
+from loads.models import StaffLoadSummary
+from loads.models import WorkPackage
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Checks staff load summaries against a live calculation and repairs any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--package',
+                            dest='package',
+                            type=int,
+                            default=None,
+                            help='Only check the WorkPackage with this id')
+
+        parser.add_argument('--check-only',
+                            action='store_true',
+                            dest='check-only',
+                            default=False,
+                            help='Report drift, but don\'t repair it')
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+        check_only = options['check-only']
+        logger.info("Rebuild load summaries management command invoked.", extra={'options': options})
+
+        packages = WorkPackage.objects.all()
+        if options['package']:
+            packages = packages.filter(pk=options['package'])
+
+        total_created = 0
+        total_repaired = 0
+        # Packages with summaries created or repaired, whose cached pages were rendered from the old ones
+        changed_packages = list()
+        for package in packages:
+            (created, repaired) = self.rebuild_package(package, options)
+            total_created += created
+            total_repaired += repaired
+            if created or repaired:
+                changed_packages.append(package)
+
+        if not check_only:
+            WorkPackage.bump_generation(changed_packages)
+
+        if check_only:
+            string = '{} summaries missing, {} summaries drifted'.format(total_created, total_repaired)
+        else:
+            string = '{} summaries created, {} summaries repaired'.format(total_created, total_repaired)
+        logger.info(string)
+        if verbosity:
+            self.stdout.write(string)
+
+        logger.info("Rebuild load summaries management command completed.")
+
+    def rebuild_package(self, package, options):
+        """Check and repair all summaries for a package, returns a tuple of numbers created and repaired"""
+        verbosity = options['verbosity']
+        check_only = options['check-only']
+
+        engine = PackageLoadEngine(package)
+        summaries = {summary.staff_id: summary for summary in
+                     StaffLoadSummary.objects.filter(package=package).select_related('staff__user')}
+
+        # Everyone in the package groups, and anyone else with an allocation or an existing summary
+        staff_ids = set(package.get_all_staff().values_list('pk', flat=True))
+        staff_ids |= engine.get_staff_ids()
+        staff_ids |= set(summaries.keys())
+
+        created = 0
+        repaired = 0
+        for staff in Staff.objects.filter(pk__in=staff_ids).select_related('user'):
+            summary = summaries.get(staff.pk)
+            if summary is None:
+                created += 1
+                if verbosity > 1:
+                    self.stdout.write('  {}: missing summary for {}'.format(package, staff))
+                summary = StaffLoadSummary(staff=staff, package=package)
+            elif summary.differs_from(engine):
+                repaired += 1
+                logger.warning("load summary drift for %s in package %s" % (staff, package))
+                if verbosity:
+                    self.stdout.write(self.style.WARNING('  {}: summary drifted for {}'.format(package, staff)))
+            else:
+                continue
+
+            if not check_only:
+                summary.calculate(engine)
+                summary.save()
+
+        if verbosity > 1:
+            self.stdout.write('{}: {} staff checked'.format(package, len(staff_ids)))
+
+        return created, repaired
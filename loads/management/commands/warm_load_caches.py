@@ -0,0 +1,80 @@
+"""A custom command to render and cache the load pages of all active packages ahead of time
+
+Any load summaries missing for the packages are created first, as after upgrading to a version with them.
+"""
+import logging
+import os
+import time
+
+# Code to implement a custom command
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+# And some models
+from loads.models import WorkPackage
+
+# Workers import their entry points from a module which is safe to import before Django is set up
+from loads.workers import get_pool
+from loads.workers import warm_package
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Renders and caches the load pages of all active packages so nobody waits on a cold cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--package',
+                            dest='package',
+                            type=int,
+                            default=None,
+                            help='Only warm the WorkPackage with this id')
+
+        parser.add_argument('--workers',
+                            dest='workers',
+                            type=int,
+                            default=None,
+                            help='How many worker processes to use, by default one for each package up to the number of CPUs')
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+        logger.info("Warm load caches management command invoked.", extra={'options': options})
+
+        packages = WorkPackage.objects.all().filter(archive=False, hidden=False)
+        if options['package']:
+            packages = packages.filter(pk=options['package'])
+        package_ids = list(packages.values_list('pk', flat=True))
+
+        workers = options['workers'] or min(len(package_ids), os.cpu_count() or 1)
+        if isinstance(caches['default'], LocMemCache):
+            # Anything cached in another process would be lost, and even this process won't be the web server
+            logger.warning("the default cache is local to each process, so warming it has no lasting effect")
+            if verbosity:
+                self.stdout.write(self.style.WARNING(
+                    'The default cache is local to each process, configure a shared cache for warming to help'))
+            workers = 1
+
+        start = time.perf_counter()
+        if workers > 1 and len(package_ids) > 1:
+            with get_pool(workers) as executor:
+                results = list(executor.map(warm_package, package_ids))
+        else:
+            results = [warm_package(package_id) for package_id in package_ids]
+
+        for package_id, name, created, timings in results:
+            string = '{}: '.format(name) + ', '.join(
+                '{} {:.2f}s'.format(fragment, seconds) for fragment, seconds in timings)
+            if created:
+                string += ', {} load summaries created'.format(created)
+            logger.info(string, extra={'package_id': package_id})
+            if verbosity:
+                self.stdout.write(string)
+
+        string = '{} packages warmed in {:.2f}s'.format(len(results), time.perf_counter() - start)
+        logger.info(string)
+        if verbosity:
+            self.stdout.write(string)
+
+        logger.info("Warm load caches management command completed.")
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loads', '0057_alter_module_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StaffLoadSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_hours', models.FloatField(default=0)),
+                ('semester1_hours', models.FloatField(default=0)),
+                ('semester2_hours', models.FloatField(default=0)),
+                ('semester3_hours', models.FloatField(default=0)),
+                ('activity_count', models.PositiveIntegerField(default=0)),
+                ('category_hours', models.JSONField(default=dict)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('package', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='loads.workpackage')),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='loads.staff')),
+            ],
+            options={
+                'verbose_name_plural': 'staff load summaries',
+                'unique_together': {('staff', 'package')},
+            },
+        ),
+    ]
@@ -0,0 +1,58 @@
+"""
+Migration: add semester_mask to Activity, ActivityGenerator and Module,
+populated from the existing comma separated semester strings.
+
+Semester 1 is bit 0, semester 2 bit 1 and semester 3 bit 2. This mirrors
+loads.helpers.semester_mask(), copied here so later changes to the helper
+can't alter the migration.
+"""
+
+from django.db import migrations, models
+
+
+def mask_from_text(text):
+    mask = 0
+    for semester in text.split(','):
+        semester = semester.strip()
+        if semester in ('1', '2', '3'):
+            mask |= 1 << (int(semester) - 1)
+    return mask
+
+
+def populate_semester_masks(apps, schema_editor):
+    for model_name in ['Activity', 'ActivityGenerator', 'Module']:
+        model = apps.get_model('loads', model_name)
+        objects_to_update = []
+        for instance in model.objects.all().only('pk', 'semester'):
+            instance.semester_mask = mask_from_text(instance.semester)
+            objects_to_update.append(instance)
+        model.objects.bulk_update(objects_to_update, ['semester_mask'], batch_size=200)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loads', '0058_staffloadsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='semester_mask',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='activitygenerator',
+            name='semester_mask',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='module',
+            name='semester_mask',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(
+            populate_semester_masks,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
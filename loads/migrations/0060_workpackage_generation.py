@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loads', '0059_semester_mask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workpackage',
+            name='generation',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='workpackage',
+            name='generation_modified',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
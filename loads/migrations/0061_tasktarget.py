@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_task_targets(apps, schema_editor):
+    """Resolve the targets of all existing tasks, directly or through groups"""
+    Staff = apps.get_model('loads', 'Staff')
+    Task = apps.get_model('loads', 'Task')
+    TaskTarget = apps.get_model('loads', 'TaskTarget')
+    for task in Task.objects.all():
+        staff_ids = set(Staff.objects.filter(
+            models.Q(pk__in=task.targets.values('pk')) |
+            models.Q(user__groups__in=task.groups.values('pk'))).values_list('pk', flat=True))
+        TaskTarget.objects.bulk_create([TaskTarget(task=task, staff_id=staff_id) for staff_id in staff_ids])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loads', '0060_workpackage_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskTarget',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='loads.staff')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='loads.task')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['staff', 'task'], name='loads_taskt_staff_i_b81071_idx')],
+                'unique_together': {('task', 'staff')},
+            },
+        ),
+        migrations.RunPython(
+            populate_task_targets,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
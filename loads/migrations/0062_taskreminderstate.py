@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loads', '0061_tasktarget'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskReminderState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=40)),
+                ('sent', models.DateTimeField()),
+                ('staff', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='loads.staff')),
+            ],
+        ),
+    ]
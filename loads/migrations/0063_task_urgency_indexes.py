@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loads', '0062_taskreminderstate'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['archive', 'deadline'], name='loads_task_archive_2440aa_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='taskcompletion',
+            index=models.Index(fields=['task', 'staff'], name='loads_taskc_task_id_ad7f7e_idx'),
+        ),
+    ]
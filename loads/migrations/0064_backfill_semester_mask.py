@@ -0,0 +1,45 @@
+"""
+Migration: correct semester_mask for Activity, ActivityGenerator and Module rows
+written since 0059 without going through save(), such as by loaddata,
+QuerySet.update() or bulk_create(), which left the default of 0.
+
+The mask is now kept in step by a pre_save signal. mask_from_text() is
+copied from 0059, so later changes to the helper can't alter the migration.
+"""
+
+from django.db import migrations
+
+
+def mask_from_text(text):
+    mask = 0
+    for semester in text.split(','):
+        semester = semester.strip()
+        if semester in ('1', '2', '3'):
+            mask |= 1 << (int(semester) - 1)
+    return mask
+
+
+def backfill_semester_masks(apps, schema_editor):
+    for model_name in ['Activity', 'ActivityGenerator', 'Module']:
+        model = apps.get_model('loads', model_name)
+        objects_to_update = []
+        for instance in model.objects.all().only('pk', 'semester', 'semester_mask'):
+            mask = mask_from_text(instance.semester)
+            if instance.semester_mask != mask:
+                instance.semester_mask = mask
+                objects_to_update.append(instance)
+        model.objects.bulk_update(objects_to_update, ['semester_mask'], batch_size=200)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loads', '0063_task_urgency_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            backfill_semester_masks,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
@@ -2,12 +2,22 @@
 
 # General Python imports
 
+import collections
+import copy
+import itertools
 import datetime
+import hashlib
+import math
 import logging
+import threading
+import time
 
 # Django imports
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db import transaction
 from django.contrib.auth.models import User, Group
 
 from django.core.validators import validate_comma_separated_integer_list
@@ -19,12 +29,20 @@ from WAM.settings import (WAM_DEFAULT_ACTIVITY_TYPE, WAM_AUTO_CREATE_CAMPUS,
                           WAM_AUTO_CREATE_FACULTY, WAM_AUTO_CREATE_SCHOOL, WAM_AUTO_CREATE_SCHOOL_GROUPS)
 
 from .validators import validate_formula
-from .helpers import divide_by_semesters
+from .helpers import divide_by_semester_mask, semester_mask
+from .helpers import CacheVersion
 from .formula_engine import calculate_admin_hours, calculate_assessment_hours, calculate_contact_hours, calculate_all_hours, calculate_coordinator_hours
+from .formula_engine import calculate_all_hours_batch, package_hours_expressions
 
 # Create a logger
 logger = logging.getLogger(__name__)
 
+# The modules each examiner can access are cached under this version, see Staff.get_examined_module_ids()
+EXAMINER_ACCESS_VERSION = CacheVersion('wam:examiner_access:version')
+
+# How long, in seconds, examiner access is cached if nothing changes
+EXAMINER_ACCESS_TIMEOUT = getattr(settings, 'WAM_EXAMINER_ACCESS_CACHE_TIMEOUT', 24 * 60 * 60)
+
 class WorkPackage(models.Model):
     """Groups workload by user groups and time
 
@@ -59,6 +77,9 @@ class WorkPackage(models.Model):
                 a formula for calculating unspecified admin hours
     assessment_formula
                 a formula for calculating unspecified assessment hours
+    generation  increased whenever anything affecting loads in the package changes
+    generation_modified
+                when the generation was last increased
     """
 
     name = models.CharField(max_length=100)
@@ -109,9 +130,36 @@ class WorkPackage(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
 
+    # Only ever changed by bump_generation()
+    generation = models.PositiveBigIntegerField(default=0, editable=False)
+    generation_modified = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Fields never written by save(), so a stale copy of a package can't wind the generation back
+    GENERATION_FIELDS = ('generation', 'generation_modified')
+
     def __str__(self):
         return self.name + ' (' + str(self.startdate) + ' - ' + str(self.enddate) + ')'
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.GENERATION_FIELDS]
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def bump_generation(packages):
+        """Increase the generation of some packages, marking anything cached for them as out of date
+
+        packages    an iterable of WorkPackage objects or primary keys, None entries are ignored
+
+        This is done in the database, so concurrent bumps are never lost.
+        """
+        package_ids = {getattr(package, 'pk', package) for package in packages} - {None}
+        if package_ids:
+            WorkPackage.objects.filter(pk__in=package_ids).update(
+                generation=models.F('generation') + 1,
+                generation_modified=datetime.datetime.now(datetime.timezone.utc))
+
     def clean(self):
         if self.coordinator_formula and not self.coordinator_activity_type:
             raise ValidationError({
@@ -366,25 +414,27 @@ class WorkPackage(models.Model):
             logger.warning("destination package not empty")
             return messages
 
-        if options['copy_programmes']:
-            programme_mapping = self.__clone_programmes(source_package, options, messages)
-        else:
-            programme_mapping = None
+        # In one transaction, so load summaries are refreshed once on commit rather than for every copy
+        with transaction.atomic():
+            if options['copy_programmes']:
+                programme_mapping = self.__clone_programmes(source_package, options, messages)
+            else:
+                programme_mapping = None
 
-        # We need to make to work out what activity sets are in play, make copies and recall a mapping        
-        if options['copy_activities_generated']:
-            mapping_activity_set = self.__clone_activity_sets(source_package, options, messages)
-            self.__clone_generated_activities(source_package, options, messages, mapping_activity_set)
-        else:
-            mapping_activity_set = None
+            # We need to make to work out what activity sets are in play, make copies and recall a mapping        
+            if options['copy_activities_generated']:
+                mapping_activity_set = self.__clone_activity_sets(source_package, options, messages)
+                self.__clone_generated_activities(source_package, options, messages, mapping_activity_set)
+            else:
+                mapping_activity_set = None
 
-        # Copy Activities that are not associated with a Module or an ActivitySet
-        if options['copy_activities_custom']:
-            self.__clone_custom_activities(source_package, options, messages)
+            # Copy Activities that are not associated with a Module or an ActivitySet
+            if options['copy_activities_custom']:
+                self.__clone_custom_activities(source_package, options, messages)
 
-        # Copy Modules
-        if options['copy_modules']:
-            self.__clone_module_data(source_package, options, messages, mapping_activity_set, programme_mapping)
+            # Copy Modules
+            if options['copy_modules']:
+                self.__clone_module_data(source_package, options, messages, mapping_activity_set, programme_mapping)
 
         return messages
 
@@ -397,6 +447,60 @@ class WorkPackage(models.Model):
         staff = Staff.objects.all().filter(user__in=users_by_groups).distinct().order_by('user__last_name')
         return staff
 
+    def get_group_staff(self):
+        """Returns a list of (group, staff_list) for each group in the package
+
+        Staff are ordered by last name within each group. A member of staff
+        in several groups will appear in each of them. This takes a fixed
+        number of queries regardless of the number of groups.
+        """
+        groups = list(self.groups.all())
+
+        # Map each group to the users within it, with one query on the membership table
+        members = dict()
+        memberships = User.groups.through.objects.filter(group__in=groups).values_list('group_id', 'user_id')
+        for group_id, user_id in memberships:
+            members.setdefault(group_id, set()).add(user_id)
+
+        all_staff = list(Staff.objects.filter(user__in=User.objects.filter(groups__in=groups)).
+                         select_related('user').order_by('user__last_name'))
+
+        group_staff = list()
+        for group in groups:
+            group_members = members.get(group.pk, set())
+            group_staff.append((group, [staff for staff in all_staff if staff.user_id in group_members]))
+
+        return group_staff
+
+    def get_module_hours_totals(self, modules=None):
+        """Returns a dict of the total contact, admin and assessment hours for modules in the package
+
+        These are summed in the database where the package formulas are simple arithmetic,
+        otherwise, or if a formula divides by zero for some module, each module is calculated in Python.
+
+        modules     a queryset of modules in this package to total, by default all of them
+        """
+        if modules is None:
+            modules = Module.objects.filter(package=self)
+        annotated = Module.annotate_hours(modules, self)
+        if annotated is not None:
+            unresolved = (models.Q(calculated_contact_hours__isnull=True) |
+                          models.Q(calculated_admin_hours__isnull=True) |
+                          models.Q(calculated_assessment_hours__isnull=True))
+            totals = annotated.aggregate(contact=models.Sum('calculated_contact_hours'),
+                                         admin=models.Sum('calculated_admin_hours'),
+                                         assessment=models.Sum('calculated_assessment_hours'),
+                                         unresolved=models.Count('pk', filter=unresolved))
+            if not totals.pop('unresolved'):
+                return {key: value or 0 for key, value in totals.items()}
+
+        totals = {'contact': 0, 'admin': 0, 'assessment': 0}
+        for hours in Module.get_hours_batch(modules.select_related('package', 'size')).values():
+            totals['contact'] += hours.contact
+            totals['admin'] += hours.admin
+            totals['assessment'] += hours.assessment
+        return totals
+
     def in_the_past(self):
         """Returns whether the workpackage ended before the current date"""
         now = datetime.datetime.today().date()
@@ -791,25 +895,11 @@ class Staff(models.Model):
         return self.user.is_active
 
     def get_all_tasks(self, archived=False):
-        """Returns a queryset of all unarchived tasks linked to this staff member"""
-        if not archived:
-            user_tasks = Task.objects.all().filter(targets=self).exclude(archive=True).distinct().order_by('deadline')
-        else:
-            user_tasks = Task.objects.all().filter(targets=self).filter(archive=True).distinct().order_by('deadline')
-
-        # And those assigned against the group
-        groups = Group.objects.all().filter(user=self.user)
-        if not archived:
-            group_tasks = Task.objects.all().filter(groups__in=groups). \
-                exclude(archive=True).distinct().order_by('deadline')
-        else:
-            group_tasks = Task.objects.all().filter(groups__in=groups). \
-                filter(archive=True).distinct().order_by('deadline')
-
-        # Combine them
-        all_tasks = user_tasks | group_tasks
+        """Returns a queryset of all unarchived (or archived) tasks linked to this staff member
 
-        return all_tasks
+        Whether assigned directly or against a group, these are read from TaskTarget.
+        """
+        return Task.objects.all().filter(tasktarget__staff=self, archive=archived).order_by('deadline')
 
     def get_all_packages(self, include_hidden=False):
         """'Get all the packages that are relevant for a staff member"""
@@ -852,23 +942,45 @@ class Staff(models.Model):
         examined_programmes = Programme.objects.all().filter(examiners=self).distinct()
         return examined_programmes
 
-    def can_examine_module(self, module):
-        """Checks if the examiner should have general access to a module"""
+    def get_examined_module_ids(self):
+        """Returns a frozenset of the primary keys of all modules this examiner can access
 
-        examined_programmes = self.get_examined_programmes()
+        An examiner can access a module if they examine its lead programme or any of its
+        programmes. This is found in one query and kept on this Staff object, and in the shared
+        cache until examiners, programmes or lead programmes change, see invalidate_examined_modules().
+        Without a shared cache it is found again for each Staff object.
+        """
+        if 'examined_module_ids' in self.__dict__:
+            return self.__dict__['examined_module_ids']
+
+        version = EXAMINER_ACCESS_VERSION.get()
+        key = 'wam:examiner_access:{}:{}'.format(version, self.pk)
+        module_ids = cache.get(key) if version is not None else None
+        if module_ids is None:
+            module_ids = frozenset(Module.objects.filter(
+                models.Q(lead_programme__examiners=self) | models.Q(programmes__examiners=self)).
+                values_list('pk', flat=True).distinct())
+            if version is not None:
+                cache.set(key, module_ids, timeout=EXAMINER_ACCESS_TIMEOUT)
+        self.__dict__['examined_module_ids'] = module_ids
+        return module_ids
 
-        # External Examiners can download if they examine the lead programme
-        if module.lead_programme:
-            if module.lead_programme in examined_programmes:
-                return True
+    @staticmethod
+    def invalidate_examined_modules():
+        """Marks the cached modules of all examiners as out of date
 
-        # Or if they are an examiner (for information) for another listed programme
-        if module.programmes:
-            if any(programme in examined_programmes for programme in module.programmes.all()):
-                return True
+        Examiners and programmes change rarely, so it is simplest to start again for everyone.
+        Call this once changes are committed, or another process could cache the old access again.
+        """
+        EXAMINER_ACCESS_VERSION.invalidate()
 
-        # Otherwise, there is no access
-        return False
+    def can_examine_module(self, module):
+        """Checks if the examiner should have general access to a module
+
+        External Examiners have access if they examine the lead programme, or they are an examiner
+        (for information) for another listed programme.
+        """
+        return module.pk in self.get_examined_module_ids()
 
     class Meta:
         verbose_name_plural = 'staff'
@@ -933,12 +1045,16 @@ class Activity(models.Model):
     percentage       used to calculate the hours if hours_percentage is set to PERCENTAGE
     hours_percentage one of HOURS or PERCENTAGE as above
     semester         the semester or semesters the activity is in, comma separated
+    semester_mask    the semesters as a bitmask, see helpers.semester_mask()
     activity_type    see the related Model
     module           an optional module with which the activity is associated
     comment          any short comment or note
     staff            if not NULL, the staff member allocated this activity
     package          the WorkPackage this activity belongs to
     activity_set     the associated activity_set if this activity is auto generated
+
+    semester_mask is set from semester by a pre_save signal, which doesn't run for QuerySet.update()
+    or bulk_create(), so anything changing semester that way must set semester_mask too.
     """
 
     HOURS = 'H'
@@ -952,6 +1068,8 @@ class Activity(models.Model):
     percentage = models.PositiveSmallIntegerField()
     hours_percentage = models.CharField(max_length=1, choices=HOURPERCENTAGE_CHOICES, default=HOURS)
     semester = models.CharField(max_length=10, default='1,2,3', validators=[validate_comma_separated_integer_list])
+    # Kept in step with semester by a pre_save signal, see helpers.semester_mask()
+    semester_mask = models.PositiveSmallIntegerField(default=0, editable=False)
     activity_type = models.ForeignKey('ActivityType', on_delete=models.CASCADE, help_text="The activity type is used to help categorise this workload.")
     module = models.ForeignKey('Module', blank=True, null=True, on_delete=models.CASCADE, help_text="Optionally, if this activity is associated with a module, enter it here.")
     comment = models.CharField(max_length=200, default='', blank=True, help_text="Optionally, add any comment associated with this activity here.")
@@ -986,7 +1104,7 @@ class Activity(models.Model):
         # First calculate the hours over all semesters
         total_hours = self.total_hours()
 
-        return divide_by_semesters(total_hours, self.semester)
+        return divide_by_semester_mask(total_hours, self.semester_mask)
 
     class Meta:
         verbose_name_plural = "activities"
@@ -1002,6 +1120,7 @@ class ActivityGenerator(models.Model):
     percentage       used to calculate the hours if hours_percentage is set to PERCENTAGE
     hours_percentage one of HOURS or PERCENTAGE as above
     semester         the semester or semesters the activity is in, comma separated
+    semester_mask    the semesters as a bitmask, kept in step as for Activity
     activity_type    see the related Model
     comment          any short comment or note
     package          the WorkPackage this activity belongs to
@@ -1024,6 +1143,8 @@ class ActivityGenerator(models.Model):
     percentage = models.PositiveSmallIntegerField()
     hours_percentage = models.CharField(max_length=1, choices=HOURPERCENTAGE_CHOICES, default=HOURS)
     semester = models.CharField(max_length=10, validators=[validate_comma_separated_integer_list])
+    # Kept in step with semester by a pre_save signal, see helpers.semester_mask()
+    semester_mask = models.PositiveSmallIntegerField(default=0, editable=False)
     activity_type = models.ForeignKey('ActivityType', on_delete=models.CASCADE)
     module = models.ForeignKey('Module', blank=True, null=True, on_delete=models.CASCADE)
     comment = models.CharField(max_length=200, default='', blank=True, help_text='The comment added to generated activities')
@@ -1035,25 +1156,11 @@ class ActivityGenerator(models.Model):
     groups = models.ManyToManyField(Group, blank=True)
 
     def get_all_targets(self):
-        """obtains all targets for a generator whether by user or group, returns a list of valid targets"""
-        # These are staff objects
-        target_by_users = self.targets.all().order_by('user__last_name')
-        target_groups = self.groups.all()
-        # These are user objects
-        target_by_groups = User.objects.all().filter(groups__in=target_groups).distinct().order_by('last_name')
-
-        # Start to build a queryset, starting with targetted users
-        all_targets = target_by_users
-
-        # Add each collection of staff members implicated by group
-        for user in target_by_groups:
-            staff = Staff.objects.all().filter(user=user)
-            all_targets = all_targets | staff
-
-        # Use distinct to clean up any duplicates
-        all_targets = all_targets.distinct()
-
-        return all_targets
+        """obtains all targets for a generator whether by user or group, returns a queryset of valid targets"""
+        # Targeted directly, or through the groups of their users, in one query
+        return Staff.objects.all().filter(
+            models.Q(pk__in=self.targets.values('pk')) |
+            models.Q(user__in=User.objects.filter(groups__in=self.groups.values('pk')))).order_by('user__last_name')
 
     def generate_activities(self):
         """Generate all Activities for this"""
@@ -1126,12 +1233,13 @@ class ModuleStaff(models.Model):
         coordinator.
         """
         module = self.module
+        hours = module.get_hours()
         breakdown = []
 
         for label, by_semester, proportion in [
-            ('Contact Hours', module.get_contact_hours_by_semester(), self.contact_proportion),
-            ('Admin Hours', module.get_admin_hours_by_semester(), self.admin_proportion),
-            ('Assessment Hours', module.get_assessment_hours_by_semester(), self.assessment_proportion),
+            ('Contact Hours', hours.contact_by_semester, self.contact_proportion),
+            ('Admin Hours', hours.admin_by_semester, self.admin_proportion),
+            ('Assessment Hours', hours.assessment_by_semester, self.assessment_proportion),
         ]:
             p = proportion / 100
             breakdown.append((
@@ -1144,7 +1252,7 @@ class ModuleStaff(models.Model):
 
         # Coordinator hours belong entirely to the coordinator — no proportion
         if module.coordinator == self.staff:
-            coord = module.get_coordinator_hours_by_semester()
+            coord = hours.coordinator_by_semester
             breakdown.append((
                 f"{module} Coordination",
                 coord[0], coord[1], coord[2], coord[3],
@@ -1206,12 +1314,69 @@ class Programme(models.Model):
         ordering = ['programme_name']
 
 
+class ModuleHours(object):
+    """The hours for a module, calculated once in dependency order
+
+    contact         contact hours
+    admin           admin hours, which may depend on contact hours
+    assessment      assessment hours, which may depend on contact and admin hours
+    coordinator     hours for module coordination, 0 if there is no coordinator
+    all             the total of all the above
+
+    Each has a corresponding *_by_semester list, as returned by divide_by_semester_mask()
+    """
+
+    def __init__(self, contact, admin, assessment, coordinator, mask):
+        self.contact = contact
+        self.admin = admin
+        self.assessment = assessment
+        self.coordinator = coordinator
+        self.all = contact + admin + assessment + coordinator
+
+        self.contact_by_semester = divide_by_semester_mask(contact, mask)
+        self.admin_by_semester = divide_by_semester_mask(admin, mask)
+        self.assessment_by_semester = divide_by_semester_mask(assessment, mask)
+        self.coordinator_by_semester = divide_by_semester_mask(coordinator, mask)
+
+    @staticmethod
+    def calculate(module):
+        """Calculate the hours for a module, using any overrides, otherwise the package formulas"""
+        package = module.package
+        students = module._student_count()
+
+        if module.contact_hours is not None:
+            contact = float(module.contact_hours)
+        else:
+            contact = calculate_contact_hours(package, module.credits, students)
+
+        if module.admin_hours is not None:
+            admin = float(module.admin_hours)
+        else:
+            admin = calculate_admin_hours(package, module.credits, students, contact=contact)
+
+        if module.assessment_hours is not None:
+            assessment = float(module.assessment_hours)
+        else:
+            assessment = calculate_assessment_hours(package, module.credits, students,
+                                                    contact=contact, admin=admin)
+
+        if module.coordinator_id is None:
+            coordinator = 0
+        elif module.coordinator_hours is not None:
+            coordinator = float(module.coordinator_hours)
+        else:
+            coordinator = calculate_coordinator_hours(package, module.credits, students)
+
+        return ModuleHours(contact, admin, assessment, coordinator, module.semester_mask)
+
+
 class Module(models.Model):
     """Basic information about a module
 
     module_code     the code for the module (e.g. EEE122)
     module_name     the module name
     semester        a Comma Separated Variable list of semesters the module covers
+    semester_mask   the semesters as a bitmask, kept in step as for Activity
     size            the approximate size of the module
     contact_hours   the main contact hours for the module
     admin_hours     admin hours, blank for automatic calculation
@@ -1230,6 +1395,8 @@ class Module(models.Model):
     campus = models.ForeignKey('Campus', on_delete=models.CASCADE)
     semester = models.CharField(max_length=10, validators=[validate_comma_separated_integer_list],
                                 help_text='Specify which semester(s) this module runs in.')
+    # Kept in step with semester by a pre_save signal, and indexed for filtering, see helpers.semester_mask()
+    semester_mask = models.PositiveSmallIntegerField(default=0, db_index=True, editable=False)
     credits = models.PositiveSmallIntegerField(default=20)
     # Deprecated
     size = models.ForeignKey('ModuleSize', on_delete=models.CASCADE, null=True, blank=True) #, null=True, blank=True)
@@ -1273,6 +1440,9 @@ class Module(models.Model):
     # formula engine, which in turn falls back to the legacy scalar calculation.
     # -------------------------------------------------------------------------
 
+    # The ModuleHours for this instance, once calculated
+    _hours = None
+
     def _student_count(self):
         """
         Returns the best available student count for formula calculations.
@@ -1288,94 +1458,167 @@ class Module(models.Model):
             return low
         return round((low + high) / 2)
 
+    def get_hours(self):
+        """Returns the ModuleHours for this module
+
+        These are calculated once, and kept until the module is next saved.
+        """
+        if self._hours is None:
+            self._hours = ModuleHours.calculate(self)
+        return self._hours
+
     def get_contact_hours(self):
         """Returns contact hours, using override if set, otherwise formula."""
-        if self.contact_hours is not None:
-            return float(self.contact_hours)
-        return calculate_contact_hours(self.package, self.credits, self._student_count())
+        return self.get_hours().contact
 
     def get_contact_hours_by_semester(self):
-        return divide_by_semesters(self.get_contact_hours(), self.semester)
+        return list(self.get_hours().contact_by_semester)
 
     def get_admin_hours(self):
         """Returns admin hours, using override if set, otherwise formula.
-        Note: uses get_contact_hours() so that any contact override is respected."""
-        if self.admin_hours is not None:
-            return float(self.admin_hours)
-        return calculate_admin_hours(
-            self.package, self.credits, self._student_count(),
-            contact=self.get_contact_hours(),
-        )
+        Note: based on contact hours so that any contact override is respected."""
+        return self.get_hours().admin
 
     def get_admin_hours_by_semester(self):
-        return divide_by_semesters(self.get_admin_hours(), self.semester)
+        return list(self.get_hours().admin_by_semester)
 
     def get_assessment_hours(self):
         """Returns assessment hours, using override if set, otherwise formula."""
-        if self.assessment_hours is not None:
-            return float(self.assessment_hours)
-        return calculate_assessment_hours(
-            self.package, self.credits, self._student_count(),
-            contact=self.get_contact_hours(),
-            admin=self.get_admin_hours(),
-        )
+        return self.get_hours().assessment
 
     def get_assessment_hours_by_semester(self):
-        return divide_by_semesters(self.get_assessment_hours(), self.semester)
+        return list(self.get_hours().assessment_by_semester)
 
     def get_coordinator_hours(self):
         """Returns coordinator hours for whoever is the module coordinator.
         Returns 0 if no coordinator is assigned to this module."""
-        if self.coordinator is None:
-            return 0
-        if self.coordinator_hours is not None:
-            return float(self.coordinator_hours)
-        return calculate_coordinator_hours(
-            self.package, self.credits, self._student_count(),
-        )
+        return self.get_hours().coordinator
 
     def get_coordinator_hours_by_semester(self):
         """Coordinator admin is distributed across the module's own semesters."""
-        return divide_by_semesters(self.get_coordinator_hours(), self.semester)
+        return list(self.get_hours().coordinator_by_semester)
 
     def get_all_hours(self):
         """Returns total hours for the module including coordinator hours."""
-        return (
-                self.get_contact_hours()
-                + self.get_admin_hours()
-                + self.get_assessment_hours()
-                + self.get_coordinator_hours()
-        )
+        return self.get_hours().all
 
     def get_all_hours_by_semester(self):
-        return divide_by_semesters(self.get_all_hours(), self.semester)
+        return divide_by_semester_mask(self.get_all_hours(), self.semester_mask)
 
-    def get_assessment_history(self):
-        """returns a list of tuples of AssessmentState objects and the resources signed off"""
+    @staticmethod
+    def get_hours_batch(modules):
+        """Calculates the hours of many modules at once
+
+        Modules are grouped by package, and each package's formulas are evaluated in one batch.
+        The results are also kept on each module, as if get_hours() had been called.
 
-        # Get the signoffs and resources in chronological order
-        signoffs = AssessmentStateSignOff.objects.all().filter(module=self).order_by('created')
-        resources = AssessmentResource.objects.all().filter(module=self).order_by('created')
+        modules     an iterable of Module objects, ideally with package already selected
 
-        # Make a list of tuples
-        history = list()
+        returns a dict, keyed by module primary key, of ModuleHours objects
+        """
+        by_package = dict()
+        for module in modules:
+            by_package.setdefault(module.package_id, list()).append(module)
+
+        module_hours = dict()
+        for package_modules in by_package.values():
+            hours = calculate_all_hours_batch(
+                package_modules[0].package,
+                [module.credits for module in package_modules],
+                [module._student_count() for module in package_modules],
+                contact_hours=[module.contact_hours for module in package_modules],
+                admin_hours=[module.admin_hours for module in package_modules],
+                assessment_hours=[module.assessment_hours for module in package_modules],
+                # Modules with no coordinator never carry coordinator hours, so don't evaluate them
+                coordinator_hours=[module.coordinator_hours if module.coordinator_id else 0
+                                   for module in package_modules],
+            )
+            for index, module in enumerate(package_modules):
+                module._hours = ModuleHours(
+                    hours['contact'][index], hours['admin'][index], hours['assessment'][index],
+                    hours['coordinator'][index] if module.coordinator_id else 0, module.semester_mask)
+                module_hours[module.pk] = module._hours
+        return module_hours
+
+    @staticmethod
+    def annotate_hours(queryset, package):
+        """Annotates a queryset of modules in a package with their hours, calculated in the database
+
+        The annotations are calculated_contact_hours, calculated_admin_hours and
+        calculated_assessment_hours, which respect any overrides. They are NULL where a
+        formula divides by zero, for which the Python calculation raises FormulaError.
+
+        returns the annotated queryset, or None if the package formulas can't be calculated in the database
+        """
+        expressions = package_hours_expressions(package)
+        if expressions is None:
+            return None
+        return queryset.annotate(calculated_contact_hours=expressions['contact'],
+                                 calculated_admin_hours=expressions['admin'],
+                                 calculated_assessment_hours=expressions['assessment'])
+
+    def save(self, *args, **kwargs):
+        # Any change might alter the hours, so calculate them again when next needed
+        self._hours = None
+        super().save(*args, **kwargs)
+
+    def get_assessment_history(self):
+        """returns a list of tuples of AssessmentStateSignOff objects and lists of the resources signed off
+
+        The most recent sign off comes first, each with the resources created before it and after the
+        previous one, most recent first. Any resources since the last sign off come first against None.
+        """
+        return Module.get_assessment_histories([self])[self.pk]
 
-        for counter, signoff in enumerate(signoffs):
-            # Get the resources covered by this sign off, in reverse chronological order
-            slice = resources.filter(created__lt=signoff.created).order_by('-created')
-            # Exclude them from the next iteration
-            resources = resources.exclude(created__lt=signoff.created)
-            # Add the tuple of the sign off and slice of resources to the list
-            history.append((signoff, slice))
+    @staticmethod
+    def get_assessment_histories(modules):
+        """Builds the assessment history of many modules at once, see get_assessment_history()
 
-        # If any remaining resources aren't signed off, add them against a None object
-        if len(resources):
-            history.append((None, resources.order_by('-created')))
+        Sign offs and resources are each fetched once, ordered by module and time, and merged
+        in a single pass over both.
 
-        # So the list is chronological, and we'll want most recent first, so
-        history.reverse()
+        modules     an iterable of Module objects
 
-        return history
+        returns a dict, keyed by module primary key, of assessment histories
+        """
+        modules = {module.pk: module for module in modules}
+        signoffs = AssessmentStateSignOff.objects.filter(module__in=modules.keys()). \
+            select_related('assessment_state', 'signed_by').order_by('module_id', 'created', 'pk')
+        resources = AssessmentResource.objects.filter(module__in=modules.keys()). \
+            select_related('resource_type', 'owner__user').order_by('module_id', 'created', 'pk')
+
+        histories = {module_id: list() for module_id in modules}
+        resources = iter(resources)
+        resource = next(resources, None)
+        for signoff in itertools.chain(signoffs, [None]):
+            # Resources in earlier modules than this sign off are unsigned, as are all those left at the end
+            while resource is not None and (signoff is None or resource.module_id < signoff.module_id):
+                unsigned = list()
+                module_id = resource.module_id
+                while resource is not None and resource.module_id == module_id:
+                    unsigned.append(resource)
+                    resource = next(resources, None)
+                histories[module_id].append((None, unsigned))
+            if signoff is None:
+                break
+
+            # The resources in this module created before this sign off, and after the previous one
+            signed = list()
+            while resource is not None and resource.module_id == signoff.module_id and \
+                    resource.created < signoff.created:
+                signed.append(resource)
+                resource = next(resources, None)
+            signoff.module = modules[signoff.module_id]
+            histories[signoff.module_id].append((signoff, signed))
+
+        # The histories and their resources are chronological, and we'll want most recent first, so
+        for history in histories.values():
+            history.reverse()
+            for signoff, items in history:
+                items.reverse()
+                for item in items:
+                    item.module = modules[item.module_id]
+        return histories
 
     def get_lead_examiners(self):
         """return any examiners for the lead_programme for this module"""
@@ -1425,42 +1668,62 @@ class Task(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
 
+    # Tasks due within this time are urgent
+    URGENT_PERIOD = datetime.timedelta(days=7)
+
     def __str__(self):
         return self.name + ' due ' + str(self.deadline)
 
     def get_all_targets(self):
-        """obtains all targets for a task whether by user or group, returns a list of valid targets"""
-        # These are staff objects
-        target_by_users = self.targets.all().order_by('user__last_name')
-        target_groups = self.groups.all()
-        # These are user objects
-        target_by_groups = User.objects.all().filter(groups__in=target_groups).distinct().order_by('last_name')
+        """obtains all targets for a task whether by user or group, returns a queryset of valid targets
+
+        These are read from TaskTarget, which is kept up to date with the targets and groups.
+        """
+        return Staff.objects.all().filter(tasktarget__task=self).order_by('user__last_name')
 
-        # Start to build a queryset, starting with targetted users
-        all_targets = target_by_users
+    def resolve_targets(self):
+        """finds the primary keys of all targets for a task whether by user or group, in one query"""
+        return set(Staff.objects.filter(
+            models.Q(pk__in=self.targets.values('pk')) |
+            models.Q(user__in=User.objects.filter(groups__in=self.groups.values('pk')))).values_list('pk', flat=True))
 
-        # Add each collection of staff members implicated by group
-        for user in target_by_groups:
-            staff = Staff.objects.all().filter(user=user)
-            all_targets = all_targets | staff
+    @staticmethod
+    def annotate_urgency(queryset, now=None):
+        """Annotates a queryset of tasks with whether each is urgent or overdue, worked out in the database
 
-        # Use distinct to clean up any duplicates
-        all_targets = all_targets.distinct()
+        The annotations are urgent and overdue, which can be used to filter and sort the queryset,
+        and which is_urgent() and is_overdue() then use.
 
-        return all_targets
+        now     the time to compare deadlines with, by default the current time
+        """
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        return queryset.annotate(
+            urgent=models.Case(models.When(deadline__lt=now + Task.URGENT_PERIOD, then=True),
+                               default=False, output_field=models.BooleanField()),
+            overdue=models.Case(models.When(deadline__lt=now, then=True),
+                                default=False, output_field=models.BooleanField()))
 
     def is_urgent(self):
-        """returns True is the task is 7 days away or less, False otherwise"""
-        now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-        seconds_left = (self.deadline - now).total_seconds()
-        # If a task is less than a week from deadline consider it urgent
-        return bool(seconds_left < 60 * 60 * 24 * 7)
+        """returns True is the task is 7 days away or less, False otherwise
+
+        This uses the annotation of annotate_urgency() if the task was loaded with it.
+        """
+        if 'urgent' in self.__dict__:
+            return self.urgent
+        return self.deadline < datetime.datetime.now(datetime.timezone.utc) + Task.URGENT_PERIOD
 
     def is_overdue(self):
-        """returns True is the deadline has passed, False otherwise"""
-        now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-        seconds_left = (self.deadline - now).total_seconds()
-        return bool(seconds_left < 0)
+        """returns True is the deadline has passed, False otherwise
+
+        This uses the annotation of annotate_urgency() if the task was loaded with it.
+        """
+        if 'overdue' in self.__dict__:
+            return self.overdue
+        return self.deadline < datetime.datetime.now(datetime.timezone.utc)
+
+    class Meta:
+        indexes = [models.Index(fields=['archive', 'deadline'])]
 
 
 class TaskCompletion(models.Model):
@@ -1480,6 +1743,140 @@ class TaskCompletion(models.Model):
     def __str__(self):
         return self.task.name + ' completed by ' + str(self.staff) + ' on ' + str(self.when)
 
+    class Meta:
+        indexes = [models.Index(fields=['task', 'staff'])]
+
+
+class TaskCompletionMatrix(object):
+    """Which of some tasks have been completed by which of some staff, found in one query
+
+    Use for_task() or for_staff() to build one for all the targets of a task, or all the
+    tasks of a member of staff.
+
+    tasks           a list of the Tasks
+    staff           a list of the Staff
+    completions     a dict of TaskCompletion objects keyed by (task primary key, staff primary key)
+    urgent          a set of the primary keys of tasks 7 days away or less, see Task.is_urgent()
+    overdue         a set of the primary keys of tasks past their deadline, see Task.is_overdue()
+
+    Tasks annotated by Task.annotate_urgency() are classified as the database found them.
+    """
+
+    def __init__(self, tasks, staff, completions):
+        """tasks, staff and completions may be any iterables, such as querysets, each is read once"""
+        self.tasks = list(tasks)
+        self.staff = list(staff)
+        self.completions = {(completion.task_id, completion.staff_id): completion for completion in completions}
+
+        self.urgent = set(task.pk for task in self.tasks if task.is_urgent())
+        self.overdue = set(task.pk for task in self.tasks if task.is_overdue())
+
+    @classmethod
+    def for_task(cls, task):
+        """Returns the matrix for all the targets of a task"""
+        return cls(Task.annotate_urgency(Task.objects.filter(pk=task.pk)), task.get_all_targets().select_related('user'),
+                   TaskCompletion.objects.filter(task=task))
+
+    @classmethod
+    def for_staff(cls, staff, archived=False):
+        """Returns the matrix for all the unarchived (or archived) tasks of a member of staff"""
+        return cls(Task.annotate_urgency(staff.get_all_tasks(archived=archived)), [staff],
+                   TaskCompletion.objects.filter(staff=staff, task__archive=archived))
+
+    def get_completion(self, task, staff):
+        """Returns the TaskCompletion of a task by a member of staff, or None if it isn't complete"""
+        return self.completions.get((task.pk, staff.pk))
+
+    def is_urgent(self, task):
+        """returns True is the task is 7 days away or less, False otherwise"""
+        return task.pk in self.urgent
+
+    def is_overdue(self, task):
+        """returns True is the deadline has passed, False otherwise"""
+        return task.pk in self.overdue
+
+
+class TaskTarget(models.Model):
+    """A member of staff a task is allocated to, whether directly or through a group
+
+    These are kept up to date by signal handlers when the targets or groups of a task, or
+    the members of a group, change. The targets of a task, and the tasks of a member of staff,
+    can then be found with one indexed lookup.
+
+    task    See the Task model
+    staff   See the Staff model
+    """
+    task = models.ForeignKey(Task, on_delete=models.CASCADE)
+    staff = models.ForeignKey(Staff, on_delete=models.CASCADE)
+
+    def __str__(self):
+        return str(self.task) + ' for ' + str(self.staff)
+
+    @staticmethod
+    def refresh(tasks):
+        """Brings the targets of some tasks up to date
+
+        tasks   an iterable of Task objects or their primary keys
+
+        returns a tuple of the number of targets added and removed
+        """
+        added = removed = 0
+        for task in Task.objects.filter(pk__in=[getattr(task, 'pk', task) for task in tasks]):
+            with transaction.atomic():
+                wanted = task.resolve_targets()
+                existing = set(TaskTarget.objects.filter(task=task).values_list('staff', flat=True))
+                # Another refresh may have added some already
+                TaskTarget.objects.bulk_create([TaskTarget(task=task, staff_id=staff_id)
+                                                for staff_id in wanted - existing], ignore_conflicts=True)
+                if existing - wanted:
+                    TaskTarget.objects.filter(task=task, staff__in=existing - wanted).delete()
+            added += len(wanted - existing)
+            removed += len(existing - wanted)
+        return added, removed
+
+    class Meta:
+        unique_together = ('task', 'staff')
+        indexes = [models.Index(fields=['staff', 'task'])]
+
+
+class TaskReminderState(models.Model):
+    """What a member of staff was last reminded of, so unchanged reminders need not be sent again
+
+    The email_reminders command updates these whenever it sends a reminder, and in incremental
+    mode only emails staff whose digest has changed, or whose last reminder is old enough.
+
+    staff       See the Staff model
+    digest      a hash of the outstanding tasks and their urgency, see get_digest()
+    sent        when the last reminder was sent
+    """
+    staff = models.OneToOneField(Staff, on_delete=models.CASCADE)
+    digest = models.CharField(max_length=40)
+    sent = models.DateTimeField()
+
+    def __str__(self):
+        return str(self.staff) + ' reminded ' + str(self.sent)
+
+    @staticmethod
+    def get_digest(incomplete):
+        """Returns a hash of outstanding tasks, which changes if any task, deadline or urgency does
+
+        incomplete  a list of [task, urgent, overdue] lists for the outstanding tasks
+        """
+        items = sorted('{}:{}:{}:{}'.format(task.pk, task.deadline.isoformat(), urgent, overdue)
+                       for task, urgent, overdue in incomplete)
+        return hashlib.sha1('|'.join(items).encode()).hexdigest()
+
+    @staticmethod
+    def record(digests, when):
+        """Records reminders as sent in one go
+
+        digests     a dict of digests keyed by Staff primary key
+        when        when the reminders were sent
+        """
+        TaskReminderState.objects.bulk_create(
+            [TaskReminderState(staff_id=staff_id, digest=digest, sent=when) for staff_id, digest in digests.items()],
+            update_conflicts=True, unique_fields=['staff'], update_fields=['digest', 'sent'])
+
 
 class Resource(models.Model):
     """A file resource to be made available for staff
@@ -1561,27 +1958,15 @@ class AssessmentResource(models.Model):
         if staff.is_external:
             return False
 
-        # Module Coordinators can download
-        if self.module.coordinator == staff:
-            return True
-
-        # Specifically designated assessment staff can download
-        if len(AssessmentStaff.objects.all().filter(staff=staff).filter(package=self.module.package)):
-            return True
-
         # The owner can download
-        if staff == self.owner:
+        if staff.pk == self.owner_id:
             return True
 
-        # People on the teaching team can download
-        if len(ModuleStaff.objects.all().filter(module=self.module).filter(staff=staff)):
+        # Module Coordinators, specifically designated assessment staff, people on the teaching
+        # team and moderators can download
+        if ModuleRelationships.get_for_module(staff, self.module).get_roles(self.module):
             return True
 
-        # A moderator can download
-        for moderator in self.module.moderators.all():
-            if staff == moderator:
-                return True
-
         # Otherwise, there is no access
         return False
 
@@ -1689,43 +2074,19 @@ class AssessmentState(models.Model):
     def can_be_set_by_staff(self, staff, module):
         """determines if a member of staff can set this state for a module
 
+            This uses the saved state, see AssessmentWorkflow.
+
             returns True if permitted, False otherwise"""
 
         if staff.is_external:
             return False
-
-        actors = self.get_actor_list()
-
-        # SuperUser override
-        if staff.user.is_superuser:
-            return True
-
-        # Anyone
-        if self.ANYONE in actors:
-            return True
-
-        # Module Coordinator?
-        if self.COORDINATOR in actors and staff == module.coordinator:
-            return True
-
-        # Moderator
-        if self.MODERATOR in actors and staff in module.moderators.all():
-            return True
-
-        # Team member
-        if self.TEAM_MEMBER in actors and len(ModuleStaff.objects.all().filter(module=module).filter(staff=staff)):
-            return True
-
-        # Assessment Staff
-        if self.ASSESSMENT_STAFF in actors and \
-                len(AssessmentStaff.objects.all().filter(staff=staff).filter(package=module.package)):
-            return True
-
-        return False
+        return AssessmentWorkflow.get().can_be_set_by(self.pk, staff, module)
 
     def can_be_set_by_external(self, external, module):
         """determines if a specific external examiner Staff member may set this state for a module
 
+            This uses the saved state, see AssessmentWorkflow.
+
             returns True if permitted, False otherwise
         """
 
@@ -1736,12 +2097,7 @@ class AssessmentState(models.Model):
         if not external.is_external:
             return False
 
-        # If external is not in the actor list, reject
-        if self.EXTERNAL not in self.get_actor_list():
-            return False
-
-        # Now it's about checking they have permission at all
-        return external.can_examine_module(module)
+        return AssessmentWorkflow.get().can_be_set_by(self.pk, external, module)
 
     class Meta:
         ordering = ['priority']
@@ -1769,6 +2125,197 @@ class AssessmentStateSignOff(models.Model):
         return str(self.assessment_state)
 
 
+class ModuleRelationships(object):
+    """The relationships of a member of staff to all the modules in a WorkPackage, as role bitmasks
+
+    These are found in two queries, so that permission checks for any number of modules in the
+    package need no more. Use get_for_staff() or get_for_module() to share one resolver for each
+    package between all the checks made with the same Staff object, usually for one request.
+
+    staff                   the Staff
+    package_id              the primary key of the WorkPackage
+    is_assessment_staff     whether the member of staff is in AssessmentStaff for the package
+    roles                   a dict of role bitmasks keyed by module primary key, for modules with any role
+    """
+
+    COORDINATOR = 1
+    MODERATOR = 2
+    TEAM_MEMBER = 4
+    ASSESSMENT_STAFF = 8
+
+    def __init__(self, staff, package_id):
+        self.staff = staff
+        self.package_id = package_id
+        self.is_assessment_staff = AssessmentStaff.objects.filter(staff=staff, package_id=package_id).exists()
+
+        # All the modules with any role, and the role, in one query
+        coordinated = Module.objects.filter(package_id=package_id, coordinator=staff). \
+            annotate(role=models.Value(self.COORDINATOR)).values_list('pk', 'role').order_by()
+        moderated = Module.moderators.through.objects.filter(module__package_id=package_id, staff=staff). \
+            annotate(role=models.Value(self.MODERATOR)).values_list('module_id', 'role').order_by()
+        taught = ModuleStaff.objects.filter(module__package_id=package_id, staff=staff). \
+            annotate(role=models.Value(self.TEAM_MEMBER)).values_list('module_id', 'role').order_by()
+
+        self.roles = dict()
+        for module_id, role in coordinated.union(moderated, taught, all=True):
+            self.roles[module_id] = self.roles.get(module_id, 0) | role
+
+    @classmethod
+    def get_for_staff(cls, staff, package_id):
+        """Returns the relationships of a member of staff to the modules in a package, kept on the Staff object
+
+        staff       the Staff
+        package_id  the primary key of the WorkPackage
+        """
+        resolvers = staff.__dict__.setdefault('_module_relationships', dict())
+        if package_id not in resolvers:
+            resolvers[package_id] = cls(staff, package_id)
+        return resolvers[package_id]
+
+    @classmethod
+    def get_for_module(cls, staff, module):
+        """Returns the relationships of a member of staff to the modules in the package of a module"""
+        return cls.get_for_staff(staff, module.package_id)
+
+    def get_roles(self, module):
+        """Returns the bitmask of roles the member of staff has for a module in the package"""
+        roles = self.roles.get(module.pk, 0)
+        if self.is_assessment_staff:
+            roles |= self.ASSESSMENT_STAFF
+        return roles
+
+
+# One state in an AssessmentWorkflow, actors and notify are role bitmasks and next_state_ids a tuple
+WorkflowState = collections.namedtuple('WorkflowState', ['pk', 'name', 'priority', 'initial_state', 'actors',
+                                                         'notify', 'next_state_ids'])
+
+
+class AssessmentWorkflow(object):
+    """An in-process copy of the AssessmentState graph, with actors and notify as role bitmasks
+
+    The workflow almost never changes, so it is loaded once, in two queries, and shared by all
+    requests in the process until any AssessmentState changes, see invalidate(). The graph itself
+    is never changed, only replaced, so it needs no locking to read.
+
+    version         the version the workflow was loaded at
+    states          a dict of WorkflowState tuples keyed by primary key
+    initial_ids     a tuple of the primary keys of initial states, in priority order
+    """
+
+    # Roles for modules share the bits of ModuleRelationships
+    COORDINATOR = ModuleRelationships.COORDINATOR
+    MODERATOR = ModuleRelationships.MODERATOR
+    TEAM_MEMBER = ModuleRelationships.TEAM_MEMBER
+    ASSESSMENT_STAFF = ModuleRelationships.ASSESSMENT_STAFF
+    EXTERNAL = 16
+    ANYONE = 32
+
+    # The bit for each of the AssessmentState.USER_TYPES, others can't act and aren't notified
+    ROLES = {
+        AssessmentState.ANYONE: ANYONE,
+        AssessmentState.COORDINATOR: COORDINATOR,
+        AssessmentState.MODERATOR: MODERATOR,
+        AssessmentState.TEAM_MEMBER: TEAM_MEMBER,
+        AssessmentState.EXTERNAL: EXTERNAL,
+        AssessmentState.ASSESSMENT_STAFF: ASSESSMENT_STAFF,
+    }
+
+    # Each process keeps the workflow until this version changes, which needs a shared cache
+    VERSION = CacheVersion('wam:assessment_workflow:version')
+
+    # And for no longer than this, in seconds, in case states are changed without going through Django
+    TIMEOUT = getattr(settings, 'WAM_ASSESSMENT_WORKFLOW_CACHE_TIMEOUT', 10 * 60)
+
+    _current = None
+    _current_lock = threading.Lock()
+
+    def __init__(self, version):
+        self.version = version
+        self.loaded = time.monotonic()
+
+        next_state_ids = dict()
+        for from_id, to_id in AssessmentState.next_states.through.objects. \
+                order_by('to_assessmentstate__priority', 'to_assessmentstate_id'). \
+                values_list('from_assessmentstate_id', 'to_assessmentstate_id'):
+            next_state_ids.setdefault(from_id, list()).append(to_id)
+
+        self.states = dict()
+        for state in AssessmentState.objects.order_by('priority', 'pk'):
+            self.states[state.pk] = WorkflowState(state.pk, state.name, state.priority, state.initial_state,
+                                                  self.get_mask(state.get_actor_list()),
+                                                  self.get_mask(state.get_notify_list()),
+                                                  tuple(next_state_ids.get(state.pk, ())))
+        self.initial_ids = tuple(state.pk for state in self.states.values() if state.initial_state)
+
+    @classmethod
+    def get_mask(cls, user_types):
+        """Returns the role bitmask for a list of AssessmentState.USER_TYPES"""
+        mask = 0
+        for user_type in user_types:
+            mask |= cls.ROLES.get(user_type.strip(), 0)
+        return mask
+
+    @classmethod
+    def get(cls):
+        """Returns the current workflow, loading it if it has changed or timed out
+
+        Without a shared cache other processes can't announce changes, so it is loaded every time.
+        """
+        version = cls.VERSION.get()
+        if version is None:
+            return cls(version)
+
+        workflow = cls._current
+        if workflow is None or workflow.version != version or time.monotonic() - workflow.loaded > cls.TIMEOUT:
+            workflow = cls(version)
+            with cls._current_lock:
+                cls._current = workflow
+        return workflow
+
+    @classmethod
+    def invalidate(cls):
+        """Marks the workflow as changed, so that it is loaded again in every process"""
+        cls.VERSION.invalidate()
+        with cls._current_lock:
+            cls._current = None
+
+    def get_next_states(self, state_id=None):
+        """Returns a list of the WorkflowStates that may follow a state, or the initial states if None"""
+        if state_id is None:
+            return [self.states[pk] for pk in self.initial_ids]
+        state = self.states.get(state_id)
+        return [self.states[pk] for pk in state.next_state_ids] if state else list()
+
+    def can_be_set_by(self, state_id, staff, module):
+        """Checks if a state can be set on a module by a member of Staff or an external examiner
+
+        see AssessmentState.can_be_set_by_staff() and AssessmentState.can_be_set_by_external()
+        """
+        state = self.states.get(state_id)
+        if state is None or not isinstance(staff, Staff):
+            return False
+
+        if staff.is_external:
+            # They must be allowed to act, and then have permission for the module at all
+            return bool(state.actors & self.EXTERNAL) and staff.can_examine_module(module)
+
+        # SuperUser override, or anyone
+        if staff.user.is_superuser or state.actors & self.ANYONE:
+            return True
+
+        # Module Coordinator, Moderator, Team member or Assessment Staff
+        return bool(state.actors & ModuleRelationships.get_for_module(staff, module).get_roles(module))
+
+    def get_settable_states(self, staff, module, state_id=None):
+        """Returns a list of the WorkflowStates that a member of staff can set after a state
+
+        staff       the Staff, or an external examiner
+        module      the Module
+        state_id    the primary key of the current state, or None for the initial states
+        """
+        return [state for state in self.get_next_states(state_id) if self.can_be_set_by(state.pk, staff, module)]
+
+
 class Body(models.Model):
     """Information on Project and Grant Providers
 
@@ -1910,3 +2457,729 @@ class ActivitySet(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class PackageLoadEngine(object):
+    """Calculates the loads for all members of staff in a WorkPackage at once
+
+    Staff.hours_by_semester() and Staff.hours_by_category() each fetch the
+    Activities, ModuleStaff allocations and coordinated Modules for a single
+    member of staff, and then lazily load related packages and modules row
+    by row. For pages covering a whole package that is many thousands of
+    queries.
+
+    This class fetches everything relevant to the package in a small fixed
+    number of queries, and then calculates in memory. The results are
+    identical to the per staff methods above.
+
+    package     the WorkPackage to calculate loads for
+    staff       optionally, restrict the data fetched to one member of staff
+    """
+
+    def __init__(self, package, staff=None):
+        self.package = package
+
+        # All categories, in the same order Staff.hours_by_category() uses
+        self.categories = list(Category.objects.all())
+
+        activities = Activity.objects.filter(package=package).select_related('activity_type__category')
+        modulestaff = ModuleStaff.objects.filter(package=package).select_related('activity_type__category')
+        if staff is not None:
+            activities = activities.filter(staff=staff)
+            modulestaff = modulestaff.filter(staff=staff)
+
+        self.activities_by_staff = dict()
+        for activity in activities.order_by('pk'):
+            # Avoid a lazy fetch of the package for every activity
+            activity.package = package
+            self.activities_by_staff.setdefault(activity.staff_id, list()).append(activity)
+
+        modulestaff = list(modulestaff.order_by('pk'))
+
+        # ModuleStaff has its own package field, so include any modules it points at, just in case
+        module_ids = set(allocation.module_id for allocation in modulestaff)
+        modules = Module.objects.filter(models.Q(package=package) | models.Q(pk__in=module_ids)). \
+            select_related('coordinator', 'package__coordinator_activity_type__category')
+
+        self.modules = dict()
+        self.coordinated_by_staff = dict()
+        for module in modules:
+            self.modules[module.pk] = module
+            if module.package_id == package.pk and module.coordinator_id is not None:
+                self.coordinated_by_staff.setdefault(module.coordinator_id, list()).append(module)
+
+        self.modulestaff_by_staff = dict()
+        for allocation in modulestaff:
+            allocation.module = self.modules[allocation.module_id]
+            self.modulestaff_by_staff.setdefault(allocation.staff_id, list()).append(allocation)
+
+        # Module hours are calculated on demand, but only once for each module
+        self.__module_hours_calculated = False
+
+    def calculate_module_hours(self):
+        """Calculates the hours of all the engine's modules in one batch, if not already done"""
+        if not self.__module_hours_calculated:
+            Module.get_hours_batch(self.modules.values())
+            self.__module_hours_calculated = True
+
+    def get_module_hours(self, module):
+        """Returns the ModuleHours for a module
+
+        All the engine's modules are calculated in one batch on first use.
+        """
+        self.calculate_module_hours()
+        return module.get_hours()
+
+    def get_activities(self, staff):
+        """Returns a list of the activities allocated to a member of staff in the package"""
+        return self.activities_by_staff.get(staff.pk, list())
+
+    def get_modulestaff(self, staff):
+        """Returns a list of the ModuleStaff allocations for a member of staff in the package"""
+        allocations = self.modulestaff_by_staff.get(staff.pk, list())
+        for allocation in allocations:
+            # We already have the staff object, so avoid fetching it again
+            allocation.staff = staff
+        return allocations
+
+    def get_coordinated_modules(self, staff):
+        """Returns a list of modules in the package coordinated by a member of staff"""
+        return self.coordinated_by_staff.get(staff.pk, list())
+
+    def get_staff_ids(self):
+        """Returns the set of primary keys of all staff with any allocation in the package"""
+        return set(self.activities_by_staff.keys()) | set(self.modulestaff_by_staff.keys()) | \
+            set(self.coordinated_by_staff.keys())
+
+    def hours_by_semester(self, staff):
+        """Calculate the total allocated hours for a member of staff
+
+        The return value is exactly as for Staff.hours_by_semester()
+        """
+        semester1_hours = 0.0
+        semester2_hours = 0.0
+        semester3_hours = 0.0
+
+        activities = self.get_activities(staff)
+        for activity in activities:
+            hours_by_semester = activity.hours_by_semester()
+            semester1_hours += hours_by_semester[1]
+            semester2_hours += hours_by_semester[2]
+            semester3_hours += hours_by_semester[3]
+
+        for moduledata in self.get_modulestaff(staff):
+            module_hours = self.get_module_hours(moduledata.module)
+            contact_hours = module_hours.contact_by_semester
+            assess_hours = module_hours.assessment_by_semester
+            admin_hours = module_hours.admin_by_semester
+
+            semester1_hours += (contact_hours[1] * moduledata.contact_proportion / 100)
+            semester1_hours += (assess_hours[1] * moduledata.assessment_proportion / 100)
+            semester1_hours += (admin_hours[1] * moduledata.admin_proportion / 100)
+
+            semester2_hours += (contact_hours[2] * moduledata.contact_proportion / 100)
+            semester2_hours += (assess_hours[2] * moduledata.assessment_proportion / 100)
+            semester2_hours += (admin_hours[2] * moduledata.admin_proportion / 100)
+
+            semester3_hours += (contact_hours[3] * moduledata.contact_proportion / 100)
+            semester3_hours += (assess_hours[3] * moduledata.assessment_proportion / 100)
+            semester3_hours += (admin_hours[3] * moduledata.admin_proportion / 100)
+
+        for module in self.get_coordinated_modules(staff):
+            coord_by_semester = self.get_module_hours(module).coordinator_by_semester
+            semester1_hours += coord_by_semester[1]
+            semester2_hours += coord_by_semester[2]
+            semester3_hours += coord_by_semester[3]
+
+        return [semester1_hours + semester2_hours + semester3_hours,
+                semester1_hours, semester2_hours, semester3_hours, len(activities)]
+
+    def hours_by_category(self, staff):
+        """Calculates the total allocated hours for a member of staff for each category
+
+        The return value is exactly as for Staff.hours_by_category()
+        """
+        hours_by_category = dict()
+        for category in self.categories:
+            hours_by_category[category] = 0
+
+        for activity in self.get_activities(staff):
+            hours = activity.total_hours()
+            hours_by_category[activity.activity_type.category] += hours
+
+        for moduledata in self.get_modulestaff(staff):
+            module_hours = self.get_module_hours(moduledata.module)
+            contact_hours = moduledata.contact_proportion * module_hours.contact / 100
+            assess_hours = moduledata.assessment_proportion * module_hours.assessment / 100
+            admin_hours = (moduledata.admin_proportion * module_hours.admin / 100)
+
+            hours = contact_hours + assess_hours + admin_hours
+
+            hours_by_category[moduledata.activity_type.category] += hours
+
+        for module in self.get_coordinated_modules(staff):
+            if module.package.coordinator_activity_type:
+                category = module.package.coordinator_activity_type.category
+                if category in hours_by_category:
+                    hours_by_category[category] += self.get_module_hours(module).coordinator
+
+        return hours_by_category
+
+
+class StaffLoadSummary(models.Model):
+    """A denormalised summary of the load for a member of staff in a WorkPackage
+
+    These are kept up to date by signal handlers when anything affecting the
+    load changes, so that pages showing the loads for a whole package can read
+    them from one table rather than recalculate them on every request.
+
+    Rows are created by the signal handlers for staff whose allocations change,
+    by the warm_load_caches command for active packages, see create_missing(),
+    and by the rebuild_load_summaries command, which can also be used to check
+    the whole table against a live calculation. get_for_package() only reads
+    them, calculating any that are missing without saving them.
+
+    staff               the member of staff
+    package             the WorkPackage the load is in
+    total_hours         the total hours as from Staff.hours_by_semester()
+    semester1_hours     hours in semester 1
+    semester2_hours     hours in semester 2
+    semester3_hours     hours in semester 3
+    activity_count      the number of Activity objects allocated
+    category_hours      a dictionary of hours, keyed by Category primary key
+    modified            when the summary was last calculated
+    """
+
+    staff = models.ForeignKey(Staff, on_delete=models.CASCADE)
+    package = models.ForeignKey(WorkPackage, on_delete=models.CASCADE)
+    total_hours = models.FloatField(default=0)
+    semester1_hours = models.FloatField(default=0)
+    semester2_hours = models.FloatField(default=0)
+    semester3_hours = models.FloatField(default=0)
+    activity_count = models.PositiveIntegerField(default=0)
+    category_hours = models.JSONField(default=dict)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.staff) + ' (' + str(self.package) + ')'
+
+    def calculate(self, engine):
+        """Set the summary fields from a PackageLoadEngine for the package"""
+        load_info = engine.hours_by_semester(self.staff)
+        self.total_hours, self.semester1_hours, self.semester2_hours, self.semester3_hours, self.activity_count = \
+            load_info
+        self.category_hours = {str(category.pk): hours
+                               for category, hours in engine.hours_by_category(self.staff).items()}
+
+    def differs_from(self, engine):
+        """Returns True if the stored summary does not match a live calculation from the engine"""
+        live = StaffLoadSummary(staff=self.staff, package=self.package)
+        live.calculate(engine)
+
+        if live.activity_count != self.activity_count:
+            return True
+        for field in ['total_hours', 'semester1_hours', 'semester2_hours', 'semester3_hours']:
+            if not math.isclose(getattr(live, field), getattr(self, field), abs_tol=1e-9):
+                return True
+        if set(live.category_hours.keys()) != set(self.category_hours.keys()):
+            return True
+        return any(not math.isclose(hours, self.category_hours[key], abs_tol=1e-9)
+                   for key, hours in live.category_hours.items())
+
+    def hours_by_semester(self):
+        """Returns the hours in the same format as Staff.hours_by_semester()"""
+        return [self.total_hours, self.semester1_hours, self.semester2_hours, self.semester3_hours,
+                self.activity_count]
+
+    def hours_by_category(self, categories):
+        """Returns the hours in the same format as Staff.hours_by_category()
+
+        categories  all the Category objects, in the order required
+        """
+        return {category: self.category_hours.get(str(category.pk), 0) for category in categories}
+
+    @staticmethod
+    def get_for_package(package, staff_list):
+        """Get summaries for a list of staff in a package, calculating any that are missing
+
+        Missing summaries are not saved, so this never writes to the database.
+
+        returns a dictionary of StaffLoadSummary objects keyed by the staff primary key
+        """
+        summaries = {summary.staff_id: summary for summary in
+                     StaffLoadSummary.objects.filter(package=package)}
+
+        missing = {staff.pk: staff for staff in staff_list if staff.pk not in summaries}
+        if missing:
+            logger.debug("calculating %u missing load summaries for package %s" % (len(missing), package))
+            summaries.update(StaffLoadSummary.calculate_for_package(package, missing.values()))
+
+        return summaries
+
+    @staticmethod
+    def create_missing(package):
+        """Create any missing summaries for the staff in a package, such as after upgrading
+
+        Staff are included if they are in the package groups, or have any allocation in it. If any
+        are created the package generation is increased, as pages may have been cached without them.
+
+        returns the number of summaries created
+        """
+        staff_ids = set(package.get_all_staff().values_list('pk', flat=True))
+        staff_ids |= set(Activity.objects.filter(package=package).values_list('staff', flat=True))
+        staff_ids |= set(ModuleStaff.objects.filter(package=package).values_list('staff', flat=True))
+        staff_ids |= set(Module.objects.filter(package=package).values_list('coordinator', flat=True))
+        staff_ids -= set(StaffLoadSummary.objects.filter(package=package).values_list('staff', flat=True))
+        staff_ids.discard(None)
+        if not staff_ids:
+            return 0
+
+        created = StaffLoadSummary.refresh(package, staff_ids)
+        WorkPackage.bump_generation([package])
+        logger.info("created %u missing load summaries for package %s" % (created, package))
+        return created
+
+    @staticmethod
+    def calculate_for_package(package, staff_list):
+        """Calculate summaries for a list of staff in a package without saving them
+
+        returns a dictionary of StaffLoadSummary objects keyed by the staff primary key
+        """
+        staff_list = list(staff_list)
+        if len(staff_list) == 1:
+            engine = PackageLoadEngine(package, staff=staff_list[0])
+        else:
+            engine = PackageLoadEngine(package)
+
+        summaries = dict()
+        for staff in staff_list:
+            summary = StaffLoadSummary(staff=staff, package=package)
+            summary.calculate(engine)
+            summaries[staff.pk] = summary
+        return summaries
+
+    @staticmethod
+    def refresh(package, staff_ids=None):
+        """Recalculate summaries for a package
+
+        package     the WorkPackage, or its primary key
+        staff_ids   if not None, only the summaries for these staff primary keys are refreshed,
+                    and created if they are missing, otherwise all existing summaries are refreshed
+
+        returns the number of summaries refreshed or created
+        """
+        summaries = StaffLoadSummary.objects.filter(package=package).select_related('staff', 'package')
+        if staff_ids is not None:
+            staff_ids = set(staff_id for staff_id in staff_ids if staff_id is not None)
+            summaries = summaries.filter(staff__in=staff_ids)
+        summaries = list(summaries)
+
+        if staff_ids is not None and len(summaries) < len(staff_ids):
+            if not isinstance(package, WorkPackage):
+                package = WorkPackage.objects.get(pk=package)
+            found = set(summary.staff_id for summary in summaries)
+            summaries += [StaffLoadSummary(staff=staff, package=package)
+                          for staff in Staff.objects.filter(pk__in=staff_ids - found)]
+
+        if not summaries:
+            return 0
+
+        package = summaries[0].package
+        if len(summaries) == 1:
+            engine = PackageLoadEngine(package, staff=summaries[0].staff)
+        else:
+            engine = PackageLoadEngine(package)
+
+        for summary in summaries:
+            summary.calculate(engine)
+            summary.save()
+
+        logger.debug("refreshed %u load summaries for package %s" % (len(summaries), package))
+        return len(summaries)
+
+    class Meta:
+        verbose_name_plural = "staff load summaries"
+        unique_together = ('staff', 'package')
+
+
+class LoadMatrix(object):
+    """The loads for all staff in a package's groups, built once and shared by the loads views
+
+    Each member of staff is one row, however many groups they are in, and rows are read
+    from the StaffLoadSummary table.
+
+    package         the WorkPackage
+    staff           the Staff for each row
+    categories      all Category objects, one for each category column
+    groups          a list of (group, rows) in the order of WorkPackage.get_group_staff()
+    semester_hours  for each row, the [total, semester 1, semester 2, semester 3] hours
+    category_hours  for each row, the hours in each category column
+    category_totals for each row, the sum of its category hours
+    staff_index     maps staff primary keys to rows
+    category_index  maps category primary keys to columns
+    """
+
+    def __init__(self, package):
+        self.package = package
+        self.categories = list(Category.objects.all())
+        self.category_index = {category.pk: column for column, category in enumerate(self.categories)}
+
+        self.staff = list()
+        self.staff_index = dict()
+        self.groups = list()
+        for group, staff_list in package.get_group_staff():
+            rows = list()
+            for staff in staff_list:
+                if staff.pk not in self.staff_index:
+                    self.staff_index[staff.pk] = len(self.staff)
+                    self.staff.append(staff)
+                rows.append(self.staff_index[staff.pk])
+            self.groups.append((group, rows))
+
+        summaries = StaffLoadSummary.get_for_package(package, self.staff)
+        self.semester_hours = list()
+        self.category_hours = list()
+        for staff in self.staff:
+            summary = summaries[staff.pk]
+            self.semester_hours.append(summary.hours_by_semester()[:4])
+            self.category_hours.append([summary.category_hours.get(str(category.pk), 0)
+                                        for category in self.categories])
+        self.category_totals = [sum(row) for row in self.category_hours]
+
+        # Staff with no load are only shown if they are active and expected to have a workload
+        self.__shown_without_load = [staff.is_active() and staff.has_workload for staff in self.staff]
+
+    def get_category_hours(self, staff):
+        """Returns the hours for a member of staff in the same format as Staff.hours_by_category()"""
+        return dict(zip(self.categories, self.category_hours[self.staff_index[staff.pk]]))
+
+    def get_group_rows(self, totals):
+        """Returns a list of (group, rows) leaving out staff with no load who needn't be shown
+
+        totals      for each row, the hours used to decide if the member of staff has any load
+        """
+        return [(group, [row for row in rows if totals[row] or self.__shown_without_load[row]])
+                for group, rows in self.groups]
+
+    def get_statistics(self, rows, totals):
+        """Returns the total, average, number with any load, and their average for some rows
+
+        rows        the rows to consider
+        totals      for each row, the hours to sum
+        """
+        total = sum(totals[row] for row in rows)
+        allocated = len([row for row in rows if totals[row]])
+        average = total / len(rows) if rows else 0.0
+        allocated_average = total / allocated if allocated else 0.0
+        return total, average, allocated, allocated_average
+
+    def get_overall_statistics(self, group_rows, totals):
+        """Returns the total, number of staff, and average over all groups, counting each member of staff once
+
+        group_rows  a list of (group, rows) as from get_group_rows()
+        totals      for each row, the hours to sum
+        """
+        counted = dict()
+        for group, rows in group_rows:
+            for row in rows:
+                counted.setdefault(row, totals[row])
+        total = sum(counted.values(), 0.0)
+        return total, len(counted), total / len(counted) if counted else 0
+
+    def get_percentages(self, row, values, scale_fte=False):
+        """Converts hours for a row into percentages of the package nominal hours
+
+        row         the row, used for its FTE if scaled
+        values      a list of hours
+        scale_fte   if True, percentages are of the nominal hours for that member of staff's FTE
+        """
+        nominal_hours = self.package.nominal_hours
+        if scale_fte:
+            nominal_hours = nominal_hours * self.staff[row].fte / 100
+        return [100 * value / nominal_hours for value in values]
+
+
+class LoadTrend(object):
+    """The loads of some staff across every WorkPackage they appear in, for trends over the years
+
+    Loads are read from the StaffLoadSummary table in one query for all staff and packages, so
+    the cost barely grows with the number of packages. Any summaries that don't exist yet are
+    calculated, without saving them, with one PackageLoadEngine for each package missing some.
+
+    staff       the Staff for each row
+    packages    the WorkPackages for each column, in order of start date
+    categories  all Category objects
+    hours       hours[row][column] is a list of the hours in each category, or None if the
+                member of staff doesn't appear in the package
+    totals      totals[row][column] is the total of the hours above, or None
+    """
+
+    def __init__(self, staff_list, packages=None):
+        """Calculate the trend
+
+        staff_list  the staff to include
+        packages    if not None, a queryset to restrict the packages shown
+        """
+        self.staff = list(staff_list)
+        self.categories = list(Category.objects.all())
+
+        # Which packages each member of staff appears in, by the same rules as Staff.get_all_packages()
+        users = {staff.user_id: row for row, staff in enumerate(self.staff)}
+        everywhere = set(row for row, staff in enumerate(self.staff) if staff.user.is_superuser)
+        rows_by_package = dict()
+        memberships = WorkPackage.groups.through.objects.filter(group__user__in=users.keys()). \
+            values_list('workpackage', 'group__user').distinct()
+        for package_id, user_id in memberships:
+            rows_by_package.setdefault(package_id, set()).add(users[user_id])
+
+        if packages is None:
+            packages = WorkPackage.objects.all()
+        if not everywhere:
+            packages = packages.filter(pk__in=rows_by_package.keys())
+        self.packages = list(packages.order_by('startdate', 'name'))
+
+        package_rows = list()
+        for package in self.packages:
+            rows = rows_by_package.get(package.pk, set())
+            if package.hidden:
+                rows = set(row for row in rows if self.staff[row].user.is_staff)
+            package_rows.append(rows | everywhere)
+
+        summaries = {(summary.staff_id, summary.package_id): summary for summary in
+                     StaffLoadSummary.objects.filter(staff__in=[staff.pk for staff in self.staff],
+                                                     package__in=self.packages)}
+        for package, rows in zip(self.packages, package_rows):
+            missing = [self.staff[row] for row in rows if (self.staff[row].pk, package.pk) not in summaries]
+            if missing:
+                for staff_id, summary in StaffLoadSummary.calculate_for_package(package, missing).items():
+                    summaries[(staff_id, package.pk)] = summary
+
+        self.hours = list()
+        self.totals = list()
+        for row, staff in enumerate(self.staff):
+            hours = list()
+            for package, rows in zip(self.packages, package_rows):
+                if row in rows:
+                    summary = summaries[(staff.pk, package.pk)]
+                    hours.append([summary.category_hours.get(str(category.pk), 0) for category in self.categories])
+                else:
+                    hours.append(None)
+            self.hours.append(hours)
+            self.totals.append([sum(column) if column is not None else None for column in hours])
+
+    def get_percentage(self, row, column):
+        """Returns a total as a percentage of the package nominal hours for the FTE, or None
+
+        The FTE used is the current one, as no history of it is kept.
+        """
+        total = self.totals[row][column]
+        staff = self.staff[row]
+        if total is None or not staff.fte or not self.packages[column].nominal_hours:
+            return None
+        return 100 * 100 * total / staff.fte / self.packages[column].nominal_hours
+
+class LoadSimulator(PackageLoadEngine):
+    """An in memory snapshot of a package's loads for calculating the effect of hypothetical changes
+
+    Nothing is ever written to the database. Each simulation works on a shallow copy of the
+    snapshot in which only the allocations of affected staff are replaced, and only those staff
+    are recalculated. The snapshot itself is never changed, so it can be shared between requests
+    while the package generation is unchanged, see get_for_package().
+
+    package         the WorkPackage to simulate
+    generation      the package generation the snapshot was taken at
+    staff_by_id     the Staff that may be allocated, keyed by primary key
+    activity_types  all ActivityType objects, keyed by primary key
+    """
+
+    # The fields that may be given for each type of object, foreign keys are given by primary key
+    SIMULATED_FIELDS = {
+        'activity': ['name', 'hours', 'percentage', 'hours_percentage', 'semester', 'activity_type', 'module',
+                     'staff'],
+        'modulestaff': ['module', 'staff', 'activity_type', 'contact_proportion', 'admin_proportion',
+                        'assessment_proportion'],
+    }
+
+    # How many package snapshots are kept in each process
+    SNAPSHOTS = 8
+
+    _snapshots = dict()
+    _snapshots_lock = threading.Lock()
+
+    def __init__(self, package):
+        # Read before the data, so the snapshot is never labelled newer than it is
+        self.generation = WorkPackage.objects.filter(pk=package.pk).values_list('generation', flat=True).get()
+        super().__init__(package)
+        # Calculated now so that simulations never change the modules
+        self.calculate_module_hours()
+
+        self.activity_types = {activity_type.pk: activity_type for activity_type in
+                               ActivityType.objects.all().select_related('category')}
+        staff_ids = self.get_staff_ids() | set(package.get_all_staff().values_list('pk', flat=True))
+        self.staff_by_id = Staff.objects.filter(pk__in=staff_ids).select_related('user').in_bulk()
+
+        self.indexes = {
+            'activity': {activity.pk: activity
+                         for activities in self.activities_by_staff.values() for activity in activities},
+            'modulestaff': {allocation.pk: allocation
+                            for allocations in self.modulestaff_by_staff.values() for allocation in allocations},
+        }
+
+    @classmethod
+    def get_for_package(cls, package):
+        """Returns a simulator for a package, reusing a snapshot while the package generation is unchanged"""
+        with cls._snapshots_lock:
+            simulator = cls._snapshots.get(package.pk)
+
+        # The creation time distinguishes packages which reuse a primary key, as in a restored database
+        if simulator is None or simulator.generation != package.generation or \
+                simulator.package.created != package.created:
+            simulator = cls(package)
+            with cls._snapshots_lock:
+                cls._snapshots.pop(package.pk, None)
+                cls._snapshots[package.pk] = simulator
+                while len(cls._snapshots) > cls.SNAPSHOTS:
+                    del cls._snapshots[next(iter(cls._snapshots))]
+
+        return simulator
+
+    def simulate(self, changes):
+        """Calculates the loads of the staff affected by a list of hypothetical changes
+
+        changes     a list of dictionaries applied in order, each with
+                    action  one of 'add', 'change' or 'delete'
+                    type    one of 'activity' or 'modulestaff'
+                    id      the primary key of the object, for change and delete
+                    fields  for add and change, a dictionary of values for SIMULATED_FIELDS
+
+        returns a dictionary keyed by staff primary key of dictionaries with 'before' and 'after'
+        loads, each a dictionary with 'semester_hours' as [total, semester 1, semester 2, semester 3]
+        and 'category_hours' keyed by Category primary key
+
+        raises ValidationError if any change is invalid
+        """
+        scenario = copy.copy(self)
+        scenario.activities_by_staff = dict(self.activities_by_staff)
+        scenario.modulestaff_by_staff = dict(self.modulestaff_by_staff)
+
+        # Objects already changed or deleted (None) in this simulation, keyed by (type, id)
+        changed = dict()
+        affected = set()
+        for change in changes:
+            if not isinstance(change, dict):
+                raise ValidationError("each change must be an object")
+            action = change.get('action')
+            model_type = change.get('type')
+            fields = change.get('fields', dict())
+            if model_type not in self.SIMULATED_FIELDS:
+                raise ValidationError("unknown type %(type)s", params={'type': model_type})
+            if action not in ['add', 'change', 'delete']:
+                raise ValidationError("unknown action %(action)s", params={'action': action})
+            if not isinstance(fields, dict):
+                raise ValidationError("fields must be an object")
+
+            if model_type == 'activity':
+                model = Activity
+                allocations = scenario.activities_by_staff
+            else:
+                model = ModuleStaff
+                allocations = scenario.modulestaff_by_staff
+
+            if action == 'add':
+                if model_type == 'activity':
+                    instance = Activity(package=self.package, hours=0, percentage=0)
+                else:
+                    instance = ModuleStaff(package=self.package, contact_proportion=0, admin_proportion=0,
+                                           assessment_proportion=0)
+            else:
+                pk = model._meta.pk.to_python(change.get('id'))
+                key = (model_type, pk)
+                original = changed.get(key, self.indexes[model_type].get(pk))
+                if original is None:
+                    raise ValidationError("no %(type)s with id %(id)s in this package",
+                                          params={'type': model_type, 'id': pk})
+                allocations[original.staff_id] = [allocation for allocation in allocations.get(original.staff_id, [])
+                                                  if allocation is not original]
+                affected.add(original.staff_id)
+                if action == 'delete':
+                    changed[key] = None
+                    continue
+                instance = copy.copy(original)
+                changed[key] = instance
+
+            self.set_simulated_fields(instance, model_type, fields)
+            allocations[instance.staff_id] = allocations.get(instance.staff_id, []) + [instance]
+            affected.add(instance.staff_id)
+
+        results = dict()
+        for staff_id in affected:
+            # Unallocated activities don't count towards anyone's load
+            if staff_id is None:
+                continue
+            staff = self.staff_by_id[staff_id]
+            results[staff_id] = {
+                'before': self.get_simulated_loads(staff),
+                'after': scenario.get_simulated_loads(staff),
+            }
+        return results
+
+    def get_modulestaff(self, staff):
+        """Returns copies of the ModuleStaff allocations for a member of staff in the package
+
+        The snapshot may be shared by simulations in other threads, so its allocations are never changed.
+        """
+        allocations = [copy.copy(allocation) for allocation in self.modulestaff_by_staff.get(staff.pk, list())]
+        for allocation in allocations:
+            allocation.staff = staff
+        return allocations
+
+    def set_simulated_fields(self, instance, model_type, fields):
+        """Sets fields from a simulated change on an unsaved Activity or ModuleStaff
+
+        raises ValidationError if any field or value is invalid
+        """
+        related = {
+            'activity_type': self.activity_types,
+            'module': self.modules,
+            'staff': self.staff_by_id,
+        }
+
+        for name, value in fields.items():
+            if name not in self.SIMULATED_FIELDS[model_type]:
+                raise ValidationError("%(name)s cannot be simulated", params={'name': name})
+            field = instance._meta.get_field(name)
+            if name in related:
+                if value is None and field.null:
+                    setattr(instance, name, None)
+                    continue
+                value = field.target_field.to_python(value)
+                if value not in related[name]:
+                    raise ValidationError("no %(name)s with id %(id)s in this package",
+                                          params={'name': name, 'id': value})
+                setattr(instance, name, related[name][value])
+            else:
+                setattr(instance, name, field.clean(value, instance))
+
+        # New objects may rely on defaults, which must also be found in the snapshot
+        if instance.pk is None:
+            for name in related:
+                field = instance._meta.get_field(name)
+                value = getattr(instance, field.attname)
+                if value is None:
+                    if not field.null:
+                        raise ValidationError("%(name)s is required", params={'name': name})
+                elif value not in related[name]:
+                    raise ValidationError("no %(name)s with id %(id)s in this package",
+                                          params={'name': name, 'id': value})
+                else:
+                    setattr(instance, name, related[name][value])
+
+        if model_type == 'activity':
+            instance.semester_mask = semester_mask(instance.semester)
+
+    def get_simulated_loads(self, staff):
+        """Returns the semester and category hours for a member of staff as used by simulate()"""
+        return {
+            'semester_hours': self.hours_by_semester(staff)[:4],
+            'category_hours': {category.pk: hours for category, hours in self.hours_by_category(staff).items()},
+        }
@@ -1,13 +1,20 @@
 # signals.py
 import re
 import logging
+import threading
 
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.contrib.auth.signals import user_logged_in, user_logged_out, user_login_failed
 from django.dispatch import receiver
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, User
 from .models import Staff
+from .models import Activity, ActivityGenerator, ActivityType, Category, Module, ModuleStaff, Programme, WorkPackage
+from .models import StaffLoadSummary
+from .models import AssessmentState, AssessmentWorkflow
+from .models import Task, TaskTarget
+from .helpers import semester_mask
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -106,3 +113,388 @@ def user_login_failed_callback(sender, credentials, **kwargs):
     logger.warning('login failed for: {credentials}'.format(
         credentials=credentials,
     ))
+
+
+# The following handlers keep StaffLoadSummary objects in step with the data they summarise.
+# Only the summaries for the affected staff are recalculated, once the transaction commits, so
+# changing many rows at once recalculates each summary only once. The package generation is
+# increased after that, so nothing rendered from the old summaries is cached as current.
+
+# Changes to these WorkPackage fields will change the load for everyone in the package
+WORKPACKAGE_LOAD_FIELDS = ['nominal_hours', 'credit_contact_scaling', 'contact_admin_scaling',
+                           'contact_assessment_scaling', 'contact_formula', 'admin_formula',
+                           'assessment_formula', 'coordinator_formula', 'coordinator_activity_type']
+
+
+# Staff fields shown on the package pages
+STAFF_DISPLAY_FIELDS = ['title', 'fte', 'is_external', 'has_workload']
+
+
+def get_previous_values(sender, instance, fields):
+    """Returns a dict of the values of fields for the saved version of instance, or None if it is new"""
+    if instance.pk is None:
+        return None
+    return sender.objects.filter(pk=instance.pk).values(*fields).first()
+
+
+# The summaries waiting for the transaction in this thread to commit, a dict of sets of staff
+# primary keys keyed by package primary key, where None means all staff in the package
+pending_load_summaries = threading.local()
+
+
+def get_pending_load_summaries():
+    """Returns the pending summaries for this thread
+
+    After adding to them, register flush_load_summaries() with transaction.on_commit(), which runs it
+    at once outside a transaction. Only the first callback to run finds anything to do, and anything
+    left by a transaction that was rolled back is simply refreshed with the next.
+    """
+    if not hasattr(pending_load_summaries, 'staff_by_package'):
+        pending_load_summaries.staff_by_package = dict()
+    return pending_load_summaries.staff_by_package
+
+
+def flush_load_summaries():
+    """Refresh all the pending load summaries for this thread, and then the generation of their packages"""
+    staff_by_package = getattr(pending_load_summaries, 'staff_by_package', dict())
+    pending_load_summaries.staff_by_package = dict()
+    if not staff_by_package:
+        return
+
+    # Packages deleted since don't need their summaries refreshed
+    existing = set(WorkPackage.objects.filter(pk__in=staff_by_package.keys()).values_list('pk', flat=True))
+    for package_id, staff_ids in staff_by_package.items():
+        if package_id in existing:
+            StaffLoadSummary.refresh(package_id, staff_ids)
+    WorkPackage.bump_generation(existing)
+
+
+def refresh_load_summaries(pairs):
+    """Refresh load summaries for an iterable of (package_id, staff_id) tuples once the transaction commits
+
+    The packages have their generation increased then, even if staff_id is None.
+    """
+    staff_by_package = get_pending_load_summaries()
+    for package_id, staff_id in pairs:
+        if package_id is None:
+            continue
+        staff_ids = staff_by_package.setdefault(package_id, set())
+        if staff_ids is not None and staff_id is not None:
+            staff_ids.add(staff_id)
+    transaction.on_commit(flush_load_summaries)
+
+
+def refresh_package_load_summaries(package_ids):
+    """Refresh all the load summaries for packages once the transaction commits"""
+    staff_by_package = get_pending_load_summaries()
+    for package_id in package_ids:
+        staff_by_package[package_id] = None
+    transaction.on_commit(flush_load_summaries)
+
+
+def is_package_deletion(origin):
+    """Returns True if a deletion started with a WorkPackage, whose summaries are deleted along with it"""
+    return isinstance(origin, WorkPackage) or getattr(origin, 'model', None) is WorkPackage
+
+
+@receiver(pre_save, sender=Activity)
+@receiver(pre_save, sender=ActivityGenerator)
+@receiver(pre_save, sender=Module)
+def update_semester_mask(sender, instance, **kwargs):
+    """Keep semester_mask in step with semester, including for raw saves such as by loaddata"""
+    instance.semester_mask = semester_mask(instance.semester)
+
+
+@receiver(pre_save, sender=Activity)
+@receiver(pre_save, sender=ModuleStaff)
+def remember_allocation(sender, instance, raw=False, **kwargs):
+    """Remember who had an allocation before it changes, as they may need a refresh too"""
+    if raw:
+        return
+    instance._previous_load_values = get_previous_values(sender, instance, ['package', 'staff'])
+
+
+@receiver(post_save, sender=Activity)
+@receiver(post_save, sender=ModuleStaff)
+def allocation_saved(sender, instance, raw=False, **kwargs):
+    """Refresh load summaries for the staff member with an Activity or ModuleStaff allocation"""
+    if raw:
+        return
+    pairs = [(instance.package_id, instance.staff_id)]
+    previous = getattr(instance, '_previous_load_values', None)
+    if previous:
+        pairs.append((previous['package'], previous['staff']))
+    refresh_load_summaries(pairs)
+
+
+@receiver(post_delete, sender=Activity)
+@receiver(post_delete, sender=ModuleStaff)
+def allocation_deleted(sender, instance, origin=None, **kwargs):
+    """Refresh load summaries when an Activity or ModuleStaff allocation is removed"""
+    if is_package_deletion(origin):
+        return
+    refresh_load_summaries([(instance.package_id, instance.staff_id)])
+
+
+@receiver(pre_save, sender=Module)
+def remember_module(sender, instance, raw=False, **kwargs):
+    """Remember the module package, coordinator and lead programme before any change"""
+    if raw:
+        return
+    instance._previous_load_values = get_previous_values(sender, instance,
+                                                         ['package', 'coordinator', 'lead_programme'])
+
+
+@receiver(post_save, sender=Module)
+def module_saved(sender, instance, raw=False, **kwargs):
+    """Refresh load summaries for everyone allocated to, or coordinating, a module"""
+    if raw:
+        return
+    pairs = list(ModuleStaff.objects.filter(module=instance).values_list('package', 'staff'))
+    pairs.append((instance.package_id, instance.coordinator_id))
+    previous = getattr(instance, '_previous_load_values', None)
+    if previous:
+        pairs.append((previous['package'], previous['coordinator']))
+    refresh_load_summaries(pairs)
+
+
+@receiver(post_delete, sender=Module)
+def module_deleted(sender, instance, origin=None, **kwargs):
+    """Refresh the coordinator load summary when a module is removed, allocations are handled by cascade"""
+    if is_package_deletion(origin):
+        return
+    refresh_load_summaries([(instance.package_id, instance.coordinator_id)])
+
+
+@receiver(pre_save, sender=WorkPackage)
+def remember_workpackage(sender, instance, raw=False, **kwargs):
+    """Remember the WorkPackage fields that affect load calculations before any change"""
+    if raw:
+        return
+    instance._previous_load_values = get_previous_values(sender, instance, WORKPACKAGE_LOAD_FIELDS)
+
+
+@receiver(post_save, sender=WorkPackage)
+def workpackage_saved(sender, instance, created, raw=False, **kwargs):
+    """Refresh all load summaries for a package if its formulas or nominal hours change"""
+    if raw or created:
+        return
+    previous = getattr(instance, '_previous_load_values', None)
+    current = {field: getattr(instance, instance._meta.get_field(field).attname)
+               for field in WORKPACKAGE_LOAD_FIELDS}
+    if previous and current != previous:
+        logger.info("load calculation settings changed for package %s, refreshing summaries" % instance)
+        refresh_package_load_summaries([instance.pk])
+    else:
+        # Any other change might still show on the package pages
+        WorkPackage.bump_generation([instance])
+
+
+@receiver(pre_save, sender=ActivityType)
+def remember_activity_type(sender, instance, raw=False, **kwargs):
+    """Remember the category of an ActivityType before any change"""
+    if raw:
+        return
+    instance._previous_load_values = get_previous_values(sender, instance, ['category'])
+
+
+@receiver(post_save, sender=ActivityType)
+def activity_type_saved(sender, instance, created, raw=False, **kwargs):
+    """Refresh load summaries that use an ActivityType if its category changes"""
+    if raw or created:
+        return
+    previous = getattr(instance, '_previous_load_values', None)
+    if not previous or previous['category'] == instance.category_id:
+        return
+
+    pairs = list(Activity.objects.filter(activity_type=instance).values_list('package', 'staff').distinct())
+    pairs += list(ModuleStaff.objects.filter(activity_type=instance).values_list('package', 'staff').distinct())
+    refresh_load_summaries(pairs)
+
+    # Coordinator hours are categorised by the package, so any package using this needs a full refresh
+    refresh_package_load_summaries(
+        WorkPackage.objects.filter(coordinator_activity_type=instance).values_list('pk', flat=True))
+
+
+# The following handlers increase the generation of any WorkPackage whose pages might change,
+# beyond the allocation changes handled above.
+
+def bump_packages_for_groups(group_ids):
+    """Increase the generation of all packages containing any of the given groups"""
+    WorkPackage.bump_generation(
+        WorkPackage.objects.filter(groups__in=group_ids).values_list('pk', flat=True).distinct())
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def group_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Group membership decides who appears in a package"""
+    if reverse:
+        # The instance is a Group, with users added or removed
+        group_ids = [instance.pk]
+    elif action == 'pre_clear':
+        # Remember the groups this user is about to leave
+        instance._cleared_group_ids = list(instance.groups.values_list('pk', flat=True))
+        return
+    elif action == 'post_clear':
+        group_ids = getattr(instance, '_cleared_group_ids', list())
+    else:
+        group_ids = pk_set
+
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_packages_for_groups(group_ids)
+
+
+@receiver(m2m_changed, sender=WorkPackage.groups.through)
+def package_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """The groups in a package decide who appears in it"""
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            WorkPackage.bump_generation([instance])
+    elif action == 'pre_clear':
+        # The instance is a Group about to be removed from all its packages
+        instance._cleared_package_ids = list(instance.workpackage_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        WorkPackage.bump_generation(getattr(instance, '_cleared_package_ids', list()))
+    elif action in ('post_add', 'post_remove'):
+        WorkPackage.bump_generation(pk_set)
+
+
+@receiver(pre_save, sender=Staff)
+def remember_staff(sender, instance, raw=False, **kwargs):
+    """Remember the Staff fields shown on package pages before any change"""
+    if raw:
+        return
+    instance._previous_load_values = get_previous_values(sender, instance, STAFF_DISPLAY_FIELDS)
+
+
+@receiver(post_save, sender=Staff)
+def staff_saved(sender, instance, created, raw=False, **kwargs):
+    """Changes to a member of staff change the pages of packages they are in, but choosing a package doesn't"""
+    if raw or created:
+        return
+    previous = getattr(instance, '_previous_load_values', None)
+    if previous and previous != {field: getattr(instance, field) for field in STAFF_DISPLAY_FIELDS}:
+        bump_packages_for_groups(instance.user.groups.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    """Names and active status show on package pages, but logging in only updates last_login"""
+    if raw or created or (update_fields and set(update_fields) == {'last_login'}):
+        return
+    bump_packages_for_groups(instance.groups.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=ActivityType)
+@receiver(post_delete, sender=ActivityType)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def classification_changed(sender, instance, raw=False, **kwargs):
+    """Activity types and categories are shared by all packages, and rarely change"""
+    if raw:
+        return
+    WorkPackage.bump_generation(WorkPackage.objects.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Programme.examiners.through)
+@receiver(m2m_changed, sender=Module.programmes.through)
+def examiner_access_changed(sender, action, **kwargs):
+    """Examiners, and the programmes of modules, decide which modules examiners can access"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(Staff.invalidate_examined_modules)
+
+
+@receiver(post_save, sender=Module)
+def module_lead_programme_saved(sender, instance, created, **kwargs):
+    """The lead programme of a module decides access too, and a new module may reuse the key of a deleted one"""
+    previous = getattr(instance, '_previous_load_values', None)
+    if created or not previous or previous['lead_programme'] != instance.lead_programme_id:
+        transaction.on_commit(Staff.invalidate_examined_modules)
+
+
+@receiver(post_delete, sender=Module)
+@receiver(post_delete, sender=Programme)
+@receiver(post_delete, sender=Staff)
+def examiner_access_object_deleted(sender, instance, **kwargs):
+    """Deleting objects removes their relationships without any m2m signals"""
+    transaction.on_commit(Staff.invalidate_examined_modules)
+
+
+@receiver(post_save, sender=Staff)
+def examiner_created(sender, instance, created, **kwargs):
+    """A new member of staff may reuse the key of a deleted one"""
+    if created:
+        transaction.on_commit(Staff.invalidate_examined_modules)
+
+
+@receiver(post_save, sender=AssessmentState)
+@receiver(post_delete, sender=AssessmentState)
+def assessment_state_changed(sender, instance, **kwargs):
+    """Any change to a state means loading the assessment workflow again, once the change is committed
+
+    Otherwise another process could load the old workflow again, and keep it under the new version.
+    """
+    transaction.on_commit(AssessmentWorkflow.invalidate)
+
+
+@receiver(m2m_changed, sender=AssessmentState.next_states.through)
+def assessment_transitions_changed(sender, action, **kwargs):
+    """As do changes to the states that may follow each other"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(AssessmentWorkflow.invalidate)
+
+
+@receiver(m2m_changed, sender=Task.targets.through)
+@receiver(m2m_changed, sender=Task.groups.through)
+def task_targets_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep TaskTarget up to date with the staff and groups targeted by tasks"""
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            TaskTarget.refresh([instance])
+    elif action == 'pre_clear':
+        # The instance is a Staff or Group about to be removed from all its tasks
+        instance._cleared_task_ids = list(instance.task_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        TaskTarget.refresh(getattr(instance, '_cleared_task_ids', list()))
+    elif action in ('post_add', 'post_remove'):
+        TaskTarget.refresh(pk_set)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def group_membership_changed_for_tasks(sender, instance, action, reverse, pk_set, **kwargs):
+    """Group membership decides who is targeted by tasks against groups"""
+    if reverse:
+        # The instance is a Group, with users added or removed
+        group_ids = [instance.pk]
+    elif action == 'pre_clear':
+        # Remember the groups this user is about to leave
+        instance._cleared_task_group_ids = list(instance.groups.values_list('pk', flat=True))
+        return
+    elif action == 'post_clear':
+        group_ids = getattr(instance, '_cleared_task_group_ids', list())
+    else:
+        group_ids = pk_set
+
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        TaskTarget.refresh(Task.objects.filter(groups__in=group_ids).values_list('pk', flat=True).distinct())
+
+
+@receiver(post_save, sender=Staff)
+def staff_created_for_tasks(sender, instance, created, raw=False, **kwargs):
+    """A user may already be in groups targeted by tasks before they have a Staff object"""
+    if raw or not created:
+        return
+    TaskTarget.refresh(Task.objects.filter(groups__in=instance.user.groups.all()).values_list('pk', flat=True).
+                       distinct())
+
+
+@receiver(pre_delete, sender=Group)
+def remember_group_tasks(sender, instance, **kwargs):
+    """Deleting a group removes it from tasks without any m2m signals"""
+    instance._deleted_task_ids = list(instance.task_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    """So the targets of its tasks are refreshed afterwards"""
+    TaskTarget.refresh(getattr(instance, '_deleted_task_ids', list()))
@@ -1,11 +1,15 @@
 # Standard Imports
 import sys, logging
+from unittest.mock import patch
 from io import StringIO
 
 from django.core.exceptions import PermissionDenied
 # Django specific Imports
 from django.test import TestCase, override_settings
 from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.test import Client
 from django.urls import reverse
 
@@ -23,10 +27,13 @@ from .models import Activity
 from .models import AssessmentResource
 from .models import AssessmentResourceType
 from .models import AssessmentStaff
+from .models import AssessmentState
+from .models import AssessmentStateSignOff
 from .models import Category
 from .models import Campus
 from .models import ExternalExaminer
 from .models import Staff
+from .models import StaffLoadSummary
 from .models import Task
 from .models import Activity
 from .models import TaskCompletion
@@ -38,6 +45,8 @@ from .models import Project
 from .models import ProjectStaff
 from .models import WorkPackage
 
+from .caching import get_fragment_statistics, reset_fragment_statistics
+
 from WAM.settings import LOGIN_URL
 from WAM.settings import WAM_ADFS_AUTH
 
@@ -54,6 +63,8 @@ class UserClientTest(TestCase):
     def setUp(self):
         # Logging is very noisy typically
         logging.disable(logging.CRITICAL)
+        # Examiner access is cached across tests, whose changes are never committed to invalidate it
+        cache.clear()
 
         # Every test needs a client.
         self.client = Client()
@@ -960,4 +971,563 @@ class ActivitiesViewTest(TestCase):
             ctx['total'],
             ctx['semester1_total'] + ctx['semester2_total'] + ctx['semester3_total'],
             places=2,
-        )
\ No newline at end of file
+        )
+
+class PackageConditionalGetTest(TestCase):
+    """Tests that the loads pages answer conditional requests from the package generation."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.client = Client()
+
+        category = Category.objects.create(name="Admin", abbreviation="adm", colour="blue")
+        self.activity_type = ActivityType.objects.create(name="Marking", category=category)
+        self.package = WorkPackage.objects.create(name="test", startdate="2024-09-01", enddate="2025-08-31")
+        self.group = Group.objects.create(name="etaggroup")
+        self.package.groups.add(self.group)
+
+        user = User.objects.create_user('etaguser', 'a@b.com', 'password')
+        user.groups.add(self.group)
+        self.staff = Staff.objects.get(user=user)
+        self.staff.package = self.package
+        self.staff.save()
+        self.client.force_login(user)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def get_generation(self):
+        return WorkPackage.objects.get(pk=self.package.pk).generation
+
+    def test_unchanged_pages_not_modified(self):
+        """A repeated request with the same ETag gets a 304, for every conditional page."""
+        # The first page sets the CSRF cookie, which is part of the ETag
+        self.client.get("/loads/")
+        for url in ["/loads/", "/loads_charts/", "/loads/modules/", f"/activities/{self.staff.id}"]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.has_header('ETag'))
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_changes_give_fresh_pages(self):
+        """Allocation and membership changes change the ETag."""
+        # The first page sets the CSRF cookie, which is part of the ETag
+        self.client.get("/loads/")
+        etag = self.client.get("/loads/")['ETag']
+        self.assertEqual(self.client.get("/loads/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            Activity.objects.create(name="Marking", hours=10, percentage=0, semester="1",
+                                    activity_type=self.activity_type, staff=self.staff, package=self.package)
+        response = self.client.get("/loads/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        other = User.objects.create_user('etagother', 'b@b.com', 'password')
+        other.groups.add(self.group)
+        response = self.client.get("/loads/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # Logging in only updates last_login, which doesn't change the package
+        generation = self.get_generation()
+        self.client.login(username='etagother', password='password')
+        self.assertEqual(self.get_generation(), generation)
+
+    def test_stale_package_save_keeps_generation(self):
+        """Saving an out of date copy of a package never winds the generation back."""
+        stale = WorkPackage.objects.get(pk=self.package.pk)
+        WorkPackage.bump_generation([self.package])
+        generation = self.get_generation()
+        stale.details = "changed"
+        stale.save()
+        # The save itself is a change to the package
+        self.assertEqual(self.get_generation(), generation + 1)
+
+
+class FragmentCacheTest(TestCase):
+    """Tests that rendered load tables are cached until their package changes."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        cache.clear()
+        self.client = Client()
+
+        category = Category.objects.create(name="Admin", abbreviation="adm", colour="blue")
+        self.activity_type = ActivityType.objects.create(name="Marking", category=category)
+        self.package = WorkPackage.objects.create(name="test", startdate="2024-09-01", enddate="2025-08-31")
+        self.group = Group.objects.create(name="cachegroup")
+        self.package.groups.add(self.group)
+
+        user = User.objects.create_user('cacheuser', 'a@b.com', 'password')
+        user.groups.add(self.group)
+        self.staff = Staff.objects.get(user=user)
+        self.staff.package = self.package
+        self.staff.save()
+        self.client.force_login(user)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_repeated_pages_hit_cache(self):
+        """The second request for each page is served from the cache."""
+        for url in ["/loads/", "/loads_charts/", "/loads/modules/"]:
+            reset_fragment_statistics()
+            self.client.get(url)
+            self.assertEqual(get_fragment_statistics(), {'hits': 0, 'misses': 1})
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(get_fragment_statistics(), {'hits': 1, 'misses': 1})
+
+    def test_changes_miss_cache(self):
+        """A change to the package renders the table again, showing the change."""
+        self.client.get("/loads/")
+        with self.captureOnCommitCallbacks(execute=True):
+            Activity.objects.create(name="Marking", hours=123, percentage=0, semester="1",
+                                    activity_type=self.activity_type, staff=self.staff, package=self.package)
+        reset_fragment_statistics()
+        response = self.client.get("/loads/")
+        self.assertEqual(get_fragment_statistics(), {'hits': 0, 'misses': 1})
+        self.assertContains(response, "123")
+
+    def test_options_cached_separately(self):
+        """Different form options are different cache entries."""
+        self.client.get("/loads/modules/1")
+        reset_fragment_statistics()
+        self.client.get("/loads/modules/2")
+        self.assertEqual(get_fragment_statistics(), {'hits': 0, 'misses': 1})
+
+
+class LoadSimulateTest(TestCase):
+    """Tests the what-if allocation simulator endpoint."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.client = Client()
+
+        category = Category.objects.create(name="Admin", abbreviation="adm", colour="blue")
+        self.activity_type = ActivityType.objects.create(name="Marking", category=category)
+        self.package = WorkPackage.objects.create(name="test", startdate="2024-09-01", enddate="2025-08-31")
+        group = Group.objects.create(name="simulategroup")
+        self.package.groups.add(group)
+
+        user = User.objects.create_user('simulateuser', 'a@b.com', 'password')
+        user.groups.add(group)
+        self.staff = Staff.objects.get(user=user)
+        self.staff.package = self.package
+        self.staff.save()
+        self.activity = Activity.objects.create(name="Marking", hours=10, percentage=0, semester="1",
+                                                activity_type=self.activity_type, staff=self.staff,
+                                                package=self.package)
+
+        self.admin = User.objects.create_superuser('simulateadmin', 'b@b.com', 'password')
+        admin_staff = Staff.objects.get(user=self.admin)
+        admin_staff.package = self.package
+        admin_staff.save()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def post(self, data):
+        return self.client.post(reverse('loads_simulate'), data=data, content_type='application/json')
+
+    def test_simulate(self):
+        """Simulated changes return the loads before and after, and save nothing."""
+        self.client.force_login(self.admin)
+        response = self.post({'changes': [
+            {'action': 'change', 'type': 'activity', 'id': self.activity.pk, 'fields': {'hours': 30}}]})
+        self.assertEqual(response.status_code, 200)
+        staff_loads = response.json()['staff']
+        self.assertEqual(len(staff_loads), 1)
+        self.assertEqual(staff_loads[0]['staff'], self.staff.pk)
+        self.assertEqual(staff_loads[0]['before']['semester_hours'], [10, 10, 0, 0])
+        self.assertEqual(staff_loads[0]['after']['semester_hours'], [30, 30, 0, 0])
+        self.assertEqual(Activity.objects.get(pk=self.activity.pk).hours, 10)
+
+    def test_invalid_requests(self):
+        """Invalid requests are rejected without a server error."""
+        self.client.force_login(self.admin)
+        self.assertEqual(self.client.get(reverse('loads_simulate')).status_code, 405)
+        self.assertEqual(self.post("not json").status_code, 400)
+        self.assertEqual(self.post({'changes': 'all'}).status_code, 400)
+        response = self.post({'changes': [{'action': 'delete', 'type': 'activity', 'id': 999999}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('errors', response.json())
+
+    def test_needs_permission(self):
+        """Staff who can't change allocations can't simulate them."""
+        self.client.force_login(self.staff.user)
+        response = self.post({'changes': []})
+        self.assertNotEqual(response.status_code, 200)
+
+
+class AllocationSolverViewTest(TestCase):
+    """Tests previewing and accepting proposed module allocations."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.client = Client()
+
+        campus = Campus.objects.create(name="campus")
+        category = Category.objects.create(name="Teaching", abbreviation="T", colour="red")
+        self.activity_type = ActivityType.objects.create(name="Lecturing", category=category)
+        self.package = WorkPackage.objects.create(name="test", startdate="2024-09-01", enddate="2025-08-31")
+        group = Group.objects.create(name="solvergroup")
+        self.package.groups.add(group)
+        for counter in range(2):
+            user = User.objects.create_user('solver%u' % counter, 'a@b.com', 'password')
+            user.groups.add(group)
+        self.module = Module.objects.create(module_code="SOL101", module_name="Solving", package=self.package,
+                                            campus=campus, credits=20, number_students=40, semester="1")
+
+        self.admin = User.objects.create_superuser('solveradmin', 'b@b.com', 'password')
+        admin_staff = Staff.objects.get(user=self.admin)
+        admin_staff.package = self.package
+        admin_staff.has_workload = False
+        admin_staff.save()
+        self.client.force_login(self.admin)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_preview_and_accept(self):
+        """Proposals are shown, and only accepted if the package hasn't changed since."""
+        url = reverse('modules_allocation_solver')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "SOL101")
+        generation = response.context['solver'].generation
+        self.assertEqual(ModuleStaff.objects.count(), 0)
+
+        data = {'step': 50, 'activity_type': self.activity_type.pk, 'accept': 'Accept'}
+        response = self.client.post(url, dict(data, generation=generation - 1))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ModuleStaff.objects.count(), 0)
+
+        response = self.client.post(url, dict(data, generation=generation))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(ModuleStaff.objects.filter(module=self.module, activity_type=self.activity_type).count(), 2)
+
+
+class LoadTrendViewTest(TestCase):
+    """Tests the load trend pages."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.client = Client()
+
+        category = Category.objects.create(name="Teaching", abbreviation="T", colour="red")
+        activity_type = ActivityType.objects.create(name="Lecturing", category=category)
+        group = Group.objects.create(name="trendgroup")
+        for year in [2023, 2024]:
+            package = WorkPackage.objects.create(name="year%u" % year, startdate="%u-09-01" % year,
+                                                 enddate="%u-08-31" % (year + 1))
+            package.groups.add(group)
+
+        user = User.objects.create_user('trenduser', 'a@b.com', 'password')
+        user.groups.add(group)
+        self.staff = Staff.objects.get(user=user)
+        self.staff.package = package
+        self.staff.save()
+        Activity.objects.create(name="Lecturing", hours=77, percentage=0, semester="1",
+                                activity_type=activity_type, staff=self.staff, package=package)
+        self.client.force_login(user)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_trend_pages(self):
+        """Both the overview and the single staff pages show each year."""
+        for url in [reverse('loads_trend'), reverse('loads_trend_staff', kwargs={'staff_id': self.staff.pk})]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, "year2023")
+            self.assertContains(response, "77.00")
+
+    def test_trend_pages_read_only(self):
+        """Viewing trends calculates missing load summaries without saving them."""
+        self.assertEqual(StaffLoadSummary.objects.count(), 0)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('loads_trend'))
+        self.assertContains(response, "77.00")
+        self.assertEqual(StaffLoadSummary.objects.count(), 0)
+        self.assertFalse([query for query in queries.captured_queries if 'loadsummary' in query['sql'].lower() and
+                          not query['sql'].startswith('SELECT')])
+
+
+class LoadsModulesQueryTest(TestCase):
+    """Tests the loads by modules table is calculated in a fixed number of queries."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        cache.clear()
+        self.client = Client()
+
+        self.campus = Campus.objects.create(name="campus")
+        category = Category.objects.create(name="Teaching", abbreviation="T", colour="red")
+        self.activity_type = ActivityType.objects.create(name="Lecturing", category=category)
+        self.package = WorkPackage.objects.create(name="test", startdate="2024-09-01", enddate="2025-08-31",
+                                                  nominal_hours=1000)
+        group = Group.objects.create(name="modulesgroup")
+        self.package.groups.add(group)
+
+        self.staff = list()
+        for counter in range(2):
+            user = User.objects.create_user('modules%u' % counter, 'a@b.com', 'password')
+            user.groups.add(group)
+            staff = Staff.objects.get(user=user)
+            staff.package = self.package
+            staff.save()
+            self.staff.append(staff)
+        self.client.force_login(self.staff[0].user)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def add_module(self, counter):
+        module = Module.objects.create(module_code="MOD%03u" % counter, module_name="Module %u" % counter,
+                                       package=self.package, campus=self.campus, credits=20, number_students=40,
+                                       semester="1,2", coordinator=self.staff[0])
+        for staff, proportion in zip(self.staff, [70, 20]):
+            ModuleStaff.objects.create(module=module, staff=staff, package=self.package,
+                                       activity_type=self.activity_type, contact_proportion=proportion,
+                                       admin_proportion=proportion, assessment_proportion=proportion)
+        Activity.objects.create(name="Hours", hours=10, percentage=0, hours_percentage=Activity.HOURS,
+                                semester="1", activity_type=self.activity_type, module=module,
+                                staff=self.staff[0], package=self.package)
+        Activity.objects.create(name="Percentage", hours=0, percentage=2, hours_percentage=Activity.PERCENTAGE,
+                                semester="2", activity_type=self.activity_type, module=module,
+                                staff=self.staff[1], package=self.package)
+        return module
+
+    def get_page(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('loads_modules', kwargs={'semesters': ''}))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_constant_queries(self):
+        """More modules take no more queries, and the totals are correct."""
+        self.add_module(0)
+        response, few = self.get_page()
+        for counter in range(1, 6):
+            self.add_module(counter)
+        response, many = self.get_page()
+        self.assertEqual(few, many)
+
+        module, contact, contact_proportion, admin, admin_proportion, assessment, assessment_proportion, \
+            extra_hours, module_staff = response.context['combined_list'][0]
+        self.assertEqual([contact_proportion, admin_proportion, assessment_proportion], [90, 90, 90])
+        self.assertAlmostEqual(extra_hours, 10 + 2 * 1000 / 100)
+        self.assertEqual(len(module_staff), 2)
+        self.assertContains(response, str(self.staff[1]))
+
+    def test_totals(self):
+        """The totals are summed in the database, and match the rows."""
+        for counter in range(3):
+            self.add_module(counter)
+        response, queries = self.get_page()
+        rows = response.context['combined_list']
+        totals = response.context['totals']
+        self.assertAlmostEqual(totals['contact'], sum(row[1] for row in rows))
+        self.assertAlmostEqual(totals['admin'], sum(row[3] for row in rows))
+        self.assertAlmostEqual(totals['assessment'], sum(row[5] for row in rows))
+        self.assertContains(response, "%6.2f" % totals['contact'])
+
+
+class ModulesIndexQueryTest(TestCase):
+    """Tests the modules index takes a fixed number of queries, and still shows relationships."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        cache.clear()
+        self.client = Client()
+
+        self.campus = Campus.objects.create(name="campus")
+        category = Category.objects.create(name="Teaching", abbreviation="T", colour="red")
+        self.activity_type = ActivityType.objects.create(name="Lecturing", category=category)
+        self.resource_type = AssessmentResourceType.objects.create(name="Exam")
+        self.package = WorkPackage.objects.create(name="test", startdate="2024-09-01", enddate="2025-08-31")
+        self.programme = Programme.objects.create(programme_code="P1", programme_name="Programme",
+                                                  package=self.package)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.submitted = AssessmentState.objects.create(name="Submitted", description="", actors="coordinator",
+                                                            notify="", initial_state=True, priority=1)
+            self.approved = AssessmentState.objects.create(name="Approved", description="", actors="moderator",
+                                                           notify="", priority=2)
+            self.submitted.next_states.add(self.approved)
+
+        user = User.objects.create_user('indexuser', 'a@b.com', 'password')
+        self.staff = Staff.objects.get(user=user)
+        self.staff.package = self.package
+        self.staff.save()
+        other = User.objects.create_user('indexother', 'b@b.com', 'password')
+        self.other = Staff.objects.get(user=other)
+        examiner = User.objects.create_user('indexexaminer', 'c@b.com', 'password')
+        self.examiner = Staff.objects.get(user=examiner)
+        self.examiner.is_external = True
+        self.examiner.save()
+        self.programme.examiners.add(self.examiner)
+        self.client.force_login(user)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def add_module(self, counter, moderator, team):
+        module = Module.objects.create(module_code="IDX%03u" % counter, module_name="Index %u" % counter,
+                                       package=self.package, campus=self.campus, credits=20, number_students=40,
+                                       semester="1", coordinator=self.other, lead_programme=self.programme)
+        module.programmes.add(self.programme)
+        module.moderators.add(moderator)
+        if team:
+            ModuleStaff.objects.create(module=module, staff=self.staff, package=self.package,
+                                       activity_type=self.activity_type, contact_proportion=50,
+                                       admin_proportion=50, assessment_proportion=50)
+        AssessmentResource.objects.create(name="Exam", module=module, resource_type=self.resource_type,
+                                          owner=self.other, resource="exam.pdf")
+        AssessmentStateSignOff.objects.create(module=module, assessment_state=self.submitted,
+                                              signed_by=self.other.user)
+        return module
+
+    def get_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('modules_index', kwargs={'semesters': ''}),
+                                        {'semesters': '', 'programme': self.programme.pk,
+                                         'lead_programme': 'on', 'show_people': 'on'})
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_constant_queries(self):
+        """More modules take no more queries, and each row is as it was before."""
+        self.add_module(0, moderator=self.staff, team=False)
+        # The assessment workflow is loaded once for the process, not for each page
+        self.get_page()
+        response, few = self.get_page()
+        self.add_module(1, moderator=self.other, team=True)
+        for counter in range(2, 6):
+            self.add_module(counter, moderator=self.other, team=False)
+        response, many = self.get_page()
+        self.assertEqual(few, many)
+
+        rows = response.context['combined_list']
+        self.assertEqual(len(rows), 6)
+        (module, relationship, resource, signoff, action_possible, examiners) = rows[0]
+        self.assertEqual(relationship, ['moderator'])
+        self.assertEqual(signoff.assessment_state, self.submitted)
+        self.assertTrue(resource)
+        # Only the moderator may approve
+        self.assertTrue(action_possible)
+        self.assertEqual(list(examiners), [self.examiner])
+        (module, relationship, resource, signoff, action_possible, examiners) = rows[1]
+        self.assertEqual(relationship, ['team_member'])
+        self.assertFalse(action_possible)
+
+
+class TaskCompletionQueryTest(TestCase):
+    """Tests the task pages are built in a fixed number of queries."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.client = Client()
+
+        self.category = Category.objects.create(name="Admin", abbreviation="A", colour="blue")
+        self.group = Group.objects.create(name="faculty")
+        self.task = Task.objects.create(name="Return forms", category=self.category, details="Please",
+                                        deadline="2030-01-01 12:00:00+00:00")
+        self.task.groups.add(self.group)
+        self.staff = list()
+        self.add_staff(2)
+        self.client.force_login(self.staff[0].user)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def add_staff(self, number):
+        for counter in range(len(self.staff), len(self.staff) + number):
+            user = User.objects.create_user('tasks%u' % counter, 'a@b.com', 'password', last_name='Tasks%u' % counter)
+            user.groups.add(self.group)
+            staff = Staff.objects.get(user=user)
+            self.staff.append(staff)
+            if counter % 2:
+                TaskCompletion.objects.create(task=self.task, staff=staff, comment="done")
+
+    def add_task(self, counter):
+        task = Task.objects.create(name="Task %u" % counter, category=self.category, details="Please",
+                                   deadline="2020-01-01 12:00:00+00:00")
+        task.targets.add(self.staff[1])
+        if counter % 2:
+            TaskCompletion.objects.create(task=task, staff=self.staff[1])
+
+    def get_page(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_details_constant_queries(self):
+        """More targets take no more queries"""
+        url = reverse('tasks_details', kwargs={'task_id': self.task.pk})
+        response, few = self.get_page(url)
+        self.add_staff(10)
+        response, many = self.get_page(url)
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.context['combined_list_complete']), 6)
+        self.assertEqual(len(response.context['combined_list_incomplete']), 6)
+        self.assertEqual(response.context['percentage_complete'], 50)
+        self.assertFalse(response.context['overdue'])
+        self.assertFalse(response.context['urgent'])
+
+    def test_completion_page(self):
+        """The completion form shows the task urgency the database found"""
+        url = reverse('tasks_completion', kwargs={'task_id': self.task.pk, 'staff_id': self.staff[0].pk})
+        response, queries = self.get_page(url)
+        self.assertFalse(response.context['urgent'])
+        self.assertFalse(response.context['overdue'])
+        self.assertIn('urgent', response.context['task'].__dict__)
+
+    def test_bystaff_constant_queries(self):
+        """More tasks take no more queries"""
+        url = reverse('tasks_bystaff', kwargs={'staff_id': self.staff[1].pk})
+        response, few = self.get_page(url)
+        for counter in range(10):
+            self.add_task(counter)
+        response, many = self.get_page(url)
+        self.assertEqual(few, many)
+        self.assertEqual([task.name for task, when in response.context['combined_list_complete']],
+                         ["Task %u" % counter for counter in range(1, 10, 2)] + ["Return forms"])
+        incomplete = response.context['combined_list_incomplete']
+        self.assertEqual(len(incomplete), 5)
+        self.assertTrue(all(urgent and overdue for task, urgent, overdue in incomplete))
+
+    def test_index_filters_and_pages(self):
+        """The tasks index classifies, filters and pages tasks in the database"""
+        self.client.force_login(self.staff[1].user)
+        for counter in range(3):
+            self.add_task(counter)
+        response, queries = self.get_page(reverse('tasks_index'))
+        self.assertEqual([(task.name, urgent, overdue) for task, urgent, overdue in response.context['augmented_tasks']],
+                         [("Task 0", True, True), ("Task 1", True, True), ("Task 2", True, True),
+                          ("Return forms", False, False)])
+
+        response, queries = self.get_page(reverse('tasks_index') + '?status=pending')
+        self.assertEqual([task.name for task, urgent, overdue in response.context['augmented_tasks']],
+                         ["Return forms"])
+        response, queries = self.get_page(reverse('tasks_index') + '?status=overdue')
+        self.assertEqual(response.context['page'].paginator.count, 3)
+        self.assertContains(response, "There are 3 overdue open tasks")
+
+        with patch('loads.views.TASKS_PER_PAGE', 2):
+            response, queries = self.get_page(reverse('tasks_index') + '?page=2')
+        self.assertEqual([task.name for task, urgent, overdue in response.context['augmented_tasks']],
+                         ["Task 2", "Return forms"])
+
+        # Tasks sharing a deadline appear once each across the pages
+        for counter in range(3, 8):
+            self.add_task(counter)
+        names = list()
+        with patch('loads.views.TASKS_PER_PAGE', 3):
+            for page in range(1, 4):
+                response, queries = self.get_page(reverse('tasks_index') + '?page=%u' % page)
+                names += [task.name for task, urgent, overdue in response.context['augmented_tasks']]
+        self.assertEqual(names, ["Task %u" % counter for counter in range(8)] + ["Return forms"])
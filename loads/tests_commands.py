@@ -1,11 +1,18 @@
 # Standard Imports
 from io import StringIO
 import logging
+import multiprocessing
+from unittest import skipUnless
+from unittest.mock import patch
 
 from django.core.exceptions import PermissionDenied
 # Django specific Imports
 from django.test import TestCase, override_settings
 from django.core.management import call_command
+from django.core.cache import cache
+from django.core import mail
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.test import Client
 from django.urls import reverse
 
@@ -27,9 +34,11 @@ from .models import Category
 from .models import Campus
 from .models import ExternalExaminer
 from .models import Staff
+from .models import StaffLoadSummary
 from .models import Task
 from .models import Activity
 from .models import TaskCompletion
+from .models import TaskReminderState
 from .models import Module
 from .models import ModuleSize
 from .models import ModuleStaff
@@ -38,6 +47,8 @@ from .models import Project
 from .models import ProjectStaff
 from .models import WorkPackage
 
+from .caching import get_fragment_statistics
+
 
 class CommandsTestCase(TestCase):
 
@@ -85,3 +96,265 @@ class CommandsTestCase(TestCase):
         call_command('populate_database', stdout=out, *args, **opts)
         self.assertIn("Complete.", out.getvalue())
 
+
+class RebuildLoadSummariesTestCase(TestCase):
+    """Test the rebuild_load_summaries command creates and repairs summaries"""
+
+    def setUp(self):
+        # Logging is very noisy typically
+        logging.disable(logging.CRITICAL)
+
+        self.package = WorkPackage.objects.create(name="2017-2018", startdate="2017-09-01", enddate="2018-08-31")
+        self.group = Group.objects.create(name="Staff")
+        self.package.groups.add(self.group)
+        category = Category.objects.create(name="Teaching")
+        activity_type = ActivityType.objects.create(name="Lecturing", category=category)
+
+        self.staff = []
+        for number in range(3):
+            user = User.objects.create_user(username="staff{}".format(number), password="test")
+            user.groups.add(self.group)
+            staff = Staff.objects.get(user=user)
+            Activity.objects.create(name="Lecturing", hours=10 * (number + 1), percentage=0, hours_percentage="H",
+                                    semester="1,2", activity_type=activity_type, staff=staff, package=self.package)
+            self.staff.append(staff)
+
+    def tearDown(self):
+        # Put the logging back in place
+        logging.disable(logging.NOTSET)
+
+    def test_rebuild_creates_and_repairs(self):
+        """Missing summaries are created, drifted ones repaired, and check-only changes nothing"""
+        out = StringIO()
+        call_command('rebuild_load_summaries', stdout=out)
+        self.assertIn("3 summaries created, 0 summaries repaired", out.getvalue())
+
+        # Force drift behind the back of the signals
+        StaffLoadSummary.objects.filter(staff=self.staff[0]).update(total_hours=999)
+
+        generation = WorkPackage.objects.get(pk=self.package.pk).generation
+        out = StringIO()
+        call_command('rebuild_load_summaries', '--check-only', stdout=out)
+        self.assertIn("0 summaries missing, 1 summaries drifted", out.getvalue())
+        self.assertEqual(StaffLoadSummary.objects.get(staff=self.staff[0]).total_hours, 999)
+        self.assertEqual(WorkPackage.objects.get(pk=self.package.pk).generation, generation)
+
+        # Repairs mark cached pages of the package as out of date
+        out = StringIO()
+        call_command('rebuild_load_summaries', '--package', str(self.package.pk), stdout=out)
+        self.assertIn("0 summaries created, 1 summaries repaired", out.getvalue())
+        summary = StaffLoadSummary.objects.get(staff=self.staff[0])
+        self.assertEqual(summary.hours_by_semester(), self.staff[0].hours_by_semester(package=self.package))
+        generation += 1
+        self.assertEqual(WorkPackage.objects.get(pk=self.package.pk).generation, generation)
+
+        # And if nothing changes, neither does the generation
+        call_command('rebuild_load_summaries', stdout=StringIO())
+        self.assertEqual(WorkPackage.objects.get(pk=self.package.pk).generation, generation)
+
+
+class WarmLoadCachesTestCase(TestCase):
+    """Test the warm_load_caches command fills the cache for active packages only"""
+
+    def setUp(self):
+        # Logging is very noisy typically
+        logging.disable(logging.CRITICAL)
+        cache.clear()
+
+        self.package = WorkPackage.objects.create(name="2017-2018", startdate="2017-09-01", enddate="2018-08-31")
+        self.archived = WorkPackage.objects.create(name="2016-2017", startdate="2016-09-01", enddate="2017-08-31",
+                                                   archive=True)
+
+    def tearDown(self):
+        # Put the logging back in place
+        logging.disable(logging.NOTSET)
+
+    def test_warm_caches(self):
+        """Active packages are warmed, and warming again finds everything cached"""
+        out = StringIO()
+        call_command('warm_load_caches', stdout=out)
+        self.assertIn("1 packages warmed", out.getvalue())
+        self.assertIn(str(self.package), out.getvalue())
+        self.assertNotIn(str(self.archived), out.getvalue())
+        self.assertEqual(get_fragment_statistics(), {'hits': 0, 'misses': 3})
+
+        call_command('warm_load_caches', stdout=StringIO())
+        self.assertEqual(get_fragment_statistics(), {'hits': 3, 'misses': 3})
+
+    def test_warm_caches_creates_summaries(self):
+        """Missing load summaries, as after upgrading, are created before the pages are cached"""
+        group = Group.objects.create(name="warmed")
+        self.package.groups.add(group)
+        category = Category.objects.create(name="Teaching")
+        activity_type = ActivityType.objects.create(name="Lecturing", category=category)
+        user = User.objects.create_user(username="warmed", password="test")
+        user.groups.add(group)
+        staff = Staff.objects.get(user=user)
+        Activity.objects.create(name="Lecturing", hours=42, percentage=0, hours_percentage="H", semester="1",
+                                activity_type=activity_type, staff=staff, package=self.package)
+        StaffLoadSummary.objects.all().delete()
+
+        out = StringIO()
+        call_command('warm_load_caches', stdout=out)
+        self.assertIn("1 load summaries created", out.getvalue())
+        self.assertEqual(StaffLoadSummary.objects.get(staff=staff, package=self.package).total_hours, 42)
+
+        # The pages were cached under the generation after the summaries were created
+        out = StringIO()
+        call_command('warm_load_caches', stdout=out)
+        self.assertNotIn("load summaries created", out.getvalue())
+        self.assertEqual(get_fragment_statistics(), {'hits': 3, 'misses': 3})
+
+    @skipUnless('fork' in multiprocessing.get_all_start_methods(), "workers must share the test database")
+    def test_warm_caches_in_workers(self):
+        """Packages are warmed by a pool of workers into the shared cache"""
+        WorkPackage.objects.create(name="2018-2019", startdate="2018-09-01", enddate="2019-08-31")
+        out = StringIO()
+        # The test database only exists in the memory of this process, which only forked workers can see
+        with patch('loads.workers.START_METHOD', 'fork'):
+            call_command('warm_load_caches', '--workers', '2', stdout=out)
+        self.assertIn("2 packages warmed", out.getvalue())
+        self.assertEqual(get_fragment_statistics()['hits'], 0)
+
+        # This process finds everything the workers cached, and can still use its own database connection
+        call_command('warm_load_caches', '--workers', '1', stdout=StringIO())
+        self.assertEqual(get_fragment_statistics()['hits'], 6)
+
+
+class EmailRemindersTestCase(TestCase):
+    """Test the email_reminders command reminds active staff of outstanding tasks only"""
+
+    def setUp(self):
+        # Logging is very noisy typically
+        logging.disable(logging.CRITICAL)
+
+        self.category = Category.objects.create(name="Admin", abbreviation="admin", colour="blue")
+        self.group = Group.objects.create(name="reminded")
+        self.staff = list()
+        self.add_staff(4)
+        self.staff[3].user.is_active = False
+        self.staff[3].user.save()
+
+        # An urgent task for the group, done by staff 1, and a distant one for staff 2 only
+        self.urgent = Task.objects.create(name="Urgent", category=self.category, details="Soon",
+                                          deadline="2020-01-01 12:00:00+00:00")
+        self.urgent.groups.add(self.group)
+        TaskCompletion.objects.create(task=self.urgent, staff=self.staff[1])
+        self.distant = Task.objects.create(name="Distant", category=self.category, details="Later",
+                                           deadline="2100-01-01 12:00:00+00:00")
+        self.distant.targets.add(self.staff[2])
+        archived = Task.objects.create(name="Archived", category=self.category, details="Gone", archive=True,
+                                       deadline="2020-01-01 12:00:00+00:00")
+        archived.groups.add(self.group)
+
+    def tearDown(self):
+        # Put the logging back in place
+        logging.disable(logging.NOTSET)
+
+    def add_staff(self, number):
+        for counter in range(len(self.staff), len(self.staff) + number):
+            user = User.objects.create(username="remind%u" % counter, email="remind%u@invalid.com" % counter)
+            user.groups.add(self.group)
+            self.staff.append(Staff.objects.get(user=user))
+
+    def test_reminders(self):
+        """Only active staff with outstanding tasks are reminded, in batches"""
+        out = StringIO()
+        call_command('email_reminders', '--workers', '1', '--batch-size', '1', '-v', '2', stdout=out)
+        self.assertIn("2 reminder(s) sent", out.getvalue())
+        for stage in ['resolved', 'rendered', 'sent']:
+            self.assertIn("{} 2 reminder(s)".format(stage), out.getvalue())
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ["remind0@invalid.com", "remind2@invalid.com"])
+        for message in mail.outbox:
+            self.assertEqual(message.subject, 'URGENT: Your task reminders')
+            self.assertIn("Urgent", message.body)
+            self.assertNotIn("Archived", message.body)
+        self.assertIn("Distant", [message for message in mail.outbox if message.to == ["remind2@invalid.com"]][0].body)
+
+    def test_urgent_and_test_only(self):
+        """Urgent only skips staff with nothing urgent, and test mode sends nothing"""
+        TaskCompletion.objects.create(task=self.urgent, staff=self.staff[2])
+        out = StringIO()
+        call_command('email_reminders', '--urgent-only', '--workers', '1', stdout=out)
+        self.assertIn("1 reminder(s) sent", out.getvalue())
+        self.assertEqual([message.to for message in mail.outbox], [["remind0@invalid.com"]])
+
+        call_command('email_reminders', '--test-only', '--workers', '1', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+    @patch('loads.workers.START_METHOD', 'spawn')
+    @patch('loads.management.commands.email_reminders.RENDER_CHUNK_SIZE', 1)
+    def test_reminders_in_workers(self):
+        """Rendering in spawned workers gives the same emails, and leaves this process's database usable"""
+        call_command('email_reminders', '--workers', '1', stdout=StringIO())
+        expected = sorted((message.to, message.subject, message.body) for message in mail.outbox)
+        mail.outbox = []
+
+        out = StringIO()
+        call_command('email_reminders', '--workers', '2', stdout=out)
+        self.assertIn("2 reminder(s) sent", out.getvalue())
+        self.assertEqual(sorted((message.to, message.subject, message.body) for message in mail.outbox), expected)
+        self.assertEqual(Staff.objects.filter(pk__in=[staff.pk for staff in self.staff]).count(), 4)
+
+    def test_unsent_batches(self):
+        """Emails are only reported, and recorded, once the mail connection says they were sent"""
+        out = StringIO()
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', return_value=0):
+            call_command('email_reminders', '--incremental', '--workers', '1', stdout=out)
+        self.assertIn("0 reminder(s) sent", out.getvalue())
+        self.assertNotIn("Email sent to", out.getvalue())
+        self.assertEqual(TaskReminderState.objects.count(), 0)
+
+        # Staff without an email address are skipped
+        self.staff[0].user.email = ""
+        self.staff[0].user.save()
+        out = StringIO()
+        call_command('email_reminders', '--incremental', '--workers', '1', stdout=out)
+        self.assertIn("1 reminder(s) sent", out.getvalue())
+        self.assertIn("Email sent to", out.getvalue())
+        self.assertEqual(list(TaskReminderState.objects.values_list('staff', flat=True)), [self.staff[2].pk])
+
+    def test_constant_queries(self):
+        """More staff take no more queries"""
+        with CaptureQueriesContext(connection) as few:
+            call_command('email_reminders', '--workers', '1', stdout=StringIO())
+        self.add_staff(10)
+        with CaptureQueriesContext(connection) as many:
+            call_command('email_reminders', '--workers', '1', stdout=StringIO())
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(len(mail.outbox), 2 + 12)
+
+    def test_incremental(self):
+        """Incremental mode only emails staff whose reminders changed, or are due again"""
+        call_command('email_reminders', '--incremental', '--workers', '1', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(TaskReminderState.objects.count(), 2)
+
+        # Nothing has changed
+        out = StringIO()
+        call_command('email_reminders', '--incremental', '--workers', '1', stdout=out)
+        self.assertIn("0 reminder(s) sent", out.getvalue())
+        self.assertEqual(len(mail.outbox), 2)
+
+        # A new task for staff 0, and staff 2 completes their urgent task so has only the distant one left
+        task = Task.objects.create(name="New", category=self.category, details="New",
+                                   deadline="2100-01-01 12:00:00+00:00")
+        task.targets.add(self.staff[0])
+        TaskCompletion.objects.create(task=self.urgent, staff=self.staff[2])
+        call_command('email_reminders', '--incremental', '--workers', '1', stdout=StringIO())
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox[2:]),
+                         ["remind0@invalid.com", "remind2@invalid.com"])
+
+        # The distant task is done, so staff 2 is forgotten, but staff 0 is due again once the interval passes
+        TaskCompletion.objects.create(task=self.distant, staff=self.staff[2])
+        call_command('email_reminders', '--incremental', '--workers', '1', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertFalse(TaskReminderState.objects.filter(staff=self.staff[2]).exists())
+        call_command('email_reminders', '--incremental', '--interval', '0', '--workers', '1', stdout=StringIO())
+        self.assertEqual([message.to for message in mail.outbox[4:]], [["remind0@invalid.com"]])
+
+        # Without incremental mode, everyone outstanding is emailed
+        call_command('email_reminders', '--workers', '1', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 6)
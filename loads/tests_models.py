@@ -1,17 +1,28 @@
 # Standard Imports
+import datetime
+import importlib
 from io import StringIO
 import logging
+from unittest.mock import patch
 
 from django.core.exceptions import PermissionDenied
+from django.core.exceptions import ValidationError
 # Django specific Imports
 from django.test import TestCase, override_settings
+from django.core.cache import cache
 from django.core.management import call_command
 from django.test import Client
 from django.urls import reverse
 
 # Import Some Django models that we use
 
+from django.apps import apps as django_apps
 from django.contrib.auth.models import User, Group
+from django.db import connection
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+
+from simpleeval import simple_eval
 
 
 # Import some models
@@ -23,6 +34,9 @@ from .models import Activity
 from .models import AssessmentResource
 from .models import AssessmentResourceType
 from .models import AssessmentStaff
+from .models import AssessmentStateSignOff
+from .models import AssessmentState
+from .models import AssessmentWorkflow
 from .models import Category
 from .models import Campus
 from .models import ExternalExaminer
@@ -30,19 +44,43 @@ from .models import Staff
 from .models import Task
 from .models import Activity
 from .models import TaskCompletion
+from .models import TaskTarget
 from .models import Module
 from .models import ModuleSize
 from .models import ModuleStaff
+from .models import ModuleRelationships
 from .models import Programme
 from .models import Project
 from .models import ProjectStaff
 from .models import WorkPackage
+from .models import PackageLoadEngine
+from .models import StaffLoadSummary
+from .models import ModuleHours
+from .models import LoadMatrix
+from .models import LoadSimulator
+from .models import LoadTrend
+from .forms import AllocationSolverForm
+from .allocation_solver import AllocationSolver
+from .allocation_solver import solve_allocation
+from .formula_engine import FormulaError
+from .formula_engine import ALLOWED_FUNCTIONS
+from .formula_engine import _evaluate
+from .formula_engine import compile_formula
+from .formula_engine import formula_to_expression
+from .validators import validate_formula
+from .helpers import divide_by_semesters
+from .helpers import divide_by_semester_mask
+from .helpers import overlapping_semester_masks
+from .helpers import semester_mask
+from .helpers import CacheVersion
 
 
 class WorkPackageMigrationTestCase(TestCase):
     def setUp(self):
         # Logging is very noisy typically
         logging.disable(logging.CRITICAL)
+        # Examiner access is cached across tests, whose changes are never committed to invalidate it
+        cache.clear()
 
         # Create a workpackage
         package = WorkPackage.objects.create(name="source", startdate="2017-09-01", enddate="2018-08-31")
@@ -415,6 +453,8 @@ class AssessmentResourceTestCase(TestCase):
     def setUp(self):
         # Logging is very noisy typically
         logging.disable(logging.CRITICAL)
+        # Examiner access is cached across tests, whose changes are never committed to invalidate it
+        cache.clear()
 
         # Create a workpackage
         package = WorkPackage.objects.create(name="test", startdate="2017-09-01", enddate="2018-08-31")
@@ -602,6 +642,238 @@ class AssessmentResourceTestCase(TestCase):
         self.assertEqual(resource.is_downloadable_by_staff(other_examiner), False)
         self.assertEqual(resource.is_downloadable_by_external(other_examiner), False)
 
+    def test_module_relationships(self):
+        module = Module.objects.get(module_code="ABC101")
+        expected = {
+            "academicA": ModuleRelationships.COORDINATOR,
+            "academicB": ModuleRelationships.TEAM_MEMBER,
+            "academicC": 0,
+            "academicD": ModuleRelationships.MODERATOR,
+            "assessmentstaffA": ModuleRelationships.ASSESSMENT_STAFF,
+        }
+        for username, roles in expected.items():
+            staff = Staff.objects.get(user__username=username)
+            relationships = ModuleRelationships.get_for_staff(staff, module.package_id)
+            self.assertEqual(relationships.get_roles(module), roles)
+
+        # Roles are combined, and the resolver is kept on the Staff object
+        coordinator = Staff.objects.get(user__username="academicA")
+        module.moderators.add(coordinator)
+        relationships = ModuleRelationships.get_for_module(coordinator, module)
+        self.assertEqual(relationships.get_roles(module), ModuleRelationships.COORDINATOR | ModuleRelationships.MODERATOR)
+        self.assertIs(ModuleRelationships.get_for_module(coordinator, module), relationships)
+
+    def test_module_relationships_queries(self):
+        module = Module.objects.get(module_code="ABC101")
+        resource = AssessmentResource.objects.select_related('module').get(name="test")
+        with self.captureOnCommitCallbacks(execute=True):
+            state = AssessmentState.objects.create(name="Checked", actors="moderator,assessment_staff", priority=1)
+        moderator = Staff.objects.select_related('user').get(user__username="academicD")
+        team_member = Staff.objects.select_related('user').get(user__username="academicB")
+
+        # The relationships are found once, and then any number of checks need no more queries
+        AssessmentWorkflow.get()
+        with CaptureQueriesContext(connection) as queries:
+            for counter in range(10):
+                self.assertTrue(resource.is_downloadable_by_staff(moderator))
+                self.assertTrue(state.can_be_set_by_staff(moderator, module))
+        self.assertEqual(len(queries), 2)
+
+        self.assertTrue(resource.is_downloadable_by_staff(team_member))
+        self.assertFalse(state.can_be_set_by_staff(team_member, module))
+
+    def test_assessment_workflow(self):
+        module = Module.objects.get(module_code="ABC101")
+        moderator = Staff.objects.select_related('user').get(user__username="academicD")
+        lead_examiner = Staff.objects.select_related('user').get(user__username="externalA")
+        with self.captureOnCommitCallbacks(execute=True):
+            submitted = AssessmentState.objects.create(name="Submitted", actors="coordinator", notify="moderator",
+                                                       initial_state=True, priority=1)
+            moderated = AssessmentState.objects.create(name="Moderated", actors="moderator",
+                                                       notify="coordinator,external", priority=2)
+            examined = AssessmentState.objects.create(name="Examined", actors="external", notify="anyone",
+                                                      priority=3)
+            submitted.next_states.add(examined, moderated)
+
+        workflow = AssessmentWorkflow.get()
+        self.assertIs(AssessmentWorkflow.get(), workflow)
+        self.assertEqual(workflow.states[moderated.pk].actors, AssessmentWorkflow.MODERATOR)
+        self.assertEqual(workflow.states[moderated.pk].notify, AssessmentWorkflow.COORDINATOR | AssessmentWorkflow.EXTERNAL)
+        self.assertEqual([state.pk for state in workflow.get_next_states()], [submitted.pk])
+        self.assertEqual([state.pk for state in workflow.get_next_states(submitted.pk)], [moderated.pk, examined.pk])
+        self.assertEqual([state.pk for state in workflow.get_settable_states(moderator, module, submitted.pk)],
+                         [moderated.pk])
+        self.assertEqual([state.pk for state in workflow.get_settable_states(lead_examiner, module, submitted.pk)],
+                         [examined.pk])
+
+        # Once loaded, checks need no queries
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(moderated.can_be_set_by(moderator, module))
+            self.assertFalse(examined.can_be_set_by(moderator, module))
+            self.assertTrue(examined.can_be_set_by(lead_examiner, module))
+        self.assertEqual(len(queries), 0)
+
+        # Changes to states or transitions load it again, but only once they are committed
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            moderated.actors = "moderator,external"
+            moderated.save()
+            self.assertIs(AssessmentWorkflow.get(), workflow)
+            self.assertFalse(moderated.can_be_set_by(lead_examiner, module))
+        self.assertEqual(callbacks, [AssessmentWorkflow.invalidate])
+        self.assertTrue(moderated.can_be_set_by(lead_examiner, module))
+        with self.captureOnCommitCallbacks(execute=True):
+            submitted.next_states.remove(examined)
+        self.assertEqual([state.pk for state in AssessmentWorkflow.get().get_next_states(submitted.pk)], [moderated.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            examined.delete()
+        self.assertNotIn(examined.pk, AssessmentWorkflow.get().states)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_assessment_workflow_unshared_cache(self):
+        """Other processes can't see changes through a local memory cache, so the workflow is never kept"""
+        state = AssessmentState.objects.create(name="Submitted", actors="coordinator", notify="moderator",
+                                               initial_state=True, priority=1)
+        self.assertFalse(CacheVersion.is_shared())
+        self.assertIsNone(AssessmentWorkflow.VERSION.get())
+        workflow = AssessmentWorkflow.get()
+        self.assertIsNot(AssessmentWorkflow.get(), workflow)
+
+        # A change made elsewhere, with no signal to invalidate the workflow here
+        AssessmentState.objects.filter(pk=state.pk).update(actors="moderator")
+        self.assertEqual(AssessmentWorkflow.get().states[state.pk].actors, AssessmentWorkflow.MODERATOR)
+
+    def test_assessment_history(self):
+        module = Module.objects.get(module_code="ABC101")
+        resource_type = AssessmentResourceType.objects.get(name="exam")
+        owner = Staff.objects.get(user__username="academicC")
+        state = AssessmentState.objects.create(name="Checked", actors="anyone", notify="anyone", priority=1)
+        user = User.objects.get(username="academicA")
+        start = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+
+        # Resources and sign offs on alternate days, with the resource from setUp first
+        AssessmentResource.objects.filter(name="test").update(created=start)
+        items = dict()
+        for day, name in [(1, "signoff1"), (2, "resource2"), (3, "resource3"), (4, "signoff2"), (5, "signoff3"),
+                          (6, "resource6")]:
+            if name.startswith("signoff"):
+                item = AssessmentStateSignOff.objects.create(module=module, assessment_state=state,
+                                                             signed_by=user, notes=name)
+                AssessmentStateSignOff.objects.filter(pk=item.pk).update(
+                    created=start + datetime.timedelta(days=day))
+            else:
+                item = AssessmentResource.objects.create(name=name, module=module, owner=owner,
+                                                         resource_type=resource_type)
+                AssessmentResource.objects.filter(pk=item.pk).update(created=start + datetime.timedelta(days=day))
+            items[name] = item.pk
+
+        with CaptureQueriesContext(connection) as queries:
+            history = module.get_assessment_history()
+        self.assertEqual(len(queries), 2)
+        self.assertEqual([(signoff.notes if signoff else None, [resource.name for resource in resources])
+                          for signoff, resources in history],
+                         [(None, ["resource6"]), ("signoff3", []), ("signoff2", ["resource3", "resource2"]),
+                          ("signoff1", ["test"])])
+
+        # Many modules at once, including one with no history
+        other = Module.objects.create(module_code="ABC102", module_name="Mending Things", package=module.package,
+                                      campus=module.campus, size=module.size, number_students=10)
+        AssessmentResource.objects.create(name="other", module=other, owner=owner, resource_type=resource_type)
+        empty = Module.objects.create(module_code="ABC103", module_name="Watching Things", package=module.package,
+                                      campus=module.campus, size=module.size, number_students=10)
+        histories = Module.get_assessment_histories([module, other, empty])
+        self.assertEqual([(signoff.notes if signoff else None, [resource.name for resource in resources])
+                          for signoff, resources in histories[module.pk]],
+                         [(None, ["resource6"]), ("signoff3", []), ("signoff2", ["resource3", "resource2"]),
+                          ("signoff1", ["test"])])
+        self.assertEqual([(signoff, [resource.name for resource in resources])
+                          for signoff, resources in histories[other.pk]], [(None, ["other"])])
+        self.assertEqual(histories[empty.pk], [])
+
+    def test_examined_module_ids(self):
+        module = Module.objects.get(module_code="ABC101")
+        lead_examiner = Staff.objects.get(user__username="externalA")
+        associate_examiner = Staff.objects.get(user__username="externalB")
+        other_examiner = Staff.objects.get(user__username="externalC")
+
+        self.assertEqual(lead_examiner.get_examined_module_ids(), frozenset([module.pk]))
+        self.assertEqual(associate_examiner.get_examined_module_ids(), frozenset([module.pk]))
+        self.assertEqual(other_examiner.get_examined_module_ids(), frozenset())
+
+        # Once cached, checking many modules needs no queries
+        with CaptureQueriesContext(connection) as queries:
+            for counter in range(10):
+                self.assertTrue(lead_examiner.can_examine_module(module))
+        self.assertEqual(len(queries), 0)
+
+        # And access is shared by other objects for the same examiner, as in later requests
+        lead_examiner = Staff.objects.get(user__username="externalA")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(lead_examiner.can_examine_module(module))
+        self.assertEqual(len(queries), 0)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_examined_module_ids_unshared_cache(self):
+        """Without a shared cache, access is only kept on each Staff object"""
+        module = Module.objects.get(module_code="ABC101")
+        for counter in range(2):
+            lead_examiner = Staff.objects.get(user__username="externalA")
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(lead_examiner.can_examine_module(module))
+                self.assertTrue(lead_examiner.can_examine_module(module))
+            self.assertEqual(len(queries), 1)
+
+    def test_examined_module_ids_invalidation(self):
+        """Committed changes to examiners, programmes and lead programmes are seen by later requests"""
+        module = Module.objects.get(module_code="ABC101")
+        lead_programme = Programme.objects.get(programme_code="123")
+        other_programme = Programme.objects.get(programme_code="456")
+
+        def can_examine(username):
+            return Staff.objects.get(user__username=username).can_examine_module(module)
+
+        self.assertFalse(can_examine("externalC"))
+
+        # The same object keeps what it found, and other processes are only told once changes are committed
+        other_examiner = Staff.objects.get(user__username="externalC")
+        self.assertFalse(other_examiner.can_examine_module(module))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            other_programme.examiners.add(other_examiner)
+            self.assertFalse(can_examine("externalC"))
+        self.assertEqual(callbacks, [Staff.invalidate_examined_modules])
+        self.assertFalse(other_examiner.can_examine_module(module))
+
+        # Examiners of programmes
+        self.assertTrue(can_examine("externalC"))
+        with self.captureOnCommitCallbacks(execute=True):
+            other_programme.examiners.clear()
+        self.assertFalse(can_examine("externalC"))
+        self.assertFalse(can_examine("externalB"))
+
+        # Programmes of modules
+        with self.captureOnCommitCallbacks(execute=True):
+            other_programme.examiners.add(Staff.objects.get(user__username="externalB"))
+        self.assertTrue(can_examine("externalB"))
+        with self.captureOnCommitCallbacks(execute=True):
+            module.programmes.remove(other_programme)
+        self.assertFalse(can_examine("externalB"))
+
+        # Lead programmes
+        self.assertTrue(can_examine("externalA"))
+        with self.captureOnCommitCallbacks(execute=True):
+            module.programmes.remove(lead_programme)
+        self.assertTrue(can_examine("externalA"))
+        with self.captureOnCommitCallbacks(execute=True):
+            module.lead_programme = other_programme
+            module.save()
+        self.assertFalse(can_examine("externalA"))
+        self.assertTrue(can_examine("externalB"))
+
+        # Deleted programmes
+        with self.captureOnCommitCallbacks(execute=True):
+            other_programme.delete()
+        module = Module.objects.get(pk=module.pk)
+        self.assertFalse(can_examine("externalB"))
+
 
 class UserCreationTestCase(TestCase):
     """Tests for user creation functionality"""
@@ -856,3 +1128,833 @@ class StaffTestCase(TestCase):
         self.assertEqual(len(staff.get_all_packages()), 2)
         self.assertEqual(len(staff.get_all_staff_in_all_packages()), 4)
 
+
+
+class LoadDataTestCase(TestCase):
+    """A base for tests needing a package with a realistic mix of allocations"""
+
+    def setUp(self):
+        # Logging is very noisy typically
+        logging.disable(logging.CRITICAL)
+
+        campus = Campus.objects.create(name="campus")
+        teaching = Category.objects.create(name="Teaching", abbreviation="T", colour="red")
+        admin = Category.objects.create(name="Admin", abbreviation="A", colour="blue")
+        Category.objects.create(name="Research", abbreviation="R", colour="green")
+        lecturing = ActivityType.objects.create(name="Lecturing", category=teaching)
+        coordination = ActivityType.objects.create(name="Coordination", category=admin)
+
+        self.package = WorkPackage.objects.create(
+            name="engine", startdate="2024-09-01", enddate="2025-08-31",
+            contact_formula='credits * 1.7 + sqrt(students)',
+            admin_formula='contact * 0.3',
+            assessment_formula='students * 0.45 + admin / 3',
+            coordinator_formula='15 + students * 0.01',
+            coordinator_activity_type=coordination)
+        other_package = WorkPackage.objects.create(name="other", startdate="2024-09-01", enddate="2025-08-31")
+
+        groupA = Group.objects.create(name="engineA")
+        groupB = Group.objects.create(name="engineB")
+        self.package.groups.add(groupA)
+        self.package.groups.add(groupB)
+
+        self.staff = list()
+        for counter in range(6):
+            user = User.objects.create(username="engine%u" % counter, last_name="Staff%u" % counter)
+            # The last member of staff is in both groups
+            user.groups.add(groupA if counter % 2 else groupB)
+            if counter == 5:
+                user.groups.add(groupA, groupB)
+            self.staff.append(Staff.objects.get(user=user))
+
+        modules = list()
+        for counter, semester in enumerate(["1", "2", "1,2", "1,2,3", "3"]):
+            modules.append(Module.objects.create(
+                module_code="ENG10%u" % counter, module_name="Engine %u" % counter,
+                package=self.package, campus=campus, credits=10 + 10 * counter,
+                number_students=17 + 31 * counter, semester=semester,
+                coordinator=self.staff[counter]))
+        # One module has its contact hours overridden
+        modules[2].contact_hours = 33
+        modules[2].save()
+
+        for counter, module in enumerate(modules):
+            for offset, proportion in [(0, 60), (1, 40)]:
+                ModuleStaff.objects.create(
+                    module=module, staff=self.staff[(counter + offset) % len(self.staff)],
+                    package=self.package, activity_type=lecturing,
+                    contact_proportion=proportion, admin_proportion=proportion, assessment_proportion=100 - proportion)
+
+        for counter, staff in enumerate(self.staff):
+            Activity.objects.create(name="Hours %u" % counter, hours=13 * counter, percentage=0,
+                                    hours_percentage=Activity.HOURS, semester="1,3",
+                                    activity_type=lecturing, staff=staff, package=self.package)
+            Activity.objects.create(name="Percentage %u" % counter, hours=0, percentage=3 + counter,
+                                    hours_percentage=Activity.PERCENTAGE, semester="2",
+                                    activity_type=coordination, staff=staff, package=self.package)
+
+        # Noise in another package that should never be counted
+        Activity.objects.create(name="Elsewhere", hours=100, percentage=0, semester="1",
+                                activity_type=lecturing, staff=self.staff[0], package=other_package)
+
+    def tearDown(self):
+        # Put the logging back in place
+        logging.disable(logging.NOTSET)
+
+
+class PackageLoadEngineTestCase(LoadDataTestCase):
+    """Tests that package wide load calculation matches the per staff methods"""
+
+    def test_engine_matches_staff_methods(self):
+        """The engine must give exactly the same figures as the per staff methods"""
+        engine = PackageLoadEngine(self.package)
+        for staff in self.staff:
+            self.assertEqual(engine.hours_by_semester(staff), staff.hours_by_semester(package=self.package))
+            self.assertEqual(engine.hours_by_category(staff), staff.hours_by_category(package=self.package))
+            self.assertEqual(list(engine.hours_by_category(staff).keys()),
+                             list(staff.hours_by_category(package=self.package).keys()))
+
+    def test_hours_batch_matches_modules(self):
+        """Batch calculated module hours must match the per module methods, respecting overrides"""
+        module = Module.objects.get(module_code="ENG101")
+        # A duplicate of an existing module, with an admin override and no coordinator
+        module.pk = None
+        module.module_code = "ENG199"
+        module.admin_hours = 12
+        module.coordinator = None
+        module.save()
+
+        modules = Module.objects.filter(package=self.package).select_related('package')
+        module_hours = Module.get_hours_batch(modules)
+        for module in Module.objects.filter(package=self.package):
+            hours = module_hours[module.pk]
+            self.assertEqual(hours.contact, module.get_contact_hours())
+            self.assertEqual(hours.admin, module.get_admin_hours())
+            self.assertEqual(hours.assessment, module.get_assessment_hours())
+            self.assertEqual(hours.coordinator, module.get_coordinator_hours())
+            self.assertEqual(hours.contact_by_semester, module.get_contact_hours_by_semester())
+            self.assertEqual(hours.coordinator_by_semester, module.get_coordinator_hours_by_semester())
+
+    def test_engine_restricted_to_staff(self):
+        """An engine restricted to one member of staff gives the same figures for them"""
+        staff = self.staff[2]
+        engine = PackageLoadEngine(self.package, staff=staff)
+        self.assertEqual(engine.hours_by_semester(staff), staff.hours_by_semester(package=self.package))
+        self.assertEqual(engine.get_activities(self.staff[3]), list())
+
+    def test_engine_group_staff(self):
+        """Groups should contain the right staff in last name order"""
+        engine = PackageLoadEngine(self.package)
+        group_staff = dict(self.package.get_group_staff())
+        groupA = Group.objects.get(name="engineA")
+        groupB = Group.objects.get(name="engineB")
+        self.assertEqual(group_staff[groupA], [self.staff[1], self.staff[3], self.staff[5]])
+        self.assertEqual(group_staff[groupB], [self.staff[0], self.staff[2], self.staff[4], self.staff[5]])
+
+    def test_engine_fixed_queries(self):
+        """The number of queries should not depend on the number of staff or modules"""
+        with self.assertNumQueries(7):
+            engine = PackageLoadEngine(self.package)
+            for group, staff_list in self.package.get_group_staff():
+                for staff in staff_list:
+                    engine.hours_by_semester(staff)
+                    engine.hours_by_category(staff)
+
+
+class StaffLoadSummaryTestCase(LoadDataTestCase):
+    """Tests that staff load summaries are created and kept up to date"""
+
+    def assertSummariesCurrent(self):
+        """Check every summary in the package matches the live calculation"""
+        categories = list(Category.objects.all())
+        for summary in StaffLoadSummary.objects.filter(package=self.package).select_related('staff'):
+            staff = summary.staff
+            self.assertEqual(summary.hours_by_semester(), staff.hours_by_semester(package=self.package))
+            self.assertEqual(summary.hours_by_category(categories), staff.hours_by_category(package=self.package))
+
+    def setUp(self):
+        super().setUp()
+        StaffLoadSummary.refresh(self.package, [staff.pk for staff in self.staff])
+
+    def test_summaries_created(self):
+        """Refreshing named staff should create one summary for each of them"""
+        self.assertEqual(StaffLoadSummary.objects.filter(package=self.package).count(), len(self.staff))
+        self.assertSummariesCurrent()
+
+    def test_get_for_package_read_only(self):
+        """Missing summaries are calculated, but not saved"""
+        StaffLoadSummary.objects.filter(staff=self.staff[1]).delete()
+        with CaptureQueriesContext(connection) as queries:
+            summaries = StaffLoadSummary.get_for_package(self.package, self.staff)
+        self.assertFalse(any(query['sql'].startswith(('INSERT', 'UPDATE')) for query in queries))
+        self.assertIsNone(summaries[self.staff[1].pk].pk)
+        self.assertEqual(summaries[self.staff[1].pk].hours_by_semester(),
+                         self.staff[1].hours_by_semester(package=self.package))
+
+    def test_activity_changes(self):
+        """Adding, moving and deleting activities should refresh the summaries"""
+        activity = Activity.objects.filter(staff=self.staff[1], package=self.package).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            activity.hours += 50
+            activity.save()
+        self.assertSummariesCurrent()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            activity.staff = self.staff[2]
+            activity.save()
+        self.assertSummariesCurrent()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            activity.delete()
+        self.assertSummariesCurrent()
+
+    def test_refresh_deferred(self):
+        """Summaries are refreshed once on commit, however many allocations change"""
+        with patch('loads.models.StaffLoadSummary.refresh', wraps=StaffLoadSummary.refresh) as refresh:
+            with self.captureOnCommitCallbacks(execute=True):
+                for activity in Activity.objects.filter(package=self.package):
+                    activity.hours += 1
+                    activity.save()
+                self.assertEqual(refresh.call_count, 0)
+            calls = [call for call in refresh.call_args_list if call.args[0] == self.package.pk]
+            self.assertEqual(len(calls), 1)
+        self.assertSummariesCurrent()
+
+    def test_generation_after_refresh(self):
+        """The package generation only changes once the summaries are refreshed"""
+        generation = WorkPackage.objects.get(pk=self.package.pk).generation
+        with self.captureOnCommitCallbacks(execute=True):
+            for activity in Activity.objects.filter(package=self.package):
+                activity.hours += 1
+                activity.save()
+            self.assertEqual(WorkPackage.objects.get(pk=self.package.pk).generation, generation)
+        self.assertGreater(WorkPackage.objects.get(pk=self.package.pk).generation, generation)
+        self.assertSummariesCurrent()
+
+    def test_package_deleted(self):
+        """Deleting a package doesn't refresh the summaries deleted with it"""
+        with patch('loads.models.StaffLoadSummary.refresh', wraps=StaffLoadSummary.refresh) as refresh:
+            with self.captureOnCommitCallbacks(execute=True):
+                package_id = self.package.pk
+                self.package.delete()
+            self.assertFalse(any(call.args[0] == package_id for call in refresh.call_args_list))
+        self.assertFalse(StaffLoadSummary.objects.exists())
+
+    def test_modulestaff_changes(self):
+        """Changing module allocations should refresh the summaries"""
+        allocation = ModuleStaff.objects.filter(package=self.package).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            allocation.contact_proportion = 10
+            allocation.staff = self.staff[4]
+            allocation.save()
+        self.assertSummariesCurrent()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            allocation.delete()
+        self.assertSummariesCurrent()
+
+    def test_module_changes(self):
+        """Changing module details or coordinators should refresh the summaries"""
+        module = Module.objects.get(module_code="ENG103")
+        with self.captureOnCommitCallbacks(execute=True):
+            module.credits = 60
+            module.semester = "2"
+            module.coordinator = self.staff[0]
+            module.save()
+        self.assertSummariesCurrent()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            module.delete()
+        self.assertSummariesCurrent()
+
+    def test_workpackage_changes(self):
+        """Changing package formulas or nominal hours should refresh the summaries"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.package.contact_formula = 'credits * 3'
+            self.package.nominal_hours = 1500
+            self.package.save()
+        self.assertSummariesCurrent()
+
+    def test_activity_type_changes(self):
+        """Moving an ActivityType to a new category should refresh the summaries"""
+        activity_type = ActivityType.objects.get(name="Lecturing")
+        with self.captureOnCommitCallbacks(execute=True):
+            activity_type.category = Category.objects.get(name="Research")
+            activity_type.save()
+        self.assertSummariesCurrent()
+
+
+class CompiledFormulaTestCase(TestCase):
+    """Tests that compiled formulas behave exactly as direct evaluation"""
+
+    def test_compiled_matches_simple_eval(self):
+        """Compiled formulas should give identical results to simple_eval"""
+        variables = {'credits': 20, 'students': 137, 'contact': 50.0, 'admin': 7.5,
+                     'contact_scaling': 2.5, 'admin_scaling': 1.1, 'assessment_scaling': 0.9}
+        for formula in ['credits * contact_scaling', 'contact * admin_scaling + sqrt(students)',
+                        'max(credits / 2, 5) + round(log(students), 2)', 'students ** 0.5 - abs(-admin)',
+                        '10 if students > 100 else 5']:
+            self.assertEqual(compile_formula(formula)(variables),
+                             simple_eval(formula, names=variables, functions=ALLOWED_FUNCTIONS))
+
+    def test_compiled_formula_cached(self):
+        """The same formula text should only be compiled once"""
+        self.assertIs(compile_formula('credits * 3'), compile_formula('credits * 3'))
+
+    def test_formula_errors(self):
+        """Evaluation and validation should reject the same formulas"""
+        for formula in ['credits * unknown', 'eval("1")', 'credits / 0']:
+            with self.assertRaises(FormulaError):
+                _evaluate(formula, {'credits': 20})
+
+        # Unknown names and functions are invalid, division by zero is tolerated
+        with self.assertRaises(ValidationError):
+            validate_formula('credits * unknown')
+        with self.assertRaises(ValidationError):
+            validate_formula('open("x")')
+        validate_formula('credits / 0')
+        validate_formula('sqrt(students) * contact')
+
+
+class ModuleHoursTestCase(LoadDataTestCase):
+    """Tests that module hours are calculated once and recalculated after saving"""
+
+    def test_hours_memoised(self):
+        """Hours are calculated only once however many getters are called"""
+        module = Module.objects.select_related('package').get(module_code="ENG103")
+        with patch('loads.models.ModuleHours.calculate', wraps=ModuleHours.calculate) as calculate:
+            contact = module.get_contact_hours()
+            module.get_admin_hours()
+            module.get_assessment_hours_by_semester()
+            module.get_all_hours()
+            self.assertEqual(calculate.call_count, 1)
+
+        # Altering the returned lists must not alter the stored hours
+        module.get_contact_hours_by_semester()[0] = -1
+        self.assertEqual(module.get_contact_hours_by_semester()[0], contact)
+
+    def test_hours_invalidated_on_save(self):
+        """Saving a module means hours are calculated afresh"""
+        # This module has its contact hours overridden
+        module = Module.objects.get(module_code="ENG102")
+        contact = module.get_contact_hours()
+        module.contact_hours = None
+        module.admin_hours = 7
+        module.save()
+        self.assertNotEqual(module.get_contact_hours(), contact)
+        self.assertEqual(module.get_admin_hours(), 7.0)
+        self.assertEqual(module.get_all_hours(), module.get_contact_hours() + 7.0 +
+                         module.get_assessment_hours() + module.get_coordinator_hours())
+
+
+class DatabaseHoursTestCase(LoadDataTestCase):
+    """Tests that module hours calculated in the database match the Python calculation"""
+
+    def assertDatabaseMatchesPython(self):
+        modules = Module.annotate_hours(Module.objects.filter(package=self.package), self.package)
+        self.assertIsNotNone(modules)
+        for module in modules:
+            self.assertAlmostEqual(module.calculated_contact_hours, module.get_contact_hours())
+            self.assertAlmostEqual(module.calculated_admin_hours, module.get_admin_hours())
+            self.assertAlmostEqual(module.calculated_assessment_hours, module.get_assessment_hours())
+
+        totals = self.package.get_module_hours_totals()
+        modules = Module.objects.filter(package=self.package)
+        self.assertAlmostEqual(totals['contact'], sum(module.get_contact_hours() for module in modules))
+        self.assertAlmostEqual(totals['admin'], sum(module.get_admin_hours() for module in modules))
+        self.assertAlmostEqual(totals['assessment'], sum(module.get_assessment_hours() for module in modules))
+
+    def test_formula_translation(self):
+        """Only pure arithmetic over known names can be translated"""
+        names = {'credits': F('credits')}
+        self.assertIsNotNone(formula_to_expression('credits * 2.5 - -1 / 3', names))
+        self.assertIsNone(formula_to_expression('sqrt(credits)', names))
+        self.assertIsNone(formula_to_expression('log(credits)', names))
+        self.assertIsNone(formula_to_expression('credits ** 2', names))
+        self.assertIsNone(formula_to_expression('credits * students', names))
+        self.assertIsNone(formula_to_expression('credits * ', names))
+
+    def test_default_formulas(self):
+        """Packages without formulas use the legacy scalings in the database too"""
+        self.package.contact_formula = ''
+        self.package.admin_formula = ''
+        self.package.assessment_formula = ''
+        self.package.credit_contact_scaling = 2.5
+        self.package.save()
+        self.assertDatabaseMatchesPython()
+
+    def test_arithmetic_formulas(self):
+        """Arithmetic formulas are calculated in the database, respecting overrides"""
+        self.package.contact_formula = 'credits * contact_scaling + students / 4'
+        self.package.assessment_formula = '-admin + contact * assessment_scaling + 3'
+        self.package.save()
+        module = Module.objects.get(module_code="ENG104")
+        module.admin_hours = 9
+        module.save()
+        self.assertDatabaseMatchesPython()
+
+        # Only the modules given are totalled
+        modules = Module.objects.filter(package=self.package, semester="1")
+        totals = self.package.get_module_hours_totals(modules)
+        self.assertAlmostEqual(totals['contact'], sum(module.get_contact_hours() for module in modules))
+
+    def test_division_by_zero(self):
+        """Division by zero gives NULL in the database, and the totals fall back to Python"""
+        self.package.contact_formula = 'credits / (students - 40)'
+        self.package.save()
+        module = Module.objects.get(module_code="ENG100")
+        module.number_students = 40
+        module.save()
+        modules = Module.annotate_hours(Module.objects.filter(pk=module.pk), self.package)
+        self.assertIsNone(modules.get().calculated_contact_hours)
+        # Just as when each module is calculated in Python
+        with self.assertRaises(FormulaError):
+            self.package.get_module_hours_totals()
+
+        # A zero-valued override is not a division
+        module.contact_hours = 5
+        module.save()
+        self.assertDatabaseMatchesPython()
+
+    def test_python_fallback(self):
+        """Formulas using functions fall back to the Python calculation"""
+        # The package contact formula uses sqrt, so the modules are fetched once and calculated in Python
+        self.assertIsNone(Module.annotate_hours(Module.objects.all(), self.package))
+        with self.assertNumQueries(1):
+            totals = self.package.get_module_hours_totals()
+        modules = Module.objects.filter(package=self.package)
+        self.assertAlmostEqual(totals['contact'], sum(module.get_contact_hours() for module in modules))
+        self.assertAlmostEqual(totals['admin'], sum(module.get_admin_hours() for module in modules))
+
+        self.package.contact_formula = 'log(credits) * 10'
+        self.package.save()
+        self.assertIsNone(Module.annotate_hours(Module.objects.all(), self.package))
+
+
+class SemesterMaskTestCase(LoadDataTestCase):
+    """Tests that semester masks agree with the semester strings they replace"""
+
+    def test_semester_mask_splits(self):
+        """Splitting by mask gives exactly the same hours as splitting the string"""
+        for semesters in ['1', '2', '3', '1,2', '1,3', '2,3', '1,2,3']:
+            for hours in [0, 10, 17.5, 100 / 3]:
+                self.assertEqual(divide_by_semester_mask(hours, semester_mask(semesters)),
+                                 divide_by_semesters(hours, semesters))
+        self.assertEqual(semester_mask('1, 3'), 5)
+        self.assertEqual(semester_mask(''), 0)
+
+    def test_semester_mask_saved(self):
+        """Masks are kept in step with the semester strings on save"""
+        module = Module.objects.get(module_code="ENG103")
+        self.assertEqual(module.semester_mask, 7)
+        module.semester = "2,3"
+        module.save()
+        self.assertEqual(Module.objects.get(pk=module.pk).semester_mask, 6)
+        activity = Activity.objects.filter(package=self.package).first()
+        self.assertEqual(activity.semester_mask, semester_mask(activity.semester))
+
+        # Raw saves, as by loaddata, are kept in step too
+        activity.semester = "3"
+        activity.semester_mask = 0
+        activity.save_base(raw=True)
+        self.assertEqual(Activity.objects.get(pk=activity.pk).semester_mask, 4)
+
+    def test_semester_mask_backfilled(self):
+        """The migration corrects masks left out of step by updates that bypass the signal"""
+        Module.objects.filter(module_code="ENG103").update(semester="2", semester_mask=0)
+        Activity.objects.filter(package=self.package).update(semester="1,3", semester_mask=0)
+        migration = importlib.import_module('loads.migrations.0064_backfill_semester_mask')
+        migration.backfill_semester_masks(django_apps, None)
+        self.assertEqual(Module.objects.get(module_code="ENG103").semester_mask, 2)
+        self.assertEqual(set(Activity.objects.filter(package=self.package).values_list('semester_mask', flat=True)),
+                         {5})
+
+    def test_semester_filtering(self):
+        """Filtering by overlapping masks finds modules in any of the given semesters"""
+        modules = Module.objects.filter(package=self.package,
+                                        semester_mask__in=overlapping_semester_masks(semester_mask("3")))
+        self.assertEqual(sorted(module.module_code for module in modules), ["ENG103", "ENG104"])
+        modules = Module.objects.filter(package=self.package,
+                                        semester_mask__in=overlapping_semester_masks(semester_mask("1,2")))
+        self.assertEqual(modules.count(), 4)
+
+
+class LoadMatrixTestCase(LoadDataTestCase):
+    """Tests that the LoadMatrix gives the same loads and statistics as the per staff methods"""
+
+    def test_matrix_matches_staff_methods(self):
+        """Each row holds the same hours as the per staff methods"""
+        matrix = LoadMatrix(self.package)
+        self.assertEqual(len(matrix.staff), len(self.staff))
+        for staff in self.staff:
+            row = matrix.staff_index[staff.pk]
+            self.assertEqual(matrix.semester_hours[row], staff.hours_by_semester(package=self.package)[:4])
+            self.assertEqual(matrix.get_category_hours(staff), staff.hours_by_category(package=self.package))
+
+    def test_matrix_statistics(self):
+        """Staff in several groups appear in each, but are only counted once overall"""
+        # An inactive member of staff with no load is left out
+        user = User.objects.create(username="inactive", is_active=False)
+        user.groups.add(Group.objects.get(name="engineA"))
+
+        matrix = LoadMatrix(self.package)
+        totals = [hours[0] for hours in matrix.semester_hours]
+        group_rows = dict(matrix.get_group_rows(totals))
+        groupA = Group.objects.get(name="engineA")
+        self.assertEqual([matrix.staff[row] for row in group_rows[groupA]],
+                         [self.staff[1], self.staff[3], self.staff[5]])
+
+        (total, average, allocated, allocated_average) = matrix.get_statistics(group_rows[groupA], totals)
+        expected = sum(self.staff[counter].hours_by_semester(package=self.package)[0] for counter in [1, 3, 5])
+        self.assertAlmostEqual(total, expected)
+        self.assertAlmostEqual(average, expected / 3)
+
+        (total, total_staff, average) = matrix.get_overall_statistics(matrix.get_group_rows(totals), totals)
+        self.assertEqual(total_staff, len(self.staff))
+        self.assertAlmostEqual(total, sum(staff.hours_by_semester(package=self.package)[0] for staff in self.staff))
+
+
+class LoadSimulatorTestCase(LoadDataTestCase):
+    """Tests that simulated changes give the loads saving them would, without saving anything"""
+
+    def get_loads(self, engine, staff):
+        return {
+            'semester_hours': engine.hours_by_semester(staff)[:4],
+            'category_hours': {category.pk: hours for category, hours in engine.hours_by_category(staff).items()},
+        }
+
+    def assertLoadsEqual(self, first, second):
+        for expected, actual in zip(first['semester_hours'], second['semester_hours']):
+            self.assertAlmostEqual(expected, actual)
+        self.assertEqual(first['category_hours'].keys(), second['category_hours'].keys())
+        for key, expected in first['category_hours'].items():
+            self.assertAlmostEqual(expected, second['category_hours'][key])
+
+    def test_simulation_matches_saving(self):
+        """The simulated loads are those a fresh calculation gives after really making the changes"""
+        moved = ModuleStaff.objects.filter(package=self.package, staff=self.staff[0]).first()
+        deleted = Activity.objects.filter(package=self.package, staff=self.staff[1]).first()
+        changed = Activity.objects.filter(package=self.package, staff=self.staff[2]).first()
+        lecturing = ActivityType.objects.get(name="Lecturing")
+        module = Module.objects.get(module_code="ENG103")
+        changes = [
+            {'action': 'change', 'type': 'modulestaff', 'id': moved.pk,
+             'fields': {'staff': self.staff[3].pk, 'contact_proportion': 25}},
+            {'action': 'delete', 'type': 'activity', 'id': deleted.pk},
+            {'action': 'change', 'type': 'activity', 'id': changed.pk, 'fields': {'hours': 50, 'semester': '2,3'}},
+            {'action': 'change', 'type': 'activity', 'id': changed.pk, 'fields': {'hours': 60}},
+            {'action': 'add', 'type': 'activity',
+             'fields': {'hours': 0, 'percentage': 7, 'hours_percentage': 'P', 'semester': '3',
+                        'activity_type': lecturing.pk, 'staff': self.staff[4].pk}},
+            {'action': 'add', 'type': 'modulestaff',
+             'fields': {'module': module.pk, 'staff': str(self.staff[5].pk), 'activity_type': lecturing.pk,
+                        'contact_proportion': 10, 'admin_proportion': 20, 'assessment_proportion': 30}},
+        ]
+
+        activities = Activity.objects.count()
+        allocations = ModuleStaff.objects.count()
+        results = LoadSimulator.get_for_package(self.package).simulate(changes)
+        self.assertEqual(Activity.objects.count(), activities)
+        self.assertEqual(ModuleStaff.objects.count(), allocations)
+        self.assertEqual(Activity.objects.get(pk=changed.pk).hours, changed.hours)
+
+        # Only the affected staff are calculated
+        self.assertEqual(set(results.keys()), {self.staff[counter].pk for counter in [0, 1, 2, 3, 4, 5]})
+        engine = PackageLoadEngine(self.package)
+        for staff_id, loads in results.items():
+            self.assertLoadsEqual(loads['before'], self.get_loads(engine, Staff.objects.get(pk=staff_id)))
+
+        moved.staff = self.staff[3]
+        moved.contact_proportion = 25
+        moved.save()
+        deleted.delete()
+        changed.hours = 60
+        changed.semester = '2,3'
+        changed.save()
+        Activity.objects.create(name="New", hours=0, percentage=7, hours_percentage='P', semester='3',
+                                activity_type=lecturing, staff=self.staff[4], package=self.package)
+        ModuleStaff.objects.create(module=module, staff=self.staff[5], package=self.package,
+                                   activity_type=lecturing, contact_proportion=10, admin_proportion=20,
+                                   assessment_proportion=30)
+
+        engine = PackageLoadEngine(self.package)
+        for staff_id, loads in results.items():
+            self.assertLoadsEqual(loads['after'], self.get_loads(engine, Staff.objects.get(pk=staff_id)))
+
+    def test_snapshot_reused_until_package_changes(self):
+        """The snapshot is shared between calls, and never changed by them"""
+        package = WorkPackage.objects.get(pk=self.package.pk)
+        simulator = LoadSimulator.get_for_package(package)
+        activity = Activity.objects.filter(package=self.package, staff=self.staff[0]).first()
+        simulator.simulate([{'action': 'delete', 'type': 'activity', 'id': activity.pk}])
+        self.assertIn(activity, simulator.get_activities(self.staff[0]))
+
+        package = WorkPackage.objects.get(pk=self.package.pk)
+        self.assertIs(LoadSimulator.get_for_package(package), simulator)
+
+        # Simulating doesn't attach staff objects to the shared allocations
+        allocation = ModuleStaff.objects.filter(package=self.package).first()
+        staff = Staff.objects.get(pk=allocation.staff_id)
+        simulator.simulate([{'action': 'change', 'type': 'modulestaff', 'id': allocation.pk,
+                             'fields': {'contact_proportion': 10}}])
+        self.assertIs(simulator.get_modulestaff(staff)[0].staff, staff)
+        for allocation in simulator.modulestaff_by_staff[staff.pk]:
+            self.assertNotIn('staff', allocation._state.fields_cache)
+
+        activity.hours += 1
+        with self.captureOnCommitCallbacks(execute=True):
+            activity.save()
+        package = WorkPackage.objects.get(pk=self.package.pk)
+        self.assertIsNot(LoadSimulator.get_for_package(package), simulator)
+
+    def test_invalid_changes(self):
+        """Invalid changes are rejected"""
+        simulator = LoadSimulator.get_for_package(self.package)
+        module = Module.objects.get(module_code="ENG100")
+        for change in [
+            {'action': 'remove', 'type': 'activity', 'id': 1},
+            {'action': 'delete', 'type': 'project', 'id': 1},
+            {'action': 'delete', 'type': 'activity', 'id': 999999},
+            {'action': 'delete', 'type': 'activity', 'id': 'x'},
+            {'action': 'add', 'type': 'modulestaff', 'fields': {'module': module.pk}},
+            {'action': 'add', 'type': 'modulestaff', 'fields': {'module': module.pk, 'staff': 999999}},
+            {'action': 'add', 'type': 'activity', 'fields': {'package': 1}},
+            {'action': 'add', 'type': 'activity', 'fields': {'hours': -1}},
+        ]:
+            with self.assertRaises(ValidationError):
+                simulator.simulate([change])
+
+
+class AllocationSolverTestCase(LoadDataTestCase):
+    """Tests the proposal and acceptance of allocations for unallocated module work"""
+
+    def test_solve_allocation(self):
+        """Chunks go to the least loaded staff, allowing for FTE and semesters"""
+        # The second member of staff is half time, so is already as loaded as the first
+        self.assertEqual(solve_allocation([10, 10], [[10, 0, 0], [10, 0, 0]], [100, 50], [20, 10],
+                                          [[20, 0, 0], [10, 0, 0]]), [0, 1])
+        # Equal loads, but the second member of staff has room in the chunk's semester
+        self.assertEqual(solve_allocation([10], [[0, 10, 0]], [100, 100], [20, 20],
+                                          [[0, 20, 0], [20, 0, 0]]), [1])
+        # Taking the largest chunks first gives the most even split
+        assignments = solve_allocation([30, 20, 20], [[30, 0, 0], [20, 0, 0], [20, 0, 0]], [100, 100], [0, 0],
+                                       [[0, 0, 0], [0, 0, 0]], candidates=1)
+        loads = [sum(hours for chunk, hours in enumerate([30, 20, 20]) if assignments[chunk] == staff)
+                 for staff in range(2)]
+        self.assertEqual(sorted(loads), [30, 40])
+        self.assertEqual(solve_allocation([10], [[10, 0, 0]], [], [], []), [None])
+
+    def test_proposals_cover_unallocated_work(self):
+        """Proposals complete every module, and accepting them updates loads and the package"""
+        campus = Campus.objects.first()
+        for counter in range(3):
+            Module.objects.create(module_code="NEW%u" % counter, module_name="New %u" % counter,
+                                  package=self.package, campus=campus, credits=20, number_students=40,
+                                  semester="1")
+        # And one module only partially allocated
+        ModuleStaff.objects.filter(module__module_code="ENG101").first().delete()
+
+        solver = AllocationSolver(self.package, step=50)
+        proposals = solver.get_proposals()
+        totals = dict()
+        for proposal in proposals:
+            self.assertIn(proposal.staff, self.staff)
+            total = totals.setdefault(proposal.module.module_code, [0, 0, 0])
+            total[0] += proposal.contact_proportion
+            total[1] += proposal.admin_proportion
+            total[2] += proposal.assessment_proportion
+        self.assertEqual(set(totals.keys()), {"ENG101", "NEW0", "NEW1", "NEW2"})
+        for code in ["NEW0", "NEW1", "NEW2"]:
+            self.assertEqual(totals[code], [100, 100, 100])
+        self.assertEqual(totals["ENG101"], [60, 60, 40])
+        self.assertLessEqual(solver.get_spread(proposals), solver.get_spread() + 1e-9)
+
+        generation = WorkPackage.objects.get(pk=self.package.pk).generation
+        allocations = ModuleStaff.objects.count()
+        self.assertEqual(solver.accept(proposals), len(proposals))
+        merged = len([proposal for proposal in proposals if proposal.existing])
+        self.assertEqual(ModuleStaff.objects.count(), allocations + len(proposals) - merged)
+        self.assertGreater(WorkPackage.objects.get(pk=self.package.pk).generation, generation)
+
+        engine = PackageLoadEngine(self.package)
+        for staff in set(proposal.staff for proposal in proposals):
+            summary = StaffLoadSummary.objects.get(staff=staff, package=self.package)
+            self.assertFalse(summary.differs_from(engine))
+
+        # Nothing is left to propose
+        self.assertEqual(AllocationSolver(self.package).get_proposals(), [])
+
+    def test_proposals_merge_into_existing(self):
+        """Work for staff already on a module is added to their allocation, never duplicating it"""
+        ModuleStaff.objects.filter(module__module_code="ENG101").update(contact_proportion=10, admin_proportion=10,
+                                                                         assessment_proportion=10)
+        pairs = set(ModuleStaff.objects.values_list('module', 'staff'))
+        allocations = ModuleStaff.objects.count()
+
+        solver = AllocationSolver(self.package, step=10)
+        proposals = solver.get_proposals()
+        merged = [proposal for proposal in proposals if proposal.existing]
+        self.assertTrue(merged)
+        for proposal in proposals:
+            self.assertEqual(proposal.existing, (proposal.module.pk, proposal.staff.pk) in pairs)
+
+        self.assertEqual(solver.accept(proposals), len(proposals))
+        self.assertEqual(ModuleStaff.objects.count(), allocations + len(proposals) - len(merged))
+        self.assertEqual(ModuleStaff.objects.values('module', 'staff').distinct().count(),
+                         ModuleStaff.objects.count())
+        for proposal in merged:
+            allocation = ModuleStaff.objects.get(module=proposal.module, staff=proposal.staff)
+            self.assertEqual(allocation.contact_proportion, 10 + proposal.contact_proportion)
+
+    def test_no_nominal_hours(self):
+        """Loads can't be balanced without nominal hours, which the form reports"""
+        self.package.nominal_hours = 0
+        self.package.save()
+        with self.assertRaises(ValidationError):
+            AllocationSolver(self.package)
+
+        form = AllocationSolverForm({'step': 50}, package=self.package)
+        self.assertFalse(form.is_valid())
+        self.assertIn(AllocationSolverForm.NO_NOMINAL_HOURS, form.non_field_errors())
+
+
+class LoadTrendTestCase(LoadDataTestCase):
+    """Tests loads across packages match the per package calculation"""
+
+    def test_trend_matches_engine(self):
+        """Every package a member of staff appears in is included, with the same loads"""
+        later = WorkPackage.objects.create(name="later", startdate="2025-09-01", enddate="2026-08-31")
+        later.groups.add(Group.objects.get(name="engineA"))
+        lecturing = ActivityType.objects.get(name="Lecturing")
+        Activity.objects.create(name="Later", hours=42, percentage=0, semester="1", activity_type=lecturing,
+                                staff=self.staff[1], package=later)
+
+        trend = LoadTrend(Staff.objects.filter(pk__in=[staff.pk for staff in self.staff]).select_related('user'))
+        self.assertEqual(trend.packages, [self.package, later])
+        for row, staff in enumerate(trend.staff):
+            for column, package in enumerate(trend.packages):
+                if package == later and staff.user.groups.filter(name="engineA").count() == 0:
+                    self.assertIsNone(trend.hours[row][column])
+                    self.assertIsNone(trend.get_percentage(row, column))
+                    continue
+                expected = PackageLoadEngine(package).hours_by_category(staff)
+                for category, hours in zip(trend.categories, trend.hours[row][column]):
+                    self.assertAlmostEqual(expected[category], hours)
+                self.assertAlmostEqual(trend.totals[row][column], sum(expected.values()))
+
+        row = trend.staff.index(self.staff[1])
+        self.assertAlmostEqual(trend.totals[row][1], 42)
+        self.assertAlmostEqual(trend.get_percentage(row, 1), 100 * 42 / later.nominal_hours)
+
+    def test_queries_independent_of_packages(self):
+        """Once summaries exist, more packages take no more queries"""
+        staff_list = Staff.objects.filter(pk__in=[staff.pk for staff in self.staff]).select_related('user')
+        call_command('rebuild_load_summaries', verbosity=0)
+        LoadTrend(staff_list)
+        with CaptureQueriesContext(connection) as one_package:
+            LoadTrend(staff_list)
+
+        for year in range(2025, 2028):
+            package = WorkPackage.objects.create(name="year%u" % year, startdate="%u-09-01" % year,
+                                                 enddate="%u-08-31" % (year + 1))
+            package.groups.add(Group.objects.get(name="engineA"), Group.objects.get(name="engineB"))
+        call_command('rebuild_load_summaries', verbosity=0)
+        LoadTrend(staff_list)
+        with CaptureQueriesContext(connection) as four_packages:
+            trend = LoadTrend(staff_list)
+        self.assertEqual(len(trend.packages), 4)
+        self.assertEqual(len(four_packages), len(one_package))
+
+
+class TaskTargetTestCase(TestCase):
+    def setUp(self):
+        # Logging is very noisy typically
+        logging.disable(logging.CRITICAL)
+
+        self.category = Category.objects.create(name="Admin", abbreviation="admin", colour="blue")
+        self.group = Group.objects.create(name="Team")
+        self.staff = list()
+        for counter in range(4):
+            user = User.objects.create(username="target%u" % counter, last_name="Target%u" % counter)
+            self.staff.append(Staff.objects.get(user=user))
+        for staff in self.staff[:2]:
+            staff.user.groups.add(self.group)
+
+        self.task = Task.objects.create(name="Return forms", category=self.category, details="Please",
+                                        deadline="2030-01-01 12:00:00+00:00")
+        self.task.groups.add(self.group)
+        self.task.targets.add(self.staff[1], self.staff[2])
+
+    def tearDown(self):
+        # Put the logging back in place
+        logging.disable(logging.NOTSET)
+
+    def test_targets(self):
+        """Targets by user and group are combined, without duplicates"""
+        self.assertEqual(list(self.task.get_all_targets()), self.staff[:3])
+        self.assertEqual(self.task.resolve_targets(), set(staff.pk for staff in self.staff[:3]))
+        self.assertEqual(list(self.staff[0].get_all_tasks()), [self.task])
+        self.assertEqual(list(self.staff[3].get_all_tasks()), [])
+        self.assertEqual(list(self.staff[0].get_all_tasks(archived=True)), [])
+
+        with CaptureQueriesContext(connection) as queries:
+            list(self.task.get_all_targets())
+            list(self.staff[0].get_all_tasks())
+        self.assertEqual(len(queries), 2)
+
+    def test_targets_maintained(self):
+        """Changes to task targets, task groups and group membership all update the targets"""
+        def targets():
+            return set(TaskTarget.objects.filter(task=self.task).values_list('staff', flat=True))
+
+        self.staff[3].user.groups.add(self.group)
+        self.assertIn(self.staff[3].pk, targets())
+        self.group.user_set.remove(self.staff[3].user)
+        self.assertNotIn(self.staff[3].pk, targets())
+        self.staff[0].user.groups.clear()
+        self.assertNotIn(self.staff[0].pk, targets())
+
+        self.task.targets.remove(self.staff[2])
+        self.assertEqual(targets(), {self.staff[1].pk})
+        self.staff[2].task_set.add(self.task)
+        self.assertEqual(targets(), {self.staff[1].pk, self.staff[2].pk})
+        self.task.targets.clear()
+        self.assertEqual(targets(), {self.staff[1].pk})
+
+        self.group.delete()
+        self.assertEqual(targets(), set())
+
+    def test_urgency(self):
+        """Tasks loaded with or without the urgency annotations are classified alike, without queries"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for days, urgent, overdue in [(-1, True, True), (3, True, False), (30, False, False)]:
+            Task.objects.filter(pk=self.task.pk).update(deadline=now + datetime.timedelta(days=days))
+            task = Task.objects.get(pk=self.task.pk)
+            annotated = Task.annotate_urgency(Task.objects.filter(pk=self.task.pk)).get()
+            unsaved = Task(name="Unsaved", category=self.category, details="", deadline=task.deadline)
+            with CaptureQueriesContext(connection) as queries:
+                for checked in [task, annotated, unsaved]:
+                    self.assertEqual((checked.is_urgent(), checked.is_overdue()), (urgent, overdue))
+            self.assertEqual(len(queries), 0)
+
+        # Without the annotations, a changed deadline is seen at once
+        task.deadline = now + datetime.timedelta(days=30)
+        self.assertFalse(task.is_urgent())
+
+    def test_targets_for_new_staff(self):
+        """Staff created for a user already in a targeted group are targeted"""
+        user = User.objects.create(username="latecomer", last_name="Latecomer")
+        Staff.objects.get(user=user).delete()
+        user.groups.add(self.group)
+        self.assertFalse(TaskTarget.objects.filter(task=self.task, staff__user=user).exists())
+
+        staff = Staff.objects.create(user=user, fte=100)
+        self.assertTrue(TaskTarget.objects.filter(task=self.task, staff=staff).exists())
+
+    def test_refresh(self):
+        """Refreshing finds and fixes any differences"""
+        TaskTarget.objects.all().delete()
+        self.assertEqual(TaskTarget.refresh([self.task]), (3, 0))
+        self.assertEqual(TaskTarget.refresh([self.task.pk]), (0, 0))
+        TaskTarget.objects.create(task=self.task, staff=self.staff[3])
+        self.assertEqual(TaskTarget.refresh([self.task]), (0, 1))
@@ -1,7 +1,8 @@
 # validators.py
-from simpleeval import simple_eval, InvalidExpression
+from simpleeval import InvalidExpression
 from django.core.exceptions import ValidationError
-import math
+
+from .formula_engine import ALLOWED_FUNCTIONS, compile_formula
 
 # The maximum variable set any formula could ever see
 # Use representative dummy values for validation purposes
@@ -15,28 +16,15 @@ FORMULA_DUMMY_CONTEXT = {
     'assessment_scaling': 1.0,
 }
 
-# A list of permitted formula functions
-FORMULA_FUNCTIONS = {
-    'log': math.log,
-    'log2': math.log2,
-    'log10': math.log10,
-    'sqrt': math.sqrt,
-    'abs': abs,
-    'min': min,
-    'max': max,
-    'round': round,
-}
+# A list of permitted formula functions, shared with the evaluator
+FORMULA_FUNCTIONS = ALLOWED_FUNCTIONS
 
 def validate_formula(value):
     """Validate that a formula string is safe and evaluable."""
     if not value:
         return
     try:
-        result = simple_eval(
-            value,
-            names=FORMULA_DUMMY_CONTEXT,
-            functions=FORMULA_FUNCTIONS,
-        )
+        result = compile_formula(value)(FORMULA_DUMMY_CONTEXT)
         if not isinstance(result, (int, float)):
             raise ValidationError("Formula must evaluate to a number.")
     except InvalidExpression as e:
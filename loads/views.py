@@ -1,4 +1,5 @@
 import os
+import json
 import mimetypes
 import logging
 
@@ -12,37 +13,46 @@ from django.contrib import messages
 from django.utils.http import url_has_allowed_host_and_scheme
 
 from django.contrib.auth.mixins import PermissionRequiredMixin, LoginRequiredMixin
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ValidationError
 
 # Class Views
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
 
 # Permission decorators
 from django.contrib.auth.decorators import login_required, permission_required, user_passes_test
-from .decorators import staff_only, external_only, admin_only
+from .decorators import staff_only, external_only, admin_only, package_conditional
 from django.utils.decorators import method_decorator
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.views.decorators.http import require_POST
 from django.template import loader
 from django.contrib.auth.models import User, Group, Permission
+from django.core.paginator import Paginator
+from django.db.models import OuterRef, Prefetch, Subquery
 
 from .models import ActivityGenerator, Category
 from .models import AssessmentResource
 from .models import AssessmentStaff
 from .models import AssessmentState
 from .models import AssessmentStateSignOff
+from .models import AssessmentWorkflow
 from .models import Staff
 from .models import Task
 from .models import Activity
-from .models import TaskCompletion
+from .models import TaskCompletionMatrix
 from .models import Module
 from .models import ModuleStaff
+from .models import ModuleRelationships
 from .models import Programme
 from .models import Project
 from .models import ProjectStaff
 from .models import WorkPackage
+from .models import PackageLoadEngine
+from .models import LoadSimulator
+from .models import LoadTrend
 
 from .forms import ActivityForm
 from .forms import ActivityGeneratorForm
+from .forms import AllocationSolverForm
 from .forms import AssessmentResourceForm
 from .forms import AssessmentStaffForm
 from .forms import AssessmentStateSignOffForm
@@ -62,9 +72,16 @@ from .forms import BaseModuleStaffByModuleFormSet
 from .forms import BaseModuleStaffByStaffFormSet
 from .forms import DateInput
 from .forms import DateTimeInput
+from .helpers import overlapping_semester_masks, semester_mask
+from .allocation_solver import AllocationSolver
+from .caching import get_fragment_statistics
+from .caching import get_loads_charts_table, get_loads_table, get_modules_table
 
 from WAM.settings import WAM_VERSION, WAM_ADMIN_CONTACT_EMAIL, WAM_ADMIN_CONTACT_NAME
 
+# How many tasks to show on each page of the tasks index
+TASKS_PER_PAGE = 50
+
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
@@ -278,6 +295,7 @@ def delete_assessment_resource(request, resource_id, confirm=None):
 
 @login_required
 @staff_only
+@package_conditional
 def loads(request):
     """Show the loads for all members of staff"""
 
@@ -302,80 +320,11 @@ def loads(request):
     # This controls whether hours or percentages are shown
     show_percentages = package.show_percentages
 
-    # We shall want to consider totals for averages, but as some users can be in multiple
-    # groups, we will keep a list to make sure we don't double count.
-    total = 0.0
-    total_staff = 0
-    counted_staff = list()
-    group_data = []
-
-    # Go through each group in turn
-    for group in package.groups.all():
-        group_list = []
-        group_size = 0
-        group_total = 0.0
-        group_average = 0.0
-        group_allocated_staff = 0
-        group_allocated_average = 0.0
-        # Get the users in the group
-        users = User.objects.all().filter(groups__in=[group]).distinct()
-        # And the associated staff objects
-        staff_list = Staff.objects.all().filter(user__in=users).order_by('user__last_name')
-        for staff in staff_list:
-            load_info = staff.hours_by_semester(package=package)
-            # Note below: the reason for checking any load as will as conditions is to allow
-            # colleagues to appear in other workpackages in times they had an allocated load, even
-            # if they are now inactive or flagged as having no workload
-
-            # Check any staff member with no load is active, if not, skip them
-            if not staff.is_active() and load_info[0] == 0:
-                continue
-            # If this colleague isn't flagged as having a workload and doesn't have any, also skip
-            if not staff.has_workload and load_info[0] ==0:
-                continue
-
-            # Check if we have seen this person already, but if not add them to the grand total
-            if not staff in counted_staff:
-                logger.debug("loads: considering staff %s, total hours %f" % (staff, load_info[0]))
-                counted_staff.append(staff)
-                counted_staff.append(staff)
-                total += load_info[0]
-                total_staff += 1
-
-            # Ok, we should include this colleague
-            if show_percentages:
-                combined_item = [staff, 100 * load_info[0] / package.nominal_hours,
-                                 100 * load_info[1] / package.nominal_hours,
-                                 100 * load_info[2] / package.nominal_hours,
-                                 100 * load_info[3] / package.nominal_hours,
-                                 100 * (100 * load_info[0] / staff.fte) / package.nominal_hours]
-            else:
-                combined_item = [staff, load_info[0], load_info[1], load_info[2], load_info[3],
-                                 100 * load_info[0] / staff.fte]
-            group_list.append(combined_item)
-            group_total += load_info[0]
-            group_size += 1
-            if load_info[0]:
-                # Also count staff with allocated hours
-                group_allocated_staff += 1
-        if group_size:
-            group_average = group_total / group_size
-        if group_allocated_staff:
-            group_allocated_average = group_total / group_allocated_staff
-        group_data.append(
-            [group, group_list, group_total, group_average, group_allocated_staff, group_allocated_average])
-
-    if total_staff:
-        average = total / total_staff
-    else:
-        average = 0
+    table = get_loads_table(package, show_percentages)
 
     template = loader.get_template('loads/loads/loads.html')
     context = {
-        'group_data': group_data,
-        'total': total,
-        'total_staff': total_staff,
-        'average': average,
+        'table': table,
         'package': package,
         'show_percentages': show_percentages,
         'loads_menu': True,
@@ -385,6 +334,7 @@ def loads(request):
 
 @login_required
 @staff_only
+@package_conditional
 def loads_by_staff_chart(request):
     """
     Show a graph of the loads for all members of staff in all groups in a given workpackage
@@ -438,110 +388,15 @@ def loads_by_staff_chart(request):
     # I'm not sure that it makes sense not to have percentages, but in case we change our minds
     show_percentages = True
 
-    # We shall want to consider totals for averages, but as some users can be in multiple
-    # groups, we will keep a list to make sure we don't double count.
-    total = 0.0
-    total_staff = 0
-    counted_staff = list()
-    group_data = []
-
-    # Go through each group in turn
-    for group in package.groups.all():
-        # We are going to have some summary statistics for each group too
-        group_list = []
-        group_size = 0
-        group_total = 0.0
-        group_average = 0.0
-        group_allocated_staff = 0
-        group_allocated_average = 0.0
-        # Get the users in the group, order by last name initially
-        users = User.objects.all().filter(groups__in=[group]).distinct()
-        # And the associated staff objects, sort them here to avoid a double hit
-        staff_list = Staff.objects.all().filter(user__in=users).order_by('user__last_name')
-        for staff in staff_list:
-            staff_hours_by_category = staff.hours_by_category(package=package)
-
-            # Total hours
-            hours = sum(staff_hours_by_category.values())
-
-            # Note below: the reason for checking any load as will as conditions is to allow
-            # colleagues to appear in other workpackages in times when they had an allocated load, even
-            # if they are now inactive or flagged as having no workload
-
-            # Check any staff member with no load is active, if not, skip them
-            if not staff.is_active() and hours == 0:
-                continue
-            # If this colleague isn't flagged as having a workload and doesn't have any, also skip
-            if not staff.has_workload and hours ==0:
-                continue
-
-            # Check if we have seen this person already, but if not add them to the grand total
-            if not staff in counted_staff:
-                logger.debug("loads: considering staff %s, total hours %f" % (staff, hours))
-                counted_staff.append(staff)
-                total += hours
-                total_staff += 1
-
-            # For each member of staff, we want a list which includes, for each category
-            # The category, the number of hours in that category, and the percentage for the category
-            # as calculated against the nominal hours for the package
-            staff_loads_by_category = list()
-            for key, value in staff_hours_by_category.items():
-                if scale_fte:
-                    staff_loads_by_category.append(
-                        [key, value, 100 * value / (package.nominal_hours * staff.fte / 100)])
-                else:
-                    staff_loads_by_category.append(
-                        [key, value, 100 * value / package.nominal_hours])
-
-            # For each staff member, the bar width is keyed to be 80% for 100% load, up to 100% for 125% load
-            # This allows us to show some moderately overloaded staff clearly.
-            if scale_fte:
-                bar_width = 0.8 * 100 * (100 / staff.fte) * hours / package.nominal_hours
-            else:
-                bar_width = 0.8 * 100 * hours / package.nominal_hours
-
-            if bar_width < 80:
-                bar_width = 80
-            if bar_width > 100:
-                bar_width = 100
-
-            # Now add all this data for each member of staff
-            combined_item = [staff, staff_loads_by_category, hours, bar_width, hours * (100/staff.fte)]
-            group_list.append(combined_item)
-            group_total += hours
-            group_size += 1
-            if hours !=0:
-                # Also count staff with allocated hours
-                group_allocated_staff += 1
-        if group_size:
-            group_average = group_total / group_size
-        if group_allocated_staff:
-            group_allocated_average = group_total / group_allocated_staff
-
-        # We want to sort with the most loaded staff at the top, using scaled hours to compensate for FTE
-        if sort_by_load:
-            group_list = sorted(group_list, key=lambda item : item[4], reverse=True)
-
-        group_data.append(
-            [group, group_list, group_total, group_average, group_allocated_staff, group_allocated_average])
-
-    if total_staff:
-        average = total / total_staff
-    else:
-        average = 0
+    table = get_loads_charts_table(package, sort_by_load, show_90_110, scale_fte)
 
     template = loader.get_template('loads/loads/loads_charts.html')
     context = {
+        'table': table,
         'form': form,
         'sort_by_load': sort_by_load,
         'show_90_110': show_90_110,
-        'group_data': group_data,
-        'total': total,
-        'total_staff': total_staff,
-        'average': average,
         'package': package,
-        'categories': Category.objects.all(),
         'show_percentages': show_percentages,
         'loads_menu': True,
     }
@@ -550,6 +405,7 @@ def loads_by_staff_chart(request):
 
 @login_required
 @staff_only
+@package_conditional
 def loads_modules(request, semesters, staff_details=False):
     """Shows allocation information by modules"""
     # Fetch the staff user associated with the person requesting
@@ -558,7 +414,6 @@ def loads_modules(request, semesters, staff_details=False):
     package = staff.package
 
     logger.info("[%s] loads by modules viewed" % request.user, extra={'package': package})
-    modules = Module.objects.all().filter(package=package).order_by('module_code')
 
     # if this is a POST request we need to process the form data
     brief_details = None
@@ -584,53 +439,14 @@ def loads_modules(request, semesters, staff_details=False):
     else:
         valid_semesters = list()
 
-    combined_list = []
-    for module in modules:
-        # Is it valid for the semester, i.e. are any of its semesters in the one being passed in?
-        if len(valid_semesters):
-            module_semesters = module.semester.split(',')
-            valid_semester = False
-            for m_sem in module_semesters:
-                for v_sem in valid_semesters:
-                    if m_sem == v_sem:
-                        valid_semester = True
-            if not valid_semester:
-                continue
-
-        # Get Allocation information
-        module_staff = ModuleStaff.objects.all().filter(module=module)
-        contact_proportion = 0
-        admin_proportion = 0
-        assessment_proportion = 0
-        extra_hours = 0
-        for allocation in module_staff:
-            contact_proportion += allocation.contact_proportion
-            admin_proportion += allocation.admin_proportion
-            assessment_proportion += allocation.assessment_proportion
-
-        activities = Activity.objects.all().filter(module=module)
-        for activity in activities:
-            hours_per_semester = activity.hours_by_semester()
-            extra_hours += hours_per_semester[0]
-
-        module_info = [module,
-                       module.get_contact_hours(),
-                       contact_proportion,
-                       module.get_admin_hours(),
-                       admin_proportion,
-                       module.get_assessment_hours(),
-                       assessment_proportion,
-                       extra_hours,
-                       module_staff]
-
-        combined_list.append(module_info)
+    table = get_modules_table(package, semesters, brief_details)
 
     template = loader.get_template('loads/loads/modules.html')
     context = {
+        'table': table,
         'form': form,
         'brief_details': brief_details,
         'valid_semesters': valid_semesters,
-        'combined_list': combined_list,
         'package': package,
         'loads_menu': True,
         'staff_details': staff_details,
@@ -640,6 +456,106 @@ def loads_modules(request, semesters, staff_details=False):
 
 @login_required
 @staff_only
+@permission_required('loads.change_modulestaff')
+@require_POST
+def loads_simulate(request):
+    """Shows the effect of hypothetical allocation changes on staff loads, without saving anything
+
+    The request body is a JSON object with a list of "changes" for the current package, as
+    described in LoadSimulator.simulate(). The response is a JSON object with the loads of
+    each affected member of staff before and after the changes.
+    """
+    # Fetch the staff user associated with the person requesting
+    staff = get_object_or_404(Staff, user=request.user)
+    # And therefore the package enabled for that user
+    package = staff.package
+    if not package:
+        return JsonResponse({'errors': ['no work package is selected']}, status=400)
+
+    try:
+        changes = json.loads(request.body)['changes']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'errors': ['expected a JSON object with a list of changes']}, status=400)
+    if not isinstance(changes, list):
+        return JsonResponse({'errors': ['changes must be a list']}, status=400)
+
+    simulator = LoadSimulator.get_for_package(package)
+    try:
+        results = simulator.simulate(changes)
+    except ValidationError as error:
+        return JsonResponse({'errors': error.messages}, status=400)
+
+    logger.debug("[%s] simulated %u changes" % (request.user, len(changes)), extra={'package': package})
+    staff_loads = [dict(staff=staff_id, name=str(simulator.staff_by_id[staff_id]), **loads)
+                   for staff_id, loads in results.items()]
+    return JsonResponse({
+        'package': package.pk,
+        'generation': simulator.generation,
+        'nominal_hours': package.nominal_hours,
+        'staff': sorted(staff_loads, key=lambda item: item['name']),
+    })
+
+
+@login_required
+@staff_only
+def loads_trend(request, staff_id=None):
+    """Shows loads over all the years of WorkPackages, for one member of staff or everyone in a school
+
+    With no staff_id, everyone in the school of the requesting member of staff is shown, or if they
+    have no school, everyone in their current package.
+    """
+    # Fetch the staff user associated with the person requesting
+    requesting_staff = get_object_or_404(Staff, user=request.user)
+    package = requesting_staff.package
+
+    if staff_id is not None:
+        staff = get_object_or_404(Staff, pk=staff_id)
+        staff_list = [staff]
+        logger.info("[%s] viewed load trend for %s" % (request.user, staff))
+    else:
+        staff = None
+        if requesting_staff.school:
+            staff_list = Staff.objects.filter(school=requesting_staff.school, is_external=False)
+        elif package:
+            staff_list = package.get_all_staff()
+        else:
+            staff_list = Staff.objects.none()
+        staff_list = staff_list.select_related('user')
+        logger.info("[%s] viewed load trends" % request.user)
+
+    # Only show packages that the requesting member of staff can see
+    trend = LoadTrend(staff_list, packages=requesting_staff.get_all_packages())
+
+    rows = list()
+    for row, row_staff in enumerate(trend.staff):
+        columns = [(trend.totals[row][column], trend.get_percentage(row, column))
+                   for column in range(len(trend.packages))]
+        # Leave out anyone who appears in none of the packages
+        if any(total is not None for total, percentage in columns):
+            rows.append((row_staff, columns))
+
+    package_rows = list()
+    if staff is not None:
+        for column, trend_package in enumerate(trend.packages):
+            if trend.hours[0][column] is not None:
+                package_rows.append((trend_package, trend.hours[0][column], trend.totals[0][column],
+                                     trend.get_percentage(0, column)))
+
+    template = loader.get_template('loads/loads/trend.html')
+    context = {
+        'staff': staff,
+        'trend': trend,
+        'rows': rows,
+        'package_rows': package_rows,
+        'package': package,
+        'loads_menu': True,
+    }
+    return HttpResponse(template.render(context, request))
+
+
+@login_required
+@staff_only
+@package_conditional
 def activities(request, staff_id):
     """Show the activities for a given staff member"""
 
@@ -662,15 +578,16 @@ def activities(request, staff_id):
             return [label, 100*row_sum/n, 100*s1/n, 100*s2/n, 100*s3/n]
         return [label, row_sum, s1, s2, s3]
 
+    # Fetch all the load data for this staff member in the package in one go
+    engine = PackageLoadEngine(package, staff=staff)
+
     # ------------------------------------------------------------------
     # Explicit activities (non-module)
     # ------------------------------------------------------------------
     combined_list = []
     s1_total = s2_total = s3_total = 0.0
 
-    activities = (Activity.objects
-                  .filter(staff=staff, package=package)
-                  .order_by('name'))
+    activities = sorted(engine.get_activities(staff), key=lambda activity: activity.name)
 
     for activity in activities:
         load_info = activity.hours_by_semester()
@@ -685,11 +602,7 @@ def activities(request, staff_id):
     # ------------------------------------------------------------------
     combined_list_modules = []
 
-    modulestaff = (ModuleStaff.objects
-                   .filter(staff=staff_id, package=package)
-                   .select_related('module', 'module__coordinator'))
-
-    for moduledata in modulestaff:
+    for moduledata in engine.get_modulestaff(staff):
         for label, _row_total, s1, s2, s3 in moduledata.get_hours_breakdown():
             combined_list_modules.append(make_row(label, s1, s2, s3))
             s1_total += s1
@@ -803,6 +716,32 @@ def assessmentstaff_delete(request, assessmentstaff_id):
     return HttpResponseRedirect(url)
 
 
+def get_tasks_page_context(request, tasks):
+    """Classifies, filters and paginates tasks in the database, returning the context for the tasks index
+
+    request     the request, whose status and page GET parameters are used
+    tasks       a queryset of tasks, which are shown in deadline order
+    """
+    # Tasks with the same deadline are ordered by key, so none are repeated or lost between pages
+    tasks = Task.annotate_urgency(tasks).order_by('deadline', 'pk')
+    status = request.GET.get('status', '')
+    if status == 'overdue':
+        tasks = tasks.filter(overdue=True)
+    elif status == 'urgent':
+        tasks = tasks.filter(urgent=True, overdue=False)
+    elif status == 'pending':
+        tasks = tasks.filter(urgent=False)
+    else:
+        status = ''
+
+    page = Paginator(tasks, TASKS_PER_PAGE).get_page(request.GET.get('page'))
+    return {
+        'augmented_tasks': [[task, task.urgent, task.overdue] for task in page],
+        'page': page,
+        'status': status,
+    }
+
+
 @login_required
 def tasks_index(request):
     """Obtains a list of all non archived tasks"""
@@ -811,17 +750,13 @@ def tasks_index(request):
     tasks = staff.get_all_tasks()
     # tasks = Task.objects.all().exclude(archive=True).order_by('deadline')
 
-    augmented_tasks = []
-    for task in tasks:
-        augmented_tasks.append([task, task.is_urgent(), task.is_overdue()])
-
     logger.info("[%s] viewed their tasks" % request.user)
     template = loader.get_template('loads/tasks/index.html')
-    context = {
-        'augmented_tasks': augmented_tasks,
+    context = get_tasks_page_context(request, tasks)
+    context.update({
         'tasks_menu': True,
         'archived': False
-    }
+    })
     return HttpResponse(template.render(context, request))
 
 
@@ -834,17 +769,13 @@ def archived_tasks_index(request):
     tasks = staff.get_all_tasks(archived=True)
     # tasks = Task.objects.all().exclude(archive=True).order_by('deadline')
 
-    augmented_tasks = []
-    for task in tasks:
-        augmented_tasks.append([task, task.is_urgent(), task.is_overdue()])
-
     logger.debug("[%s] viewed their archived tasks" % request.user)
     template = loader.get_template('loads/tasks/index.html')
-    context = {
-        'augmented_tasks': augmented_tasks,
+    context = get_tasks_page_context(request, tasks)
+    context.update({
         'tasks_menu': True,
         'archived': True
-    }
+    })
     return HttpResponse(template.render(context, request))
 
 
@@ -853,21 +784,22 @@ def archived_tasks_index(request):
 def tasks_bystaff(request, staff_id):
     """Show the tasks assigned against the specific user of the staff member"""
     staff = get_object_or_404(Staff, pk=staff_id)
-    all_tasks = staff.get_all_tasks()
+    # All their tasks and completions, found at once
+    matrix = TaskCompletionMatrix.for_staff(staff)
 
     logger.info("[%s] viewed the tasks assigned to %s" % (request.user, staff))
     # We will create separate lists for those tasks that are complete
     combined_list_complete = []
     combined_list_incomplete = []
 
-    for task in all_tasks:
+    for task in matrix.tasks:
         # Is it complete? Look for a completion model
-        completion = TaskCompletion.objects.all().filter(staff=staff).filter(task=task)
-        if len(completion) == 0:
-            combined_item = [task, task.is_urgent(), task.is_overdue()]
+        completion = matrix.get_completion(task, staff)
+        if completion is None:
+            combined_item = [task, matrix.is_urgent(task), matrix.is_overdue(task)]
             combined_list_incomplete.append(combined_item)
         else:
-            combined_item = [task, completion[0].when]
+            combined_item = [task, completion.when]
             combined_list_complete.append(combined_item)
 
     template = loader.get_template('loads/tasks/bystaff.html')
@@ -886,21 +818,22 @@ def tasks_details(request, task_id):
     task = get_object_or_404(Task, pk=task_id)
 
     logger.info("[%s] viewed details of task %s" % (request.user, task), extra={'task': task})
-    all_targets = task.get_all_targets()
+    # All the targets and their completions, found at once
+    matrix = TaskCompletionMatrix.for_task(task)
 
     combined_list_complete = []
     combined_list_incomplete = []
 
-    for target in all_targets:
+    for target in matrix.staff:
         # Is it complete? Look for a completion model
-        completion = TaskCompletion.objects.all().filter(staff=target).filter(task=task)
-        if len(completion) == 0:
+        completion = matrix.get_completion(task, target)
+        if completion is None:
             # Not complete, but only add the target if they aren't active
             if target.is_active():
                 combined_item = [target, False]
                 combined_list_incomplete.append(combined_item)
         else:
-            combined_item = [target, completion[0]]
+            combined_item = [target, completion]
             combined_list_complete.append(combined_item)
 
     total_number = len(combined_list_complete) + len(combined_list_incomplete)
@@ -912,8 +845,8 @@ def tasks_details(request, task_id):
     template = loader.get_template('loads/tasks/details.html')
     context = {
         'task': task,
-        'overdue': task.is_overdue(),
-        'urgent': task.is_urgent(),
+        'overdue': matrix.is_overdue(task),
+        'urgent': matrix.is_urgent(task),
         'combined_list_complete': combined_list_complete,
         'combined_list_incomplete': combined_list_incomplete,
         'percentage_complete': percentage_complete
@@ -929,7 +862,10 @@ def custom_admin_index(request):
 
     logger.info("[%s] (admin) custom admin menu viewed" % request.user)
     template = loader.get_template('loads/admin/index.html')
-    return HttpResponse(template.render({}, request))
+    context = {
+        'fragment_statistics': get_fragment_statistics(),
+    }
+    return HttpResponse(template.render(context, request))
 
 
 @login_required
@@ -999,7 +935,7 @@ def tasks_completion(request, task_id, staff_id):
     # Get the task itself, and all targetted users
     # TODO: check for existing completions
     # TODO: check staff is in *open* targets
-    task = get_object_or_404(Task, pk=task_id)
+    task = get_object_or_404(Task.annotate_urgency(Task.objects.all()), pk=task_id)
     staff = get_object_or_404(Staff, pk=staff_id)
     all_targets = task.get_all_targets()
 
@@ -1056,19 +992,20 @@ def add_assessment_resource(request, module_id):
     # Assume a lack of permission, unless a coordinator, teaching team member, moderator, examiner, or superuser
     permission = False
     logger.debug("[%s] checking status for module %s, pre upload" % (request.user, module))
-    if staff == module.coordinator:
+    roles = ModuleRelationships.get_for_module(staff, module).get_roles(module)
+    if roles & ModuleRelationships.COORDINATOR:
         logger.debug("[%s] is a module coordinator" % request.user)
         permission = True
-    elif staff in module.moderators.all():
+    elif roles & ModuleRelationships.MODERATOR:
         logger.debug("[%s] is a module moderator" % request.user)
         permission = True
-    elif staff in ModuleStaff.objects.filter(module=module):
+    elif roles & ModuleRelationships.TEAM_MEMBER:
         logger.debug("[%s] is on the module team" % request.user)
         permission = True
     elif staff.can_examine_module(module):
         logger.debug("[%s] is a module examiner" % request.user)
         permission = True
-    elif staff in AssessmentStaff.objects.filter(package=module.package):
+    elif roles & ModuleRelationships.ASSESSMENT_STAFF:
         logger.debug("[%s] is on the assessment team for the package" % request.user)
         permission = True
     elif staff.user.is_superuser:
@@ -1250,59 +1187,57 @@ def modules_index(request, semesters):
         # Check for any semester limitations, split by comma if something is actually there
     if semesters:
         valid_semesters = semesters.split(',')
+        # Only modules in at least one of these semesters
+        modules = modules.filter(semester_mask__in=overlapping_semester_masks(semester_mask(semesters)))
     else:
         valid_semesters = list()
 
 
+    # Only modules on the chosen programme, and if requested for which it is the lead
+    if programme:
+        modules = modules.filter(programmes=programme)
+        if lead_programme:
+            modules = modules.filter(lead_programme=programme)
+
+    # The latest resource and sign off for each module are found in subqueries, and fetched in one go below
+    latest_resources = AssessmentResource.objects.filter(module=OuterRef('pk')).order_by('-created', '-pk')
+    latest_signoffs = AssessmentStateSignOff.objects.filter(module=OuterRef('pk')).order_by('-created', '-pk')
+    modules = modules.select_related('coordinator__user', 'lead_programme'). \
+        annotate(latest_resource_id=Subquery(latest_resources.values('pk')[:1]),
+                 latest_signoff_id=Subquery(latest_signoffs.values('pk')[:1])). \
+        prefetch_related(Prefetch('moderators', queryset=Staff.objects.select_related('user')),
+                         Prefetch('lead_programme__examiners', queryset=Staff.objects.select_related('user')))
+    modules = list(modules)
+
+    resources = AssessmentResource.objects.in_bulk(
+        [module.latest_resource_id for module in modules if module.latest_resource_id])
+    signoffs = AssessmentStateSignOff.objects.select_related('assessment_state').in_bulk(
+        [module.latest_signoff_id for module in modules if module.latest_signoff_id])
+    workflow = AssessmentWorkflow.get()
+
+    # The logged in user's relationships to all the modules, found once
+    relationships = ModuleRelationships.get_for_staff(staff, package.pk)
+
     combined_list = []
     for module in modules:
-        # If there's a selected programme and this module isn't it, then skip
-        if programme and module not in programme.modules.all():
-            continue
-        # And skip if lead programme is set, and this isn't the lead programme
-        if programme and lead_programme and not (module.lead_programme == programme):
-            continue
-        # Is it valid for the semester, i.e. are and of its semesters in the passed in one?
-        if len(valid_semesters):
-            module_semesters = module.semester.split(',')
-            valid_semester = False
-            for m_sem in module_semesters:
-                for v_sem in valid_semesters:
-                    if m_sem == v_sem:
-                        valid_semester = True
-            if not valid_semester:
-                continue
-
         # Store all relationships to the modules
         relationship = []
+        roles = relationships.get_roles(module)
 
         # Is the logged in user on the teaching team?
-        module_staff = ModuleStaff.objects.all().filter(module=module).filter(staff=staff)
-        if len(module_staff):
+        if roles & ModuleRelationships.TEAM_MEMBER:
             relationship.append('team_member')
 
         # Is the logged in user a moderator?
-        if staff in module.moderators.all():
+        if roles & ModuleRelationships.MODERATOR:
             relationship.append('moderator')
 
         # get the most recent assessment resource
-        resources = AssessmentResource.objects.all().filter(module=module).order_by('-created')[:1]
-        signoffs = AssessmentStateSignOff.objects.all().filter(module=module).order_by('-created')[:1]
-
-        if len(resources) > 0:
-            resource = resources[0]
-        else:
-            resource = False
+        resource = resources.get(module.latest_resource_id, False)
 
         # Can the logged in user set a new assessment state?
-        action_possible = False
-        if len(signoffs) > 0:
-            signoff = signoffs[0]
-            for state in signoff.assessment_state.next_states.all():
-                if state.can_be_set_by_staff(staff, module):
-                    action_possible = True
-        else:
-            signoff = False
+        signoff = signoffs.get(module.latest_signoff_id, False)
+        action_possible = bool(signoff and workflow.get_settable_states(staff, module, signoff.assessment_state_id))
 
         combined_item = [module, relationship, resource, signoff, action_possible, module.get_lead_examiners()]
         combined_list.append(combined_item)
@@ -1339,8 +1274,9 @@ def external_modules_index(request, semesters):
     # Get the list of programmes that they examine
     examined_programmes = external.get_examined_programmes()
 
-    # Get all the modules in the package, pending further filtering
-    modules = Module.objects.all().filter(package=package).order_by('module_code')
+    # Get all the modules in the package they can examine, pending further filtering
+    modules = Module.objects.all().filter(package=package, pk__in=external.get_examined_module_ids()). \
+        order_by('module_code')
 
     # if this is a POST request we need to process the form data
     if request.method == 'POST':
@@ -1367,44 +1303,35 @@ def external_modules_index(request, semesters):
         # Check for any semester limitations, split by comma if something is actually there
     if semesters:
         valid_semesters = semesters.split(',')
+        # Only modules in at least one of these semesters
+        modules = modules.filter(semester_mask__in=overlapping_semester_masks(semester_mask(semesters)))
     else:
         valid_semesters = list()
 
+    examined_programme_ids = set(examined_programmes.values_list('pk', flat=True))
+    workflow = AssessmentWorkflow.get()
+
     combined_list = []
     for module in modules:
-        # Controversial... filter out modules not relevant
-        if not external.can_examine_module(module):
-            continue
         # If there's a selected programme and this module isn't it, then skip
         if programme and module not in programme.modules.all():
             continue
         # And skip if lead programme is set, and this isn't the lead programme
         if programme and lead_programme and not (module.lead_programme == programme):
             continue
-        # Is it valid for the semester, i.e. are and of its semesters in the passed in one?
-        if len(valid_semesters):
-            module_semesters = module.semester.split(',')
-            valid_semester = False
-            for m_sem in module_semesters:
-                for v_sem in valid_semesters:
-                    if m_sem == v_sem:
-                        valid_semester = True
-            if not valid_semester:
-                continue
-
         # Store all relationships to the modules
         relationship = []
 
-        if module.lead_programme in examined_programmes:
+        if module.lead_programme_id in examined_programme_ids:
             relationship.append('lead_external')
-            # That's good enough, don't bother checking for other relations
         else:
-            if any(programme in examined_programmes for programme in module.programmes.all()):
-                relationship.append('external')
+            # Otherwise they can only examine it through another of its programmes
+            relationship.append('external')
 
         # get the most recent assessment resource
         resources = AssessmentResource.objects.all().filter(module=module).order_by('-created')[:1]
-        signoffs = AssessmentStateSignOff.objects.all().filter(module=module).order_by('-created')[:1]
+        signoffs = AssessmentStateSignOff.objects.all().filter(module=module).select_related('assessment_state'). \
+            order_by('-created')[:1]
 
         if len(resources) > 0:
             resource = resources[0]
@@ -1412,14 +1339,12 @@ def external_modules_index(request, semesters):
             resource = False
 
         # Can the logged in user set a new assessment state?
-        action_possible = False
         if len(signoffs) > 0:
             signoff = signoffs[0]
-            for state in signoff.assessment_state.next_states.all():
-                if state.can_be_set_by_external(external, module):
-                    action_possible = True
+            action_possible = bool(workflow.get_settable_states(external, module, signoff.assessment_state_id))
         else:
             signoff = False
+            action_possible = False
 
         combined_item = [module, relationship, resource, signoff, action_possible, module.get_lead_examiners()]
         combined_list.append(combined_item)
@@ -1474,7 +1399,8 @@ def modules_details(request, module_id):
     # There's a subtle bug in using just the history for help, so using signoffs too.
     assessment_history = module.get_assessment_history()
     # Get all signoffs to date
-    assessment_signoffs = AssessmentStateSignOff.objects.all().filter(module=module).order_by('-created')
+    assessment_signoffs = AssessmentStateSignOff.objects.all().filter(module=module).select_related('assessment_state'). \
+        order_by('-created')
 
     # Detect if any assessment resources exist that are not signed
     unsigned_items = False
@@ -1529,20 +1455,15 @@ def add_assessment_sign_off(request, module_id):
         return HttpResponseRedirect(reverse('forbidden'))
 
     # Get all signoffs to date
-    assessment_signoffs = AssessmentStateSignOff.objects.all().filter(module=module).order_by('-created')
+    assessment_signoffs = AssessmentStateSignOff.objects.all().filter(module=module).select_related('assessment_state'). \
+        order_by('-created')
 
-    # Have we any already?
-    if not len(assessment_signoffs):
-        # No, so get all allowed initial states
-        next_states = AssessmentState.objects.all().filter(initial_state=True)
-    else:
-        # There, are, so it's just the last object's sign off
-        next_states = assessment_signoffs[0].assessment_state.next_states.all()
+    # Have we any already? If not, the initial states are allowed, otherwise those after the last sign off
+    current_state_id = assessment_signoffs[0].assessment_state_id if len(assessment_signoffs) else None
 
-    # These are the possible successor states, but same may not be allowed to the current user
-    for state in next_states:
-        if not state.can_be_set_by(staff, module):
-            next_states = next_states.exclude(pk=state.pk)
+    # Of the possible successor states, only some may be allowed to the current user
+    settable_states = AssessmentWorkflow.get().get_settable_states(staff, module, current_state_id)
+    next_states = AssessmentState.objects.all().filter(pk__in=[state.pk for state in settable_states])
 
     # if this is a POST request we need to process the form data
     if request.method == 'POST':
@@ -1659,6 +1580,72 @@ def delete_assessment_sign_off(request, signoff_id, confirm=None):
     return HttpResponseRedirect(url)
 
 
+@login_required
+@staff_only
+@permission_required('loads.add_modulestaff')
+def modules_allocation_solver(request):
+    """Proposes allocations of unallocated module work to balance loads, which can be accepted in bulk"""
+    # Fetch the staff user associated with the person requesting
+    staff = get_object_or_404(Staff, user=request.user)
+    # And therefore the package enabled for that user
+    package = staff.package
+    if not package:
+        url = reverse('workpackage_change')
+        return HttpResponseRedirect(url)
+
+    step = 50
+    activity_type = None
+    if request.method == 'POST':
+        form = AllocationSolverForm(request.POST, package=package)
+        if form.is_valid():
+            step = form.cleaned_data['step']
+            activity_type = form.cleaned_data['activity_type']
+    else:
+        form = AllocationSolverForm(package=package)
+        if not package.nominal_hours:
+            form.add_error(None, AllocationSolverForm.NO_NOMINAL_HOURS)
+
+    if not package.nominal_hours:
+        # Loads can't be compared, so nothing can be proposed
+        template = loader.get_template('loads/modules/allocation_solver.html')
+        context = {
+            'form': form,
+            'package': package,
+            'modules_menu': True,
+        }
+        return HttpResponse(template.render(context, request))
+
+    solver = AllocationSolver(package, step=step)
+    proposals = solver.get_proposals()
+
+    if request.method == 'POST' and 'accept' in request.POST and form.is_valid():
+        # The proposals are only the same as those previewed if nothing has changed since
+        if request.POST.get('generation') != str(solver.generation):
+            messages.error(request, 'The work package has changed since these proposals were shown, '
+                                    'please review them again')
+        else:
+            created = solver.accept(proposals, activity_type=activity_type)
+            logger.info("[%s] accepted %u proposed module allocations" % (request.user, created),
+                        extra={'package': package})
+            messages.success(request, '%u allocations made' % created)
+            url = reverse('loads_modules', kwargs={'semesters': ''})
+            return HttpResponseRedirect(url)
+
+    logger.info("[%s] proposed module allocations viewed" % request.user, extra={'package': package})
+    template = loader.get_template('loads/modules/allocation_solver.html')
+    context = {
+        'form': form,
+        'package': package,
+        'solver': solver,
+        'proposals': proposals,
+        'load_changes': solver.get_load_changes(proposals),
+        'spread_now': solver.get_spread(),
+        'spread_proposed': solver.get_spread(proposals),
+        'modules_menu': True,
+    }
+    return HttpResponse(template.render(context, request))
+
+
 @login_required
 @staff_only
 @permission_required('loads.add_modulestaff')
@@ -0,0 +1,82 @@
+"""Entry points for the worker processes used by management commands
+
+Workers may be started by fork, spawn or forkserver, depending on the platform and the version
+of Python. With spawn and forkserver each worker imports this module before Django is set up,
+so nothing here imports models at the top level. They are imported inside each function, which
+only runs once initialise_worker() has set Django up.
+"""
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+
+# How workers are started, None uses the default for the platform
+START_METHOD = None
+
+# Database connections inherited from a forked parent, kept so a worker never closes them
+inherited_connections = list()
+
+
+def get_pool(workers):
+    """Returns a ProcessPoolExecutor with the given number of workers, each set up for Django"""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(START_METHOD),
+                               initializer=initialise_worker)
+
+
+def initialise_worker():
+    """Prepares a worker process, which needs Django set up and its own database connections
+
+    A forked worker starts with copies of the connections of its parent. Closing those would close
+    them for the parent too, so they are set aside instead, and the worker opens its own.
+    """
+    django.setup()
+
+    from django.db import connections
+    for connection in connections.all(initialized_only=True):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # The database only exists in memory, so the worker's copy is its own
+            continue
+        if connection.connection is not None:
+            inherited_connections.append(connection.connection)
+            connection.connection = None
+
+
+def warm_package(package_id):
+    """Warms the caches for one package, creating any missing load summaries first
+
+    returns a tuple of the package id, its name, the number of summaries created and fragment timings
+    """
+    from .caching import warm_package_fragments
+    from .models import StaffLoadSummary
+    from .models import WorkPackage
+
+    package = WorkPackage.objects.get(pk=package_id)
+    created = StaffLoadSummary.create_missing(package)
+    if created:
+        # Which moved the package on to a new generation
+        package = WorkPackage.objects.get(pk=package_id)
+    timings = warm_package_fragments(package)
+    return package_id, str(package), created, timings
+
+
+def render_reminder(reminder):
+    """Renders the email for one task reminder, which needs no database queries
+
+    reminder    a dict of the context for the templates, see the email_reminders command
+
+    returns a tuple of the email subject, the plain text and the html
+    """
+    from django.conf import settings
+    from django.template.loader import get_template
+
+    plaintext = get_template('loads/emails/task_reminders.txt')
+    html = get_template('loads/emails/task_reminders.html')
+
+    if reminder['urgent_tasks']:
+        email_subject = 'URGENT: Your task reminders'
+    else:
+        email_subject = 'Your task reminders'
+
+    context_dict = dict(reminder, base_url=settings.WAM_URL)
+    return email_subject, plaintext.render(context_dict), html.render(context_dict)